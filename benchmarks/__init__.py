@@ -0,0 +1 @@
+"""Microbenchmarks of the server internals, compared against stored baselines"""
@@ -0,0 +1,81 @@
+"""Run the benchmarks and compare them with the stored baseline
+
+python -m benchmarks                  # fail on regressions
+python -m benchmarks --save           # record a new baseline
+python -m benchmarks -k wg.sync       # only matching benchmarks
+"""
+
+import argparse
+import os
+import sys
+
+from . import cases  # noqa: F401, registers the benchmarks
+from .harness import (
+    DEFAULT_TOLERANCE,
+    compare,
+    format_time,
+    load_baseline,
+    save_baseline,
+    select,
+)
+
+DEFAULT_BASELINE = os.path.join(os.path.dirname(__file__), "baseline.json")
+
+
+def main() -> int:
+    parser = argparse.ArgumentParser(description="Aspen VPN server benchmarks")
+    parser.add_argument(
+        "-k", dest="pattern", default="", help="Only run benchmarks matching this"
+    )
+    parser.add_argument(
+        "--baseline", default=DEFAULT_BASELINE, help="Baseline JSON file"
+    )
+    parser.add_argument(
+        "--tolerance",
+        type=float,
+        default=DEFAULT_TOLERANCE,
+        help="Allowed slowdown over the baseline, as a fraction",
+    )
+    parser.add_argument(
+        "--repeat", type=int, help="Timings per benchmark, overriding each default"
+    )
+    parser.add_argument(
+        "--save",
+        action="store_true",
+        help="Store the results as the new baseline instead of comparing",
+    )
+    args = parser.parse_args()
+
+    benchmarks = select(args.pattern)
+    if not benchmarks:
+        print(f"No benchmarks match {args.pattern!r}")
+        return 2
+
+    baseline = load_baseline(args.baseline)
+    results = {}
+    for bench in benchmarks:
+        result = results[bench.id] = bench.run(args.repeat)
+        previous = baseline.get(bench.id)
+        change = f"{result['min'] / previous['min'] - 1:+.0%}" if previous else "new"
+        print(
+            f"{bench.id:<40} {format_time(result['min']):>10} "
+            f"(median {format_time(result['median'])})  {change}"
+        )
+
+    if args.save:
+        # Benchmarks not run this time keep their previous baseline
+        save_baseline(args.baseline, {**baseline, **results})
+        print(f"Baseline saved to {args.baseline}")
+        return 0
+
+    regressions = compare(results, baseline, args.tolerance)
+    if regressions:
+        print(f"\nSlower than the baseline by more than {args.tolerance:.0%}:")
+        for regression in regressions:
+            print(f"  {regression}")
+        return 1
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -0,0 +1,226 @@
+"""Benchmarks of the server internals
+
+Everything runs against in-memory SQLite and the in-memory WireGuard
+backend, so no root or interface is needed.
+"""
+
+import asyncio
+import ipaddress
+from itertools import count
+
+from fastapi import FastAPI
+from fastapi.testclient import TestClient
+from sqlalchemy import create_engine, insert
+from sqlalchemy.ext.asyncio import async_sessionmaker, create_async_engine
+from sqlalchemy.orm import sessionmaker
+from sqlalchemy.pool import StaticPool
+
+from server.crud.peer import get_peers
+from server.database.models import Base, IPAllocation, Peer, ip_sort_key
+from server.database.session import AppSession, get_async_db
+from server.routes import peers as peer_routes
+from server.services.auth_cache import auth_cache
+from server.services.ip_manager import IPManager
+from server.services.peer_registry import peer_registry
+from server.services.provisioner import provisioner
+from server.wireguard import (
+    InMemoryBackend,
+    PeerReconciler,
+    set_reconciler,
+    sync_wireguard_peers,
+)
+
+from .harness import benchmark
+
+NETWORK = "10.0.0.0/16"
+SERVER_IP = "10.0.0.1"
+
+
+def memory_engine():
+    """Sync engine over a fresh in-memory database with the schema created"""
+    engine = create_engine(
+        "sqlite://",
+        poolclass=StaticPool,
+        connect_args={"check_same_thread": False},
+    )
+    Base.metadata.create_all(bind=engine)
+    return engine
+
+
+def memory_async_engine():
+    """Async engine over a fresh in-memory database"""
+    return create_async_engine("sqlite+aiosqlite://", poolclass=StaticPool)
+
+
+def seed_peers(connection, peers: int) -> list[str]:
+    """Insert `peers` enabled peers with allocations; returns their API keys"""
+    hosts = ipaddress.ip_network(NETWORK).hosts()
+    next(hosts)  # the server's address
+    api_keys, peer_rows, allocation_rows = [], [], []
+    for peer_id in range(1, peers + 1):
+        ip = str(next(hosts))
+        api_key = f"vpn_bench_{peer_id}"
+        api_keys.append(api_key)
+        peer_rows.append(
+            {
+                "id": peer_id,
+                "name": f"peer-{peer_id}",
+                "public_key": f"{peer_id:0>43}=",
+                "assigned_ip": f"{ip}/32",
+                "is_enabled": True,
+                "api_key_hash": Peer.hash_api_key(api_key),
+                "is_admin": False,
+            }
+        )
+        allocation_rows.append(
+            {"ip_address": ip, "ip_key": ip_sort_key(ip), "peer_id": peer_id}
+        )
+    if peers:
+        connection.execute(insert(Peer), peer_rows)
+        connection.execute(insert(IPAllocation), allocation_rows)
+    return api_keys
+
+
+@benchmark("ip.allocate_release", number=200, fill=[0, 0.5, 0.99])
+def allocate_release(fill):
+    """Allocate an address and release it again, with the pool `fill` full"""
+    # A /20 keeps the 99% case quick to seed: 4094 addresses
+    manager = IPManager("10.0.0.0/20", SERVER_IP)
+    engine = memory_engine()
+    with engine.begin() as connection:
+        taken = int((manager.pool.size - 1) * fill)
+        hosts = manager.network.hosts()
+        next(hosts)
+        rows = [
+            {"ip_address": str(ip), "ip_key": ip_sort_key(str(ip)), "peer_id": None}
+            for ip, _ in zip(hosts, range(taken))
+        ]
+        if rows:
+            connection.execute(insert(IPAllocation), rows)
+    session = sessionmaker(bind=engine, class_=AppSession)()
+    manager.initialize_ip_pool(session)
+    peer_ids = count(1)
+
+    def call():
+        peer_id = next(peer_ids)
+        manager.allocate_ip(session, peer_id)
+        manager.release_ip(session, peer_id)
+
+    yield call
+    session.close()
+    engine.dispose()
+
+
+@benchmark("auth.verify_api_key", number=200, cached=[True, False])
+def verify_api_key(cached):
+    """Authenticate a request among 1000 peers, with or without the auth cache"""
+    async_engine = memory_async_engine()
+    loop = asyncio.new_event_loop()
+
+    async def seed():
+        async with async_engine.begin() as connection:
+            await connection.run_sync(Base.metadata.create_all)
+            return await connection.run_sync(seed_peers, 1000)
+
+    api_key = loop.run_until_complete(seed())[500]
+    session = async_sessionmaker(async_engine, expire_on_commit=False)()
+    auth_cache.clear()
+
+    def call():
+        if not cached:
+            auth_cache.clear()
+        loop.run_until_complete(peer_routes.verify_api_key(api_key, session))
+
+    yield call
+    auth_cache.clear()
+    loop.run_until_complete(session.close())
+    loop.run_until_complete(async_engine.dispose())
+    loop.close()
+
+
+@benchmark("crud.get_peers_page", number=200, after=[0, 5000, 9900])
+def get_peers_page(after):
+    """Fetch a page of 100 peers `after` ids deep into 10k peers"""
+    engine = memory_engine()
+    with engine.begin() as connection:
+        seed_peers(connection, 10_000)
+    session = sessionmaker(bind=engine, class_=AppSession)()
+
+    def call():
+        page = get_peers(session, after_id=after, limit=100)
+        session.expunge_all()
+        return page
+
+    yield call
+    session.close()
+    engine.dispose()
+
+
+@benchmark("wg.sync", number=1, repeat=5, peers=[100, 1000, 10_000])
+def sync_peers(peers):
+    """Sync `peers` peers from the database onto an empty interface"""
+    engine = memory_engine()
+    with engine.begin() as connection:
+        seed_peers(connection, peers)
+    session = sessionmaker(bind=engine, class_=AppSession)()
+
+    def call():
+        changes = sync_wireguard_peers(session, PeerReconciler(InMemoryBackend()))
+        assert len(changes.add) == peers
+        session.expunge_all()
+
+    yield call
+    session.close()
+    engine.dispose()
+
+
+@benchmark("api.register", number=50, repeat=5)
+def register():
+    """Register a peer through the API, including its WireGuard update"""
+    async_engine = memory_async_engine()
+    factory = async_sessionmaker(
+        async_engine, expire_on_commit=False, sync_session_class=AppSession
+    )
+
+    async def override_get_async_db():
+        async with factory() as session:
+            yield session
+
+    async def create_schema():
+        async with async_engine.begin() as connection:
+            await connection.run_sync(Base.metadata.create_all)
+        async with factory() as session:
+            await peer_registry.load_async(session)
+
+    app = FastAPI()
+    app.include_router(peer_routes.router, prefix="/api/peers")
+    app.dependency_overrides[get_async_db] = override_get_async_db
+
+    saved = peer_routes.ip_manager, provisioner.window
+    peer_routes.ip_manager = IPManager(NETWORK, SERVER_IP)
+    # Time the update itself, not the coalescing delay
+    provisioner.window = 0
+    set_reconciler(PeerReconciler(InMemoryBackend()))
+    numbers = count(1)
+    hosts = ipaddress.ip_network(NETWORK).hosts()
+
+    def call():
+        number = next(numbers)
+        response = client.post(
+            "/api/peers/register",
+            json={
+                "name": f"peer-{number}",
+                "public_key": f"{number:0>43}=",
+                "assigned_ip": f"{next(hosts)}/32",
+            },
+        )
+        assert response.status_code == 200, response.text
+
+    try:
+        with TestClient(app) as client:
+            client.portal.call(create_schema)
+            yield call
+            client.portal.call(async_engine.dispose)
+    finally:
+        peer_routes.ip_manager, provisioner.window = saved
+        peer_registry.clear()
@@ -0,0 +1,151 @@
+"""Registering, timing and comparing benchmarks
+
+A benchmark is a generator function: it sets up its state, yields the
+callable to time, and cleans up after the `yield`. Parameterized
+benchmarks run once per combination, named like `wg.sync[peers=1000]`.
+"""
+
+import contextlib
+import gc
+import io
+import itertools
+import json
+import platform
+import statistics
+import time
+from typing import Callable, Iterator, Optional
+
+# A run slower than baseline * (1 + tolerance) is a regression. Loose
+# enough for shared machines, tight enough to catch a lost index or cache.
+DEFAULT_TOLERANCE = 0.5
+
+
+class Benchmark:
+    """One benchmark case with fixed parameters"""
+
+    def __init__(
+        self, name: str, function: Callable, params: dict, number: int, repeat: int
+    ):
+        self.name = name
+        self.function = function
+        self.params = params
+        # Calls per timing, and timings taken
+        self.number = number
+        self.repeat = repeat
+
+    @property
+    def id(self) -> str:
+        if not self.params:
+            return self.name
+        args = ",".join(f"{key}={value}" for key, value in self.params.items())
+        return f"{self.name}[{args}]"
+
+    def run(self, repeat: Optional[int] = None) -> dict:
+        """Time the benchmark and return seconds per call"""
+        # Server code logs as it goes; keep that out of the report
+        with contextlib.redirect_stdout(io.StringIO()):
+            cases = self.function(**self.params)
+            call = next(cases)
+            try:
+                # One untimed call warms caches and lazy loads
+                call()
+                timings = []
+                # As in timeit, collections would land in whichever timing
+                # happened to trigger them
+                gc.collect()
+                gc.disable()
+                try:
+                    for _ in range(repeat or self.repeat):
+                        start = time.perf_counter()
+                        for _ in range(self.number):
+                            call()
+                        timings.append((time.perf_counter() - start) / self.number)
+                finally:
+                    gc.enable()
+            finally:
+                # Resume the generator past its `yield` to clean up
+                next(cases, None)
+        return {
+            "median": statistics.median(timings),
+            "min": min(timings),
+            "max": max(timings),
+            "number": self.number,
+            "repeat": len(timings),
+        }
+
+
+BENCHMARKS: list[Benchmark] = []
+
+
+def benchmark(name: str, number: int = 100, repeat: int = 5, **params: list):
+    """Register a benchmark, once for each combination of `params` values"""
+
+    def register(function: Callable[..., Iterator[Callable[[], object]]]):
+        keys = list(params)
+        for values in itertools.product(*(params[key] for key in keys)):
+            BENCHMARKS.append(
+                Benchmark(name, function, dict(zip(keys, values)), number, repeat)
+            )
+        return function
+
+    return register
+
+
+def select(pattern: str = "") -> list[Benchmark]:
+    """Registered benchmarks whose id contains `pattern`"""
+    return [bench for bench in BENCHMARKS if pattern in bench.id]
+
+
+def compare(
+    results: dict[str, dict],
+    baseline: dict[str, dict],
+    tolerance: float = DEFAULT_TOLERANCE,
+) -> list[str]:
+    """Describe every result slower than its baseline by more than `tolerance`
+
+    Compares the fastest timings, which vary least between runs: slower
+    ones mostly measure other load on the machine.
+    """
+    regressions = []
+    for bench_id, result in results.items():
+        previous = baseline.get(bench_id)
+        if previous is None:
+            continue
+        if result["min"] > previous["min"] * (1 + tolerance):
+            regressions.append(
+                f"{bench_id}: {format_time(result['min'])} per call, "
+                f"baseline {format_time(previous['min'])} "
+                f"(+{result['min'] / previous['min'] - 1:.0%})"
+            )
+    return regressions
+
+
+def load_baseline(path: str) -> dict[str, dict]:
+    """Results stored by `save_baseline`, empty if there are none yet"""
+    try:
+        with open(path) as f:
+            return json.load(f)["results"]
+    except FileNotFoundError:
+        return {}
+
+
+def save_baseline(path: str, results: dict[str, dict]) -> None:
+    """Store results, with the machine they were taken on"""
+    document = {
+        "machine": {
+            "python": platform.python_version(),
+            "platform": platform.platform(),
+            "processor": platform.processor() or platform.machine(),
+        },
+        "results": dict(sorted(results.items())),
+    }
+    with open(path, "w") as f:
+        json.dump(document, f, indent=2)
+        f.write("\n")
+
+
+def format_time(seconds: float) -> str:
+    for unit, scale in (("s", 1), ("ms", 1e-3), ("us", 1e-6)):
+        if seconds >= scale:
+            return f"{seconds / scale:.2f} {unit}"
+    return f"{seconds / 1e-9:.0f} ns"
@@ -0,0 +1,130 @@
+"""
+Async client for the Aspen VPN server API
+"""
+
+import httpx
+
+# Keep-alive connections kept open to the server
+MAX_CONNECTIONS = 4
+
+
+class ApiError(Exception):
+    """The server answered a request with an error"""
+
+    def __init__(self, status_code: int, detail):
+        super().__init__(f"{status_code}: {detail}")
+        self.status_code = status_code
+        self.detail = detail
+
+
+class AspenApi:
+    """One pooled HTTP session to the server
+
+    Calls share keep-alive connections, so concurrent calls made with
+    asyncio.gather do not each pay for a new connection.
+    """
+
+    def __init__(
+        self, server_url: str, api_key: str = None, timeout: float = 10.0, transport=None
+    ):
+        self.api_key = api_key
+        self.http = httpx.AsyncClient(
+            base_url=server_url,
+            timeout=timeout,
+            transport=transport,
+            limits=httpx.Limits(
+                max_connections=MAX_CONNECTIONS,
+                max_keepalive_connections=MAX_CONNECTIONS,
+            ),
+        )
+        # Peer pages fetched before, as params -> (ETag, peers, next cursor)
+        self._pages = {}
+
+    async def __aenter__(self):
+        return self
+
+    async def __aexit__(self, *exc_info):
+        await self.close()
+
+    async def close(self):
+        await self.http.aclose()
+
+    def _headers(self, etag: str = None) -> dict:
+        headers = {}
+        if self.api_key:
+            headers["X-API-Key"] = self.api_key
+        if etag:
+            headers["If-None-Match"] = etag
+        return headers
+
+    @staticmethod
+    def _check(response: httpx.Response):
+        if response.status_code >= 400:
+            try:
+                detail = response.json().get("detail")
+            except ValueError:
+                detail = response.text
+            raise ApiError(response.status_code, detail)
+
+    async def server_info(self, etag: str = None):
+        """Server key and our shard's endpoint, with its ETag
+
+        Returns (None, etag) when the server says `etag` is still current.
+        """
+        response = await self.http.get("/api/server-info", headers=self._headers(etag))
+        if response.status_code == 304:
+            return None, etag
+        self._check(response)
+        return response.json(), response.headers.get("ETag")
+
+    async def register(
+        self, name: str, public_key: str, assigned_ip: str, invite_code: str = None
+    ) -> dict:
+        """Register a peer; the response holds its API key"""
+        body = {"name": name, "public_key": public_key, "assigned_ip": assigned_ip}
+        if invite_code:
+            body["invite_code"] = invite_code
+        response = await self.http.post("/api/peers/register", json=body)
+        self._check(response)
+        return response.json()
+
+    async def peers(self) -> list:
+        """Every registered peer, revalidating pages fetched before"""
+        peers = []
+        params = {"limit": 1000}
+        while True:
+            key = tuple(sorted(params.items()))
+            cached = self._pages.get(key)
+            response = await self.http.get(
+                "/api/peers/",
+                params=params,
+                headers=self._headers(cached[0] if cached else None),
+            )
+            if response.status_code == 304:
+                _, page, cursor = cached
+            else:
+                self._check(response)
+                page, cursor = response.json(), response.headers.get("X-Next-Cursor")
+                if "ETag" in response.headers:
+                    self._pages[key] = (response.headers["ETag"], page, cursor)
+            peers.extend(page)
+            if not cursor:
+                return peers
+            params["after"] = cursor
+
+    async def changes(self, since: int = None, wait: float = 0) -> dict:
+        """Peer changes after revision `since`, long-polling up to `wait` seconds
+
+        Raises ApiError 410 when `since` is too old; reload the peers then.
+        """
+        params = {"wait": wait}
+        if since is not None:
+            params["since"] = since
+        response = await self.http.get(
+            "/api/changes/",
+            params=params,
+            headers=self._headers(),
+            timeout=self.http.timeout.read + wait,
+        )
+        self._check(response)
+        return response.json()
@@ -1,8 +1,53 @@
 import sys
 
-from PySide6.QtCore import QSize, Qt
+from PySide6.QtCore import QObject, QRunnable, QSize, Qt, QThreadPool, QTimer, Signal
 from PySide6.QtWidgets import QApplication, QMainWindow, QPushButton, QLineEdit, QVBoxLayout, QWidget, QLabel, QHBoxLayout
-import requests 
+import requests
+
+from interfaces import monitor
+
+# Seconds between health checks; doubled after each failure, up to the max
+POLL_INTERVAL = 5
+MAX_POLL_INTERVAL = 60
+HEALTH_TIMEOUT = 3
+
+
+class WorkerSignals(QObject):
+    """Signals a Worker emits; delivered on the GUI thread"""
+    result = Signal(object)
+    error = Signal(str)
+
+
+class LinkSignals(QObject):
+    """Carries link events from the monitor's thread to the GUI thread"""
+    changed = Signal(str, object)
+
+
+class Worker(QRunnable):
+    """Runs fn(*args) on the thread pool and reports back through signals"""
+
+    def __init__(self, fn, *args):
+        super().__init__()
+        self.fn = fn
+        self.args = args
+        self.signals = WorkerSignals()
+
+    def run(self):
+        try:
+            result = self.fn(*self.args)
+        except Exception as e:
+            self.signals.error.emit(str(e))
+        else:
+            self.signals.result.emit(result)
+
+
+def check_health(address: str) -> bool:
+    """Whether the server answers its health check; runs off the GUI thread"""
+    try:
+        response = requests.get(f"{address}/api/health", timeout=HEALTH_TIMEOUT)
+    except requests.exceptions.RequestException:
+        return False
+    return response.status_code == 200
 
 
 # Subclass QMainWindow to customize your application's main window
@@ -15,9 +60,14 @@ class GUI(QMainWindow):
     }
 
     data = {}
-    
-    def __init__(self, address: str):
+
+    def __init__(self, address: str, on_connect_click=None, interface_name: str = None):
         super().__init__()
+        self.address = address
+        self.interface_name = interface_name
+        self.on_connect_click = on_connect_click
+        # Every network or interface call runs here, never on the GUI thread
+        self.pool = QThreadPool.globalInstance()
 
         self.setWindowTitle("Aspen VPN")
 
@@ -25,7 +75,7 @@ class GUI(QMainWindow):
 
         self.status_circle = QLabel()
         self.status_circle.setFixedSize(8, 8)
-        self.status_circle.setStyleSheet(f"background-color: {self.status['pending']}; border-radius: 4px;")
+        self.set_status("pending")
 
         server_status = QLabel("Server Status")
 
@@ -39,40 +89,107 @@ class GUI(QMainWindow):
 
         peername_input = QLineEdit()
         self.btn_connect = QPushButton("Connect to VPN")
+        self.connect_status = QLabel("")
+        self.tunnel_status = QLabel("")
 
         layout.addWidget(server_status)
         layout.addWidget(peername_label)
         layout.addWidget(peername_input)
         layout.addWidget(self.btn_connect)
+        layout.addWidget(self.connect_status)
+        layout.addWidget(self.tunnel_status)
 
         # Bind peername_input to data
         peername_input.textChanged.connect(lambda text: self.data.update({"peername": text}))
+        self.btn_connect.clicked.connect(lambda _: self.start_connect())
 
         central_widget = QWidget()
         central_widget.setLayout(layout)
 
         self.setCentralWidget(central_widget)
 
-    def get_server_status(self, address: str):
-        try:
-            # Ping server to get status
-            response = requests.get(address)
-            if (response.status_code != 200):
-                return self.status_circle.setStyleSheet(f"background-color: {self.status['offline']}; border-radius: 4px;")
-        except requests.exceptions.ConnectionError:
-            return self.status_circle.setStyleSheet(f"background-color: {self.status['offline']}; border-radius: 4px;")
-
-        return self.status_circle.setStyleSheet(f"background-color: {self.status['online']}; border-radius: 4px;")
+        # Health polling: one check in flight at most, backing off while down
+        self.poll_interval = POLL_INTERVAL
+        self.polling = False
+        self.poll_timer = QTimer(self)
+        self.poll_timer.setSingleShot(True)
+        self.poll_timer.timeout.connect(self.poll_server_status)
+
+        # Tunnel status follows link events, no polling needed
+        if interface_name:
+            self.link_signals = LinkSignals()
+            self.link_signals.changed.connect(self.link_changed)
+            monitor.subscribe(self.link_signals.changed.emit)
+            self.link_changed(interface_name, monitor.get(interface_name))
+
+    def set_status(self, status: str):
+        self.status_circle.setStyleSheet(f"background-color: {self.status[status]}; border-radius: 4px;")
+
+    def link_changed(self, name: str, link):
+        if name != self.interface_name:
+            return
+        if link is None:
+            self.tunnel_status.setText(f"Tunnel {name}: not created")
+        else:
+            self.tunnel_status.setText(f"Tunnel {name}: {'up' if link.up else 'down'}")
+
+    def run_in_background(self, fn, *args, on_result=None, on_error=None) -> Worker:
+        worker = Worker(fn, *args)
+        if on_result:
+            worker.signals.result.connect(on_result)
+        if on_error:
+            worker.signals.error.connect(on_error)
+        self.pool.start(worker)
+        return worker
+
+    def poll_server_status(self):
+        if self.polling:
+            return
+        self.polling = True
+        self.run_in_background(
+            check_health, self.address,
+            on_result=self.server_status_checked,
+            on_error=lambda _: self.server_status_checked(False),
+        )
+
+    def server_status_checked(self, online: bool):
+        self.polling = False
+        self.set_status("online" if online else "offline")
+        if online:
+            self.poll_interval = POLL_INTERVAL
+        else:
+            self.poll_interval = min(self.poll_interval * 2, MAX_POLL_INTERVAL)
+        self.poll_timer.start(self.poll_interval * 1000)
+
+    def start_connect(self):
+        if self.on_connect_click is None:
+            return
+        self.btn_connect.setEnabled(False)
+        self.connect_status.setText("Connecting...")
+        self.run_in_background(
+            self.on_connect_click, dict(self.data),
+            on_result=self.connect_finished,
+            on_error=self.connect_failed,
+        )
+
+    def connect_finished(self, state):
+        self.btn_connect.setEnabled(True)
+        self.connect_status.setText(f"Connected as {state.assigned_ip}")
+        # A working tunnel means the server is up; check again right away
+        self.poll_timer.stop()
+        self.poll_server_status()
+
+    def connect_failed(self, error: str):
+        self.btn_connect.setEnabled(True)
+        self.connect_status.setText(f"Connecting failed: {error}")
 
     @staticmethod
-    async def setup(address: str, on_connect_click, on_disconnect_click):
+    async def setup(address: str, on_connect_click, on_disconnect_click, interface_name: str = None):
         app = QApplication(sys.argv)
-        window = GUI(address)
-        window.get_server_status(address)
-        
-        window.btn_connect.clicked.connect((lambda _: on_connect_click(window.data)))
+        window = GUI(address, on_connect_click, interface_name)
+        window.poll_server_status()
 
         window.show()
 
         app.exec()
-        return app
\ No newline at end of file
+        return app
@@ -0,0 +1,172 @@
+"""
+Network interface state from sysfs, kept current by netlink link events
+"""
+
+import os
+import socket
+import struct
+import threading
+from dataclasses import dataclass
+from typing import Optional
+
+SYS_CLASS_NET = "/sys/class/net"
+
+IFF_UP = 0x1
+IFF_RUNNING = 0x40
+
+# From linux/rtnetlink.h and linux/if_link.h
+RTMGRP_LINK = 0x1
+RTM_NEWLINK = 16
+RTM_DELLINK = 17
+IFLA_IFNAME = 3
+
+NLMSG_HEADER = struct.Struct("=IHHII")  # length, type, flags, seq, pid
+IFINFOMSG = struct.Struct("=BxHiII")  # family, type, index, flags, change
+RTATTR = struct.Struct("=HH")  # length, type
+
+
+@dataclass(frozen=True)
+class LinkState:
+    """One interface as the kernel reports it"""
+    name: str
+    index: int
+    flags: int
+
+    @property
+    def up(self) -> bool:
+        return bool(self.flags & IFF_UP)
+
+
+def _align(length: int) -> int:
+    return (length + 3) & ~3
+
+
+def read_link(name: str, root: str = SYS_CLASS_NET) -> Optional[LinkState]:
+    """Read one interface from sysfs, or None if it does not exist
+
+    Exact directory lookups, so `wg1` never matches `wg10`.
+    """
+    path = os.path.join(root, name)
+    try:
+        with open(os.path.join(path, "ifindex")) as f:
+            index = int(f.read())
+        with open(os.path.join(path, "flags")) as f:
+            flags = int(f.read(), 16)
+    except (OSError, ValueError):
+        return None
+    return LinkState(name, index, flags)
+
+
+def parse_link_messages(data: bytes) -> list:
+    """(name, LinkState or None if removed) for each link message in `data`"""
+    changes = []
+    offset = 0
+    while offset + NLMSG_HEADER.size <= len(data):
+        length, kind, _, _, _ = NLMSG_HEADER.unpack_from(data, offset)
+        if length < NLMSG_HEADER.size:
+            break
+        body = offset + NLMSG_HEADER.size
+        if kind in (RTM_NEWLINK, RTM_DELLINK) and body + IFINFOMSG.size <= offset + length:
+            _, _, index, flags, _ = IFINFOMSG.unpack_from(data, body)
+            name = None
+            attr = body + IFINFOMSG.size
+            while attr + RTATTR.size <= offset + length:
+                attr_length, attr_type = RTATTR.unpack_from(data, attr)
+                if attr_length < RTATTR.size:
+                    break
+                if attr_type == IFLA_IFNAME:
+                    value = data[attr + RTATTR.size:attr + attr_length]
+                    name = value.split(b"\0", 1)[0].decode()
+                attr += _align(attr_length)
+            if name is not None:
+                state = LinkState(name, index, flags) if kind == RTM_NEWLINK else None
+                changes.append((name, state))
+        offset += _align(length)
+    return changes
+
+
+class InterfaceMonitor:
+    """Cached interface states, updated from netlink instead of re-probing
+
+    Until `start` subscribes to link events (or where netlink is not
+    available) every lookup reads sysfs, which is still only a few file reads.
+    """
+
+    def __init__(self, root: str = SYS_CLASS_NET):
+        self.root = root
+        self._links = {}
+        self._listeners = []
+        self._lock = threading.Lock()
+        self._socket = None
+
+    @property
+    def watching(self) -> bool:
+        return self._socket is not None
+
+    def get(self, name: str) -> Optional[LinkState]:
+        if not self.watching:
+            return read_link(name, self.root)
+        with self._lock:
+            if name not in self._links:
+                self._links[name] = read_link(name, self.root)
+            return self._links[name]
+
+    def exists(self, name: str) -> bool:
+        return self.get(name) is not None
+
+    def is_up(self, name: str) -> bool:
+        state = self.get(name)
+        return state is not None and state.up
+
+    def subscribe(self, callback):
+        """Call `callback(name, state)` on every link change, from the watcher thread"""
+        self._listeners.append(callback)
+
+    def start(self) -> bool:
+        """Watch link events on a background thread; False if netlink is unavailable"""
+        if self.watching:
+            return True
+        try:
+            sock = socket.socket(socket.AF_NETLINK, socket.SOCK_RAW, socket.NETLINK_ROUTE)
+            sock.bind((0, RTMGRP_LINK))
+        except (AttributeError, OSError) as e:
+            print(f"[client]: Link events unavailable, reading sysfs on each check: {e}")
+            return False
+        with self._lock:
+            # Anything cached before now may be stale
+            self._links.clear()
+            self._socket = sock
+        threading.Thread(target=self._watch, args=(sock,), daemon=True).start()
+        return True
+
+    def stop(self):
+        sock, self._socket = self._socket, None
+        if sock is not None:
+            sock.close()
+
+    def handle(self, data: bytes):
+        """Apply a batch of netlink messages to the cache and notify listeners"""
+        changes = parse_link_messages(data)
+        with self._lock:
+            for name, state in changes:
+                self._links[name] = state
+        for name, state in changes:
+            for callback in self._listeners:
+                callback(name, state)
+
+    def _watch(self, sock):
+        while True:
+            try:
+                data = sock.recv(65536)
+            except OSError:
+                # Closed by stop, or the receive buffer overflowed
+                break
+            self.handle(data)
+        if self._socket is sock:
+            # Lost events; fall back to reading sysfs rather than serve stale state
+            with self._lock:
+                self._socket = None
+                self._links.clear()
+
+
+monitor = InterfaceMonitor()
@@ -3,101 +3,128 @@ Command line tool to connect to Aspen VPN server
 """
 
 import argparse
-import requests
 import asyncio
+import threading
+from dataclasses import replace
+
+import httpx
 from python_wireguard import Client, Key, ServerConnection
 from gui import GUI
-import subprocess
-import pickle
-
-def get_peers(server_url: str):
-    """Get list of registered peers"""
-    response = requests.get(f"{server_url}/api/peers")
-    if response.status_code != 200:
-        raise Exception(f"Failed to get peers: {response.json()}")
-    return response.json()
-
-def register_peer(server_url: str, name: str, public_key: str):
-    """Register a new peer with the server"""
-    
-    # Generate our keys
-    private, public = Key.key_pair()
+from interfaces import monitor
+from api import ApiError, AspenApi
+from tasks import BackgroundTasks
+from state import ClientState, clear_state, load_state, save_state
 
-    # Register with server
-    peer_info = {
-        "name": "test-client",
-        "public_key": str(public),
-        "assigned_ip": "10.0.0.2/24",  # Hardcoded for now
-    }
-    print(f"[client]: peer_info: {peer_info}")
+interface_name = "wg1"
+# Hardcoded for now
+ASSIGNED_IP = "10.0.0.2/24"
 
-    response = requests.post(f"{server_url}/api/peers/register", json=peer_info)
 
-    if response.status_code != 200:
-        raise Exception(f"Failed to register: {response.json()}")
-    
-    print("Registered with server!", response.json())
-    return {"private": private, "public": public, "assigned_ip": peer_info["assigned_ip"], "server_public_key": public_key}
+async def register_peer(api: AspenApi, server_url: str, name: str, invite_code=None):
+    """Register a new peer with the server, returning its state and the peers"""
+    # Generate our keys
+    private, public = Key.key_pair()
+    registered = await api.register(name, str(public), ASSIGNED_IP, invite_code)
+    print("Registered with server!", registered)
+    api.api_key = registered["api_key"]
 
-interface_name = "wg1"
-def connect_to_vpn(server_url: str):
-    """Connect to VPN server"""
-    # Get server info
-    server_info = requests.get(f"{server_url}/api/server-info").json()
+    # Both only need the API key; fetch them together
+    (server_info, etag), peers = await asyncio.gather(api.server_info(), api.peers())
     print(f"[client]: server_info: {server_info}")
-    
-    interface_name = "wg1"
-    content = {}
-    private = None
-    public = None
-    interface_exists = has_interface(interface_name)
-    if not interface_exists:
-        content = register_peer(server_url, "test-client", server_info["public_key"])
-        with open("client_info.json", "wb") as f:
-            f.write(pickle.dumps({key: str(value) for key, value in content.items()}))
-    else:
-        # Read from stringified JSON
-        with open("client_info.json", "rb") as f:
-            content = pickle.loads(f.read())
-        print(content)
-        
-    private = content["private"]
-    public = content["public"]
-
-    # If not instance of python_wireguard.Key, convert
-    if not isinstance(private, Key):
-        private = Key(private)
-    if not isinstance(public, Key):
-        public = Key(public)
-    
-    # Create WireGuard client interface
-    client = Client(interface_name=interface_name, key=private, local_ip="10.0.0.2/24")
-
-    # Create server connection
-    server_conn = ServerConnection(
-        Key(server_info["public_key"]), server_info["endpoint"], server_info["port"]
+    state = ClientState(
+        server_url=server_url,
+        name=name,
+        private_key=str(private),
+        public_key=str(public),
+        assigned_ip=ASSIGNED_IP,
+        api_key=registered["api_key"],
+        server_public_key=server_info["public_key"],
+        endpoint=server_info["endpoint"],
+        port=server_info["port"],
+        server_info_etag=etag,
     )
+    return state, peers
 
-    client.set_server(server_conn)
-    if not interface_exists:
-        client.connect()
-        
-        
-    print("Your public key:", str(public))
-    # Bring up the WireGuard interface
-    # subprocess.run(["sudo", "ip", "link", "set", interface_name, "up"], check=True)
 
-    # Add a default route through the VPN
-    # subprocess.run(["sudo", "ip", "route", "add", "default", "dev", interface_name], check=True)
+def bring_up(state: ClientState, recreate: bool = False):
+    """Point the WireGuard interface at the server, creating it if needed"""
+    client = Client(
+        interface_name=interface_name, key=Key(state.private_key), local_ip=state.assigned_ip
+    )
+    client.set_server(
+        ServerConnection(Key(state.server_public_key), state.endpoint, state.port)
+    )
+    if has_interface(interface_name):
+        if not recreate:
+            return
+        client.delete_interface()
+    client.connect()
+
 
-    print("Connected to Aspen VPN!")
-    print("Server public key:", server_info["public_key"])
+async def connect_to_vpn(server_url: str, name: str = "test-client", invite_code=None):
+    """Connect to VPN server
 
-    # Collect and print the server's peers
-    display_peers(server_url)
+    With a cached state for this server, the tunnel comes up from the cache
+    without any API call, and the cache is revalidated in the background.
+    """
+    state = load_state(server_url)
+    api = get_api(server_url)
+    if state is None:
+        state, peers = await register_peer(api, server_url, name, invite_code)
+        save_state(state)
+        bring_up(state)
+        print("Connected to Aspen VPN!")
+        show_peers(peers)
+    else:
+        bring_up(state)
+        print("Reconnected to Aspen VPN from the cached state")
+        background.spawn(revalidate(api, state), name="revalidate")
 
-def display_peers(server_url: str):
-    peers = get_peers(server_url)
+    print("Your public key:", state.public_key)
+    print("Server public key:", state.server_public_key)
+    # Add a default route through the VPN
+    # subprocess.run(["sudo", "ip", "route", "add", "default", "dev", interface_name], check=True)
+    return state
+
+
+async def revalidate(api: AspenApi, state: ClientState):
+    """Check the cached server details, updating the tunnel if they changed"""
+    api.api_key = state.api_key
+    try:
+        (server_info, etag), peers = await asyncio.gather(
+            api.server_info(state.server_info_etag), api.peers()
+        )
+    except ApiError as e:
+        if e.status_code == 403:
+            # Deleted or disabled; the next connect registers again
+            print("[client]: API key no longer valid, dropping the cached state")
+            clear_state()
+            api.api_key = None
+        else:
+            print(f"[client]: Could not revalidate the cached state: {e}")
+        return
+    except httpx.HTTPError as e:
+        print(f"[client]: Server unreachable, keeping the cached state: {e}")
+        return
+
+    if server_info is not None:
+        updated = replace(
+            state,
+            server_public_key=server_info["public_key"],
+            endpoint=server_info["endpoint"],
+            port=server_info["port"],
+            server_info_etag=etag,
+        )
+        save_state(updated)
+        if (updated.server_public_key, updated.endpoint, updated.port) != (
+            state.server_public_key, state.endpoint, state.port
+        ):
+            print("[client]: Server details changed, reconnecting")
+            bring_up(updated, recreate=True)
+    show_peers(peers)
+
+
+def show_peers(peers: list):
     print("Peers:")
     for peer in peers:
         print("-", peer["name"], peer["assigned_ip"])
@@ -105,47 +132,66 @@ def display_peers(server_url: str):
 
 args = None
 
+# Network calls run on their own event loop thread, so the GUI never waits on
+# them and background revalidation keeps going while it runs
+network_loop = asyncio.new_event_loop()
+threading.Thread(target=network_loop.run_forever, daemon=True).start()
+background = BackgroundTasks()
+# One API session per server, kept so its peer page ETags are reused
+apis = {}
+
+
+def get_api(server_url: str) -> AspenApi:
+    """The API session of a server; only call on the network loop"""
+    if server_url not in apis:
+        apis[server_url] = AspenApi(server_url)
+    return apis[server_url]
+
+
+async def shutdown():
+    """Stop background work and close the API sessions"""
+    await background.shutdown()
+    for api in apis.values():
+        await api.close()
+    apis.clear()
+
+
 def begin_connect(data):
+    """Connect with the GUI's form data; called on a GUI worker thread"""
     global args
     print("Connecting to VPN...")
     print(data)
-    connect_to_vpn(args.server) 
-    pass
+    name = data.get("peername") or "test-client"
+    future = asyncio.run_coroutine_threadsafe(connect_to_vpn(args.server, name, args.invite), network_loop)
+    return future.result()
+
 
 def begin_disconnect():
     print("Disconnecting from VPN...")
     pass
 
 def has_interface(interface_name):
-    interfaces = subprocess.run(["ip", "link", "show"], capture_output=True, text=True).stdout
-    return interface_name in interfaces
+    return monitor.exists(interface_name)
 
 async def execute(args):
     """
     Initialize a GUI and connect to the VPN server.
     Determine if we have an existing interface or need to create a new one.
     """
-    app = await GUI.setup(args.server, begin_connect, begin_disconnect)
+    # Link events keep interface checks cached and the GUI's tunnel status live
+    monitor.start()
+    app = await GUI.setup(args.server, begin_connect, begin_disconnect, interface_name)
 
+    asyncio.run_coroutine_threadsafe(shutdown(), network_loop).result(timeout=5)
     exit(1)
     # Check if we have an existing interface
-    interfaces = subprocess.run(["ip", "link", "show"], capture_output=True, text=True).stdout
+    link = monitor.get(interface_name)
 
-    if interface_name in interfaces:
+    if link is not None:
         print(f"Interface {interface_name} already exists")
         # Check if the interface is up
-        if "UP" in interfaces:
+        if link.up:
             print(f"Interface {interface_name} is up")
-            # Check if the interface has an IP address
-            if "inet" in interfaces:
-                print(f"Interface {interface_name} has an IP address")
-                # Check if the interface has a default route
-                if "default" in interfaces:
-                    print(f"Interface {interface_name} has a default route")
-                else:
-                    print(f"Interface {interface_name} does not have a default route")
-            else:
-                print(f"Interface {interface_name} does not have an IP address")
         else:
             print(f"Interface {interface_name} is not up")
     else:
@@ -155,6 +201,7 @@ if __name__ == "__main__":
     
     parser = argparse.ArgumentParser(description="Aspen VPN Client")
     parser.add_argument("--server", default="http://localhost:8000", help="Server URL")
+    parser.add_argument("--invite", help="Invite code, for servers requiring one to register")
     args = parser.parse_args()
 
     asyncio.run(execute(args))
\ No newline at end of file
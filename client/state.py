@@ -0,0 +1,63 @@
+"""
+Versioned cache of everything the client needs to reconnect without the server
+"""
+
+import json
+import os
+from dataclasses import asdict, dataclass
+from typing import Optional
+
+# Bumped whenever fields change meaning; older caches are ignored
+STATE_VERSION = 1
+STATE_FILE = "client_state.json"
+
+
+@dataclass
+class ClientState:
+    """Keys, address and server details of a registered client"""
+    server_url: str
+    name: str
+    private_key: str
+    public_key: str
+    assigned_ip: str
+    api_key: str
+    server_public_key: str
+    endpoint: str
+    port: int
+    # ETag of the server info above, to revalidate it cheaply
+    server_info_etag: Optional[str] = None
+    version: int = STATE_VERSION
+
+
+def load_state(server_url: str, path: str = STATE_FILE) -> Optional[ClientState]:
+    """Cached state for `server_url`, or None if there is none usable"""
+    try:
+        with open(path) as f:
+            data = json.load(f)
+    except (OSError, ValueError):
+        return None
+    if not isinstance(data, dict):
+        return None
+    if data.get("version") != STATE_VERSION or data.get("server_url") != server_url:
+        return None
+    try:
+        return ClientState(**data)
+    except TypeError:
+        return None
+
+
+def save_state(state: ClientState, path: str = STATE_FILE):
+    """Write the state atomically, readable by its owner only (it holds keys)"""
+    temporary = f"{path}.tmp"
+    fd = os.open(temporary, os.O_WRONLY | os.O_CREAT | os.O_TRUNC, 0o600)
+    with os.fdopen(fd, "w") as f:
+        json.dump(asdict(state), f, indent=2)
+    os.replace(temporary, path)
+
+
+def clear_state(path: str = STATE_FILE):
+    """Forget the cached state, so the next connect registers again"""
+    try:
+        os.remove(path)
+    except FileNotFoundError:
+        pass
@@ -0,0 +1,34 @@
+"""
+Background tasks of the client's network loop
+"""
+
+import asyncio
+
+
+class BackgroundTasks:
+    """Tasks started without anyone awaiting them
+
+    The event loop only keeps weak references to tasks, so they are held
+    here until done. Failures are printed instead of lost, and shutdown()
+    cancels whatever is still running.
+    """
+
+    def __init__(self):
+        self.tasks = set()
+
+    def spawn(self, coro, name=None):
+        task = asyncio.get_running_loop().create_task(coro, name=name)
+        self.tasks.add(task)
+        task.add_done_callback(self._done)
+        return task
+
+    def _done(self, task):
+        self.tasks.discard(task)
+        if not task.cancelled() and task.exception() is not None:
+            print(f"[client]: Background task {task.get_name()} failed: {task.exception()!r}")
+
+    async def shutdown(self):
+        tasks = list(self.tasks)
+        for task in tasks:
+            task.cancel()
+        await asyncio.gather(*tasks, return_exceptions=True)
@@ -0,0 +1,310 @@
+"""
+Data-plane agent owning the WireGuard interfaces
+
+The agent is the only process that needs root. It serves newline-delimited
+JSON calls on a Unix socket, so any number of unprivileged API workers can
+push peer changes to it:
+
+    {"id": 1, "method": "apply", "params": {"interface": "wg0", "add": {...}, "update": {...}, "remove": [...]}}
+    {"id": 1, "result": {"ops": 3}}
+
+Methods are `ping`, `info`, `open_interface`, `list_peers`, `apply` and
+`dump` (transfer counters of every peer, for the stats collector). A
+whole batch of peer changes travels in one `apply` call and is applied in
+one go.
+"""
+
+import argparse
+import asyncio
+import json
+import os
+import socket
+import threading
+from dataclasses import asdict
+from typing import Any, Callable, Optional
+
+from . import config
+from .services.stats import PeerCounters, WgDumpSource
+from .wireguard import (
+    InMemoryBackend,
+    KernelBackend,
+    PeerChanges,
+    WireGuardBackend,
+    load_or_create_key_pair,
+    open_server,
+)
+
+# Group members (the API's user) may connect, others may not
+SOCKET_MODE = 0o660
+
+
+class AgentError(RuntimeError):
+    """The agent could not carry out a call"""
+
+
+class AgentServer:
+    """Serves data-plane calls for a set of WireGuard interfaces on a Unix socket
+
+    `open_interface(name, address, port)` brings an interface up and returns
+    its backend; it is called once per interface, on the first
+    `open_interface` call naming it. `read_counters` answers `dump`.
+    """
+
+    def __init__(
+        self,
+        open_interface: Callable[[str, str, int], WireGuardBackend],
+        socket_path: str,
+        info: Optional[dict] = None,
+        read_counters: Callable[[], dict[str, PeerCounters]] = dict,
+    ):
+        self.open_interface = open_interface
+        self.read_counters = read_counters
+        self.backends: dict[str, WireGuardBackend] = {}
+        self.socket_path = socket_path
+        self.info = info or {}
+        self.batches = 0
+        self.ops = 0
+        self._server: Optional[asyncio.AbstractServer] = None
+        self._apply_lock: Optional[asyncio.Lock] = None
+
+    async def start(self) -> None:
+        """Listen on the socket, replacing a stale one left by a previous run"""
+        if os.path.exists(self.socket_path):
+            os.unlink(self.socket_path)
+        self._apply_lock = asyncio.Lock()
+        self._server = await asyncio.start_unix_server(
+            self._handle, path=self.socket_path
+        )
+        os.chmod(self.socket_path, SOCKET_MODE)
+
+    async def close(self) -> None:
+        """Stop accepting calls and remove the socket"""
+        if self._server is not None:
+            self._server.close()
+            await self._server.wait_closed()
+            self._server = None
+        if os.path.exists(self.socket_path):
+            os.unlink(self.socket_path)
+
+    async def _handle(
+        self, reader: asyncio.StreamReader, writer: asyncio.StreamWriter
+    ) -> None:
+        try:
+            while line := await reader.readline():
+                response = await self._dispatch(line)
+                writer.write(json.dumps(response).encode() + b"\n")
+                await writer.drain()
+        except ConnectionError:
+            pass
+        finally:
+            writer.close()
+
+    async def _dispatch(self, line: bytes) -> dict:
+        request_id = None
+        try:
+            request = json.loads(line)
+            request_id = request.get("id")
+            result = await self._call(request["method"], request.get("params") or {})
+        except Exception as e:  # sent back to the caller
+            return {"id": request_id, "error": f"{type(e).__name__}: {e}"}
+        return {"id": request_id, "result": result}
+
+    async def _call(self, method: str, params: dict) -> Any:
+        if method == "ping":
+            return "pong"
+        if method == "info":
+            return {
+                **self.info,
+                "interfaces": sorted(self.backends),
+                "batches": self.batches,
+                "ops": self.ops,
+            }
+        if method == "open_interface":
+            async with self._apply_lock:
+                if params["interface"] not in self.backends:
+                    self.backends[params["interface"]] = await asyncio.to_thread(
+                        self.open_interface,
+                        params["interface"],
+                        params["address"],
+                        params["port"],
+                    )
+            return {"interface": params["interface"]}
+        if method == "list_peers":
+            backend = self._backend(params)
+            return await asyncio.to_thread(backend.list_peers)
+        if method == "apply":
+            backend = self._backend(params)
+            changes = PeerChanges(**params)
+            # Batches from different workers never interleave on an interface
+            async with self._apply_lock:
+                await asyncio.to_thread(backend.apply, changes)
+            self.batches += 1
+            self.ops += changes.op_count
+            return {"ops": changes.op_count}
+        if method == "dump":
+            return await asyncio.to_thread(self.read_counters)
+        raise ValueError(f"Unknown method {method!r}")
+
+    def _backend(self, params: dict) -> WireGuardBackend:
+        interface = params.pop("interface", None)
+        if interface not in self.backends:
+            raise LookupError(f"Interface {interface!r} is not open")
+        return self.backends[interface]
+
+
+class AgentBackend:
+    """WireGuard backend forwarding to one of the data-plane agent's interfaces
+
+    Keeps one connection open and reconnects once if it dropped. Calls are
+    idempotent (peers are added, updated and removed by public key), so a
+    call cut off mid-way is safe to resend.
+    """
+
+    def __init__(
+        self,
+        socket_path: str,
+        interface: str = "wg0",
+        timeout: float = config.WG_AGENT_TIMEOUT,
+    ):
+        self.socket_path = socket_path
+        self.interface = interface
+        self.timeout = timeout
+        self._lock = threading.Lock()
+        self._socket: Optional[socket.socket] = None
+        self._reader = None
+        self._next_id = 0
+
+    def open(self, address: str, port: int) -> None:
+        """Have the agent bring the interface up, if it is not already"""
+        self.call(
+            "open_interface",
+            {"interface": self.interface, "address": address, "port": port},
+        )
+
+    def list_peers(self) -> dict[str, str]:
+        return self.call("list_peers", {"interface": self.interface})
+
+    def apply(self, changes: PeerChanges) -> None:
+        self.call("apply", {"interface": self.interface, **asdict(changes)})
+
+    def info(self) -> dict:
+        """Interface details published by the agent, e.g. its public key"""
+        return self.call("info")
+
+    def call(self, method: str, params: Optional[dict] = None) -> Any:
+        """Send one call and wait for its answer"""
+        with self._lock:
+            self._next_id += 1
+            request = {"id": self._next_id, "method": method, "params": params or {}}
+            payload = json.dumps(request).encode() + b"\n"
+            for attempt in range(2):
+                try:
+                    response = self._send(payload)
+                    break
+                except OSError:
+                    self.close()
+                    if attempt:
+                        raise
+
+        if "error" in response:
+            raise AgentError(response["error"])
+        return response["result"]
+
+    def close(self) -> None:
+        """Drop the connection; the next call opens a new one"""
+        if self._socket is not None:
+            self._reader.close()
+            self._socket.close()
+            self._socket = None
+
+    def _send(self, payload: bytes) -> dict:
+        if self._socket is None:
+            sock = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+            sock.settimeout(self.timeout)
+            sock.connect(self.socket_path)
+            self._socket, self._reader = sock, sock.makefile("rb")
+        self._socket.sendall(payload)
+        line = self._reader.readline()
+        if not line:
+            raise ConnectionResetError("Agent closed the connection")
+        return json.loads(line)
+
+
+class AgentCounterSource:
+    """Stats counter source reading through the agent, which may run `wg`"""
+
+    def __init__(self, socket_path: str):
+        self.backend = AgentBackend(socket_path)
+
+    def read(self) -> dict[str, PeerCounters]:
+        return {
+            public_key: PeerCounters(*counters)
+            for public_key, counters in self.backend.call("dump").items()
+        }
+
+
+async def run_agent(args: argparse.Namespace) -> None:
+    """Serve calls until cancelled, then take down the interfaces it opened"""
+    # Every interface shares the key pair; they differ in port and subnet
+    private, public = load_or_create_key_pair(args.key_file)
+    servers = []
+
+    def open_interface(name: str, address: str, port: int) -> WireGuardBackend:
+        if args.in_memory:
+            # Stand-in for development and tests, no root needed
+            return InMemoryBackend()
+        server, adopted = open_server(name, private, public, address, port)
+        servers.append(server)
+        state = "adopted" if adopted else "enabled"
+        print(f"[agent]: WireGuard interface {name} {state} on port {port}")
+        return KernelBackend(server)
+
+    agent = AgentServer(
+        open_interface,
+        args.socket,
+        {"public_key": str(public)},
+        dict if args.in_memory else WgDumpSource().read,
+    )
+    await agent.start()
+    print(f"[agent]: Listening on {args.socket}")
+    try:
+        await asyncio.Event().wait()
+    finally:
+        await agent.close()
+        if args.keep_interfaces:
+            print("[agent]: Leaving WireGuard interfaces up")
+            servers = []
+        for server in servers:
+            print(f"[agent]: Cleaning up {server.interface_name}")
+            server.delete_interface()
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Aspen VPN data-plane agent")
+    parser.add_argument(
+        "--socket",
+        default=config.WG_AGENT_SOCKET or "/run/aspen/wg-agent.sock",
+        help="Unix socket to listen on",
+    )
+    parser.add_argument(
+        "--key-file",
+        default=config.WG_KEY_FILE,
+        help="Server key pair, created on first start",
+    )
+    parser.add_argument(
+        "--keep-interfaces",
+        action="store_true",
+        default=config.WG_KEEP_INTERFACES,
+        help="Leave WireGuard interfaces up on shutdown, for a warm restart",
+    )
+    parser.add_argument(
+        "--in-memory",
+        action="store_true",
+        help="Keep peers in memory instead of creating interfaces",
+    )
+    args = parser.parse_args()
+
+    try:
+        asyncio.run(run_agent(args))
+    except KeyboardInterrupt:
+        pass
@@ -1,11 +1,16 @@
 """CRUD operations for invites"""
 
 from datetime import datetime
+from typing import Optional
+from sqlalchemy import and_, case, delete, insert, not_, or_, select, update
+from sqlalchemy.ext.asyncio import AsyncSession
 from sqlalchemy.orm import Session
 from fastapi import HTTPException
 
 from ..database.models import Invite
 from ..schemas.invite import InviteCreate, InviteUpdate
+from ..services.revision import mark_changed
+from ..services.tracing import traced
 
 def get_invite(db: Session, invite_id: int) -> Invite:
     """Get invite by ID"""
@@ -28,6 +33,7 @@ def create_invite(db: Session, invite: InviteCreate) -> Invite:
         code=Invite.generate_code(),
         expires_at=invite.expires_at,
         description=invite.description,
+        uses_left=invite.uses_left,
         used_by=invite.used_by,
     )
     db.add(db_invite)
@@ -45,4 +51,138 @@ def update_invite(db: Session, invite_id: int, invite_update: InviteUpdate) -> I
 
     db.commit()
     db.refresh(db_invite)
-    return db_invite
\ No newline at end of file
+    return db_invite
+
+def _redeemable(now: datetime):
+    """Condition of invites with a use left that have not expired"""
+    return and_(
+        Invite.uses_left > 0,
+        or_(Invite.expires_at.is_(None), Invite.expires_at > now),
+    )
+
+@traced("crud.get_invite")
+async def get_invite_async(db: AsyncSession, invite_id: int) -> Invite:
+    """Get invite by ID"""
+    invite = await db.get(Invite, invite_id)
+    if not invite:
+        raise HTTPException(status_code=404, detail="Invite not found")
+    return invite
+
+@traced("crud.get_invites")
+async def get_invites_async(
+    db: AsyncSession,
+    after: Optional[int] = None,
+    limit: int = 100,
+    active: Optional[bool] = None,
+) -> list[Invite]:
+    """Get a page of invites in id order, optionally only (in)active ones"""
+    statement = select(Invite).order_by(Invite.id).limit(limit)
+    if after is not None:
+        statement = statement.where(Invite.id > after)
+    if active is not None:
+        redeemable = _redeemable(datetime.utcnow())
+        statement = statement.where(redeemable if active else not_(redeemable))
+    return list(await db.scalars(statement))
+
+@traced("crud.mint_invites")
+async def mint_invites_async(
+    db: AsyncSession,
+    count: int,
+    uses: int = 1,
+    expires_at: Optional[datetime] = None,
+    description: Optional[str] = None,
+) -> list[str]:
+    """Create `count` invite codes in one transaction, returning the codes
+
+    Rows go out as multi-row inserts rather than one ORM object each, so
+    minting thousands of codes holds the write lock for a moment only.
+    """
+    now = datetime.utcnow()
+    codes = [Invite.generate_code() for _ in range(count)]
+    await db.execute(
+        insert(Invite),
+        [
+            {
+                "code": code,
+                "expires_at": expires_at,
+                "uses_left": uses,
+                "description": description,
+                "created_at": now,
+                "last_modified": now,
+            }
+            for code in codes
+        ],
+    )
+    mark_changed(db.sync_session)
+    await db.commit()
+    return codes
+
+@traced("crud.redeem_invite")
+async def redeem_invite_async(db: AsyncSession, code: str, peer_id: int) -> bool:
+    """Take one use of an invite for `peer_id` in the current transaction
+
+    A single conditional UPDATE on the unique code, with no read first:
+    concurrent registrations cannot both take the last use. Returns
+    False if the code is unknown, expired or used up.
+    """
+    now = datetime.utcnow()
+    result = await db.execute(
+        update(Invite)
+        .where(Invite.code == code, _redeemable(now))
+        .values(uses_left=Invite.uses_left - 1, used_by=peer_id, last_modified=now)
+        .execution_options(synchronize_session=False)
+    )
+    if result.rowcount != 1:
+        return False
+    mark_changed(db.sync_session)
+    return True
+
+async def refund_invite_async(db: AsyncSession, code: str, peer_id: int) -> None:
+    """Give back the use taken for `peer_id`, in the current transaction"""
+    await db.execute(
+        update(Invite)
+        .where(Invite.code == code)
+        .values(
+            uses_left=Invite.uses_left + 1,
+            used_by=case((Invite.used_by == peer_id, None), else_=Invite.used_by),
+            last_modified=datetime.utcnow(),
+        )
+        .execution_options(synchronize_session=False)
+    )
+    mark_changed(db.sync_session)
+
+async def release_invites_async(db: AsyncSession, peer_ids: list[int]) -> None:
+    """Forget deleted peers as the last users of their invites, in the current transaction"""
+    await db.execute(
+        update(Invite)
+        .where(Invite.used_by.in_(peer_ids))
+        .values(used_by=None, last_modified=datetime.utcnow())
+        .execution_options(synchronize_session=False)
+    )
+    mark_changed(db.sync_session)
+
+@traced("crud.delete_invite")
+async def delete_invite_async(db: AsyncSession, invite_id: int) -> Invite:
+    """Revoke an invite"""
+    invite = await get_invite_async(db, invite_id)
+    await db.delete(invite)
+    await db.commit()
+    return invite
+
+def delete_expired_invites(db: Session, now: datetime, batch_size: int) -> int:
+    """Delete up to `batch_size` expired invites and commit, returning how many"""
+    expired = (
+        select(Invite.id)
+        .where(Invite.expires_at < now)
+        .order_by(Invite.expires_at)
+        .limit(batch_size)
+    )
+    result = db.execute(
+        delete(Invite)
+        .where(Invite.id.in_(expired))
+        .execution_options(synchronize_session=False)
+    )
+    if result.rowcount:
+        mark_changed(db)
+    db.commit()
+    return result.rowcount
\ No newline at end of file
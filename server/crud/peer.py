@@ -1,11 +1,17 @@
 """CRUD operations for peers"""
 
-from datetime import datetime
+import ipaddress
+from typing import AsyncIterator, Optional, Union
+from sqlalchemy import Row, Select, select
+from sqlalchemy.ext.asyncio import AsyncSession
 from sqlalchemy.orm import Session
 from fastapi import HTTPException
 
-from ..database.models import Peer
+from ..database.models import IPAllocation, Peer, ip_sort_key
+from .invite import redeem_invite_async, release_invites_async
 from ..schemas.peer import PeerCreate, PeerUpdate
+from ..services.auth_cache import auth_cache
+from ..services.tracing import traced
 
 
 def get_peer(db: Session, peer_id: int) -> Peer:
@@ -21,23 +27,76 @@ def get_peer_by_name(db: Session, name: str) -> Peer:
     return db.query(Peer).filter(Peer.name == name).first()
 
 
-def get_peers(db: Session, skip: int = 0, limit: int = 100) -> list[Peer]:
-    """Get all peers"""
-    return db.query(Peer).offset(skip).limit(limit).all()
+def get_peer_by_api_key_hash(db: Session, api_key_hash: str) -> Peer:
+    """Get enabled peer by the hash of its API key"""
+    return (
+        db.query(Peer)
+        .filter(Peer.api_key_hash == api_key_hash, Peer.is_enabled)
+        .first()
+    )
+
+
+def _prefix_upper_bound(prefix: str) -> str:
+    """Smallest string greater than every string starting with `prefix`"""
+    return prefix[:-1] + chr(ord(prefix[-1]) + 1)
+
+
+def filter_peers(
+    statement: Select,
+    after_id: Optional[int] = None,
+    enabled: Optional[bool] = None,
+    name_prefix: Optional[str] = None,
+    network: Optional[Union[ipaddress.IPv4Network, ipaddress.IPv6Network]] = None,
+) -> Select:
+    """Apply a keyset position and filters to a select over peers, ordered by id
+
+    Every filter is an index range scan: a name prefix becomes a range on the
+    unique name index and an IP range a range on IPAllocation.ip_key.
+    """
+    if after_id is not None:
+        statement = statement.where(Peer.id > after_id)
+    if enabled is not None:
+        statement = statement.where(Peer.is_enabled == enabled)
+    if name_prefix:
+        statement = statement.where(
+            Peer.name >= name_prefix, Peer.name < _prefix_upper_bound(name_prefix)
+        )
+    if network is not None:
+        statement = statement.join(IPAllocation, IPAllocation.peer_id == Peer.id).where(
+            IPAllocation.ip_key.between(
+                ip_sort_key(str(network.network_address)),
+                ip_sort_key(str(network.broadcast_address)),
+            )
+        )
+    return statement.order_by(Peer.id)
+
+
+def get_peers(
+    db: Session, after_id: Optional[int] = None, limit: int = 100, **filters
+) -> list[Peer]:
+    """Get a page of peers with id greater than `after_id`"""
+    return list(
+        db.scalars(filter_peers(select(Peer), after_id, **filters).limit(limit))
+    )
 
 
 def create_peer(db: Session, peer: PeerCreate) -> Peer:
-    """Create new peer"""
+    """Create new peer
+
+    The plaintext API key is only kept on the returned object, as `api_key`.
+    """
+    api_key = Peer.generate_api_key()
     db_peer = Peer(
         name=peer.name,
         public_key=peer.public_key,
         assigned_ip=peer.assigned_ip,
-        api_key=Peer.generate_api_key(),
+        api_key_hash=Peer.hash_api_key(api_key),
         description=peer.description,
     )
     db.add(db_peer)
     db.commit()
     db.refresh(db_peer)
+    db_peer.api_key = api_key
     return db_peer
 
 
@@ -50,6 +109,7 @@ def update_peer(db: Session, peer_id: int, peer_update: PeerUpdate) -> Peer:
         setattr(db_peer, field, value)
 
     db.commit()
+    auth_cache.invalidate_peer(peer_id)
     db.refresh(db_peer)
     return db_peer
 
@@ -58,8 +118,209 @@ def toggle_peer_status(db: Session, peer_id: int, enable: bool) -> Peer:
     """Enable or disable a peer"""
     peer = get_peer(db, peer_id)
     peer.is_enabled = enable
-    if enable:
-        peer.last_seen = datetime.now(datetime.timezone.utc)
     db.commit()
+    auth_cache.invalidate_peer(peer_id)
     db.refresh(peer)
     return peer
+
+
+def delete_peer(db: Session, peer_id: int) -> None:
+    """Delete a peer"""
+    peer = get_peer(db, peer_id)
+    db.delete(peer)
+    db.commit()
+    auth_cache.invalidate_peer(peer_id)
+
+
+# Async versions used by the API routes
+
+
+@traced("crud.get_peer")
+async def get_peer_async(db: AsyncSession, peer_id: int) -> Peer:
+    """Get peer by ID"""
+    peer = await db.get(Peer, peer_id)
+    if not peer:
+        raise HTTPException(status_code=404, detail="Peer not found")
+    return peer
+
+
+@traced("crud.get_peer_by_name")
+async def get_peer_by_name_async(db: AsyncSession, name: str) -> Peer:
+    """Get peer by name"""
+    return await db.scalar(select(Peer).where(Peer.name == name))
+
+
+@traced("crud.get_peer_by_api_key_hash")
+async def get_peer_by_api_key_hash_async(db: AsyncSession, api_key_hash: str) -> Peer:
+    """Get enabled peer by the hash of its API key"""
+    return await db.scalar(
+        select(Peer).where(Peer.api_key_hash == api_key_hash, Peer.is_enabled)
+    )
+
+
+@traced("crud.get_peers")
+async def get_peers_async(
+    db: AsyncSession, after_id: Optional[int] = None, limit: int = 100, **filters
+) -> list[Peer]:
+    """Get a page of peers with id greater than `after_id`"""
+    result = await db.scalars(
+        filter_peers(select(Peer), after_id, **filters).limit(limit)
+    )
+    return list(result)
+
+
+async def stream_peers_async(
+    db: AsyncSession, after_id: Optional[int] = None, batch_size: int = 500, **filters
+) -> AsyncIterator[Row]:
+    """Stream matching peers as plain rows, fetched `batch_size` at a time
+
+    Rows are not ORM objects, so nothing accumulates in the session's
+    identity map and memory stays flat however many peers are exported.
+    """
+    statement = filter_peers(select(Peer.__table__), after_id, **filters)
+    result = await db.stream(statement.execution_options(yield_per=batch_size))
+    async for row in result:
+        yield row
+
+
+@traced("crud.create_peer")
+async def create_peer_async(
+    db: AsyncSession, peer: PeerCreate, invite_code: Optional[str] = None
+) -> Peer:
+    """Create new peer
+
+    With `invite_code`, one use of the invite is taken in the same
+    transaction; nothing is created if it cannot be redeemed. The
+    plaintext API key is only kept on the returned object, as `api_key`.
+    """
+    api_key = Peer.generate_api_key()
+    db_peer = Peer(
+        name=peer.name,
+        public_key=peer.public_key,
+        assigned_ip=peer.assigned_ip,
+        api_key_hash=Peer.hash_api_key(api_key),
+        description=peer.description,
+    )
+    db.add(db_peer)
+    if invite_code is not None:
+        await db.flush()
+        if not await redeem_invite_async(db, invite_code, db_peer.id):
+            await db.rollback()
+            raise HTTPException(
+                status_code=403, detail="Invalid, expired or used up invite code"
+            )
+    await db.commit()
+    await db.refresh(db_peer)
+    db_peer.api_key = api_key
+    return db_peer
+
+
+@traced("crud.get_peers_by_ids")
+async def get_peers_by_ids_async(db: AsyncSession, peer_ids: list[int]) -> list[Peer]:
+    """Get the peers among `peer_ids` that exist"""
+    return list(await db.scalars(select(Peer).where(Peer.id.in_(peer_ids))))
+
+
+@traced("crud.get_existing_peer_keys")
+async def get_existing_peer_keys_async(
+    db: AsyncSession, peers: list[PeerCreate]
+) -> dict[str, set[str]]:
+    """Names, public keys and assigned IPs of `peers` already taken in the database"""
+    taken = {}
+    for field in ("name", "public_key", "assigned_ip"):
+        column = getattr(Peer, field)
+        values = {getattr(peer, field) for peer in peers}
+        taken[field] = set(await db.scalars(select(column).where(column.in_(values))))
+    return taken
+
+
+@traced("crud.create_peers")
+async def create_peers_async(db: AsyncSession, peers: list[PeerCreate]) -> list[Peer]:
+    """Create many peers in the current transaction, without committing
+
+    Like create_peer_async, each returned object carries its plaintext `api_key`.
+    """
+    db_peers = []
+    api_keys = []
+    for peer in peers:
+        api_key = Peer.generate_api_key()
+        api_keys.append(api_key)
+        db_peers.append(
+            Peer(
+                name=peer.name,
+                public_key=peer.public_key,
+                assigned_ip=peer.assigned_ip,
+                api_key_hash=Peer.hash_api_key(api_key),
+                description=peer.description,
+            )
+        )
+    db.add_all(db_peers)
+    await db.flush()
+    for db_peer, api_key in zip(db_peers, api_keys):
+        db_peer.api_key = api_key
+    return db_peers
+
+
+@traced("crud.set_peers_status")
+async def set_peers_status_async(
+    db: AsyncSession, peer_ids: list[int], enable: bool
+) -> list[Peer]:
+    """Enable or disable many peers in one transaction, returning those found"""
+    peers = await get_peers_by_ids_async(db, peer_ids)
+    for peer in peers:
+        peer.is_enabled = enable
+    await db.commit()
+    for peer in peers:
+        auth_cache.invalidate_peer(peer.id)
+    return peers
+
+
+@traced("crud.update_peer")
+async def update_peer_async(
+    db: AsyncSession, peer_id: int, peer_update: PeerUpdate
+) -> Peer:
+    """Update peer information"""
+    db_peer = await get_peer_async(db, peer_id)
+    update_data = peer_update.model_dump(exclude_unset=True)
+
+    for field, value in update_data.items():
+        setattr(db_peer, field, value)
+
+    await db.commit()
+    auth_cache.invalidate_peer(peer_id)
+    await db.refresh(db_peer)
+    return db_peer
+
+
+@traced("crud.toggle_peer_status")
+async def toggle_peer_status_async(
+    db: AsyncSession, peer_id: int, enable: bool
+) -> Peer:
+    """Enable or disable a peer"""
+    peer = await get_peer_async(db, peer_id)
+    peer.is_enabled = enable
+    await db.commit()
+    auth_cache.invalidate_peer(peer_id)
+    await db.refresh(peer)
+    return peer
+
+
+@traced("crud.delete_peers")
+async def delete_peers_async(db: AsyncSession, peers: list[Peer]) -> None:
+    """Delete many peers in one transaction"""
+    await release_invites_async(db, [peer.id for peer in peers])
+    for peer in peers:
+        await db.delete(peer)
+    await db.commit()
+    for peer in peers:
+        auth_cache.invalidate_peer(peer.id)
+
+
+@traced("crud.delete_peer")
+async def delete_peer_async(db: AsyncSession, peer_id: int) -> None:
+    """Delete a peer"""
+    peer = await get_peer_async(db, peer_id)
+    await release_invites_async(db, [peer_id])
+    await db.delete(peer)
+    await db.commit()
+    auth_cache.invalidate_peer(peer_id)
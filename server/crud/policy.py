@@ -0,0 +1,96 @@
+"""CRUD operations for access policies"""
+
+from typing import Optional
+from sqlalchemy import select
+from sqlalchemy.ext.asyncio import AsyncSession
+from fastapi import HTTPException
+
+from ..database.models import AccessPolicy, Peer
+from ..schemas.policy import PolicyCreate, PolicyUpdate
+from ..services.tracing import traced
+
+
+@traced("crud.get_policy")
+async def get_policy_async(db: AsyncSession, policy_id: int) -> AccessPolicy:
+    """Get policy by ID"""
+    policy = await db.get(AccessPolicy, policy_id)
+    if not policy:
+        raise HTTPException(status_code=404, detail="Policy not found")
+    return policy
+
+
+async def get_policy_by_name_async(
+    db: AsyncSession, name: str
+) -> Optional[AccessPolicy]:
+    """Get policy by name"""
+    return await db.scalar(select(AccessPolicy).where(AccessPolicy.name == name))
+
+
+@traced("crud.get_policies")
+async def get_policies_async(db: AsyncSession) -> list[AccessPolicy]:
+    """Get every policy"""
+    return list(await db.scalars(select(AccessPolicy).order_by(AccessPolicy.id)))
+
+
+@traced("crud.create_policy")
+async def create_policy_async(db: AsyncSession, policy: PolicyCreate) -> AccessPolicy:
+    """Create new policy"""
+    if await get_policy_by_name_async(db, policy.name):
+        raise HTTPException(status_code=400, detail="Policy name already exists")
+    db_policy = AccessPolicy(**policy.model_dump())
+    db.add(db_policy)
+    await db.commit()
+    await db.refresh(db_policy)
+    return db_policy
+
+
+@traced("crud.update_policy")
+async def update_policy_async(
+    db: AsyncSession, policy_id: int, policy_update: PolicyUpdate
+) -> AccessPolicy:
+    """Update policy networks, ports or name"""
+    db_policy = await get_policy_async(db, policy_id)
+    update_data = policy_update.model_dump(exclude_unset=True, exclude_none=True)
+    if "name" in update_data and update_data["name"] != db_policy.name:
+        if await get_policy_by_name_async(db, update_data["name"]):
+            raise HTTPException(status_code=400, detail="Policy name already exists")
+
+    for field, value in update_data.items():
+        setattr(db_policy, field, value)
+
+    await db.commit()
+    await db.refresh(db_policy)
+    return db_policy
+
+
+@traced("crud.delete_policy")
+async def delete_policy_async(db: AsyncSession, policy_id: int) -> None:
+    """Delete a policy, lifting it from its peers"""
+    db_policy = await get_policy_async(db, policy_id)
+    # Through the ORM, so the peer registry sees the peers change
+    for peer in await db.scalars(select(Peer).where(Peer.policy_id == policy_id)):
+        peer.policy_id = None
+    await db.delete(db_policy)
+    await db.commit()
+
+
+@traced("crud.set_peers_policy")
+async def set_peers_policy_async(
+    db: AsyncSession,
+    peer_ids: list[int],
+    policy_id: Optional[int],
+    only_from: Optional[int] = None,
+) -> list[Peer]:
+    """Put peers under `policy_id` (None lifts their policy) in one transaction
+
+    With `only_from`, only peers currently under that policy are changed.
+    Returns the changed peers.
+    """
+    statement = select(Peer).where(Peer.id.in_(peer_ids))
+    if only_from is not None:
+        statement = statement.where(Peer.policy_id == only_from)
+    peers = list(await db.scalars(statement))
+    for peer in peers:
+        peer.policy_id = policy_id
+    await db.commit()
+    return peers
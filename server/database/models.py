@@ -1,18 +1,28 @@
 """SQLAlchemy models of the database"""
 
 from datetime import datetime, timezone
+import hashlib
+import ipaddress
 import secrets
 from typing import Optional
-from sqlalchemy import Boolean, String, DateTime, Text, ForeignKey
-from sqlalchemy.orm import Mapped, mapped_column, relationship
+from sqlalchemy import Boolean, String, DateTime, Text, ForeignKey, Index, JSON
+from sqlalchemy.orm import Mapped, mapped_column, relationship, validates
 
 from .session import Base
 
 
+def ip_sort_key(ip: str) -> str:
+    """Fixed-width key that sorts like the address, so IP ranges are index range scans"""
+    address = ipaddress.ip_address(ip)
+    return f"{address.version}:{int(address):032x}"
+
+
 class Peer(Base):
     """Peer model for database"""
 
     __tablename__ = "peers"
+    # Keyset pages over enabled/disabled peers walk this index in id order
+    __table_args__ = (Index("ix_peers_is_enabled_id", "is_enabled", "id"),)
 
     id: Mapped[int] = mapped_column(primary_key=True)
 
@@ -22,12 +32,20 @@ class Peer(Base):
 
     is_enabled: Mapped[bool] = mapped_column(Boolean, default=True)
 
-    # authentication info
-    api_key: Mapped[str] = mapped_column(String, unique=True)
+    # authentication info, only a hash of the API key is stored
+    api_key_hash: Mapped[str] = mapped_column(String, unique=True, index=True)
     is_admin: Mapped[bool] = mapped_column(Boolean, default=False)
 
     description: Mapped[Optional[str]] = mapped_column(Text, nullable=True)
 
+    # egress policy enforced on the peer's traffic, None for unrestricted
+    policy_id: Mapped[Optional[int]] = mapped_column(
+        ForeignKey("access_policies.id"), nullable=True, index=True
+    )
+
+    # latest WireGuard handshake, written by the stats collector
+    last_seen: Mapped[Optional[datetime]] = mapped_column(DateTime, nullable=True)
+
     # timestamps
     created_at: Mapped[datetime] = mapped_column(
         DateTime, default=datetime.now(timezone.utc)
@@ -48,9 +66,14 @@ class Peer(Base):
         """Generate a random API key"""
         return f"vpn_{secrets.token_urlsafe(32)}"
 
-    def update_last_seen(self) -> None:
+    @staticmethod
+    def hash_api_key(api_key: str) -> str:
+        """Hash an API key for storage and lookup"""
+        return hashlib.sha256(api_key.encode()).hexdigest()
+
+    def update_last_seen(self, seen: Optional[datetime] = None) -> None:
         """Update last seen timestamp"""
-        self.last_seen = datetime.now(timezone.utc)
+        self.last_seen = seen or datetime.now(timezone.utc)
 
 
 class IPAllocation(Base):
@@ -60,6 +83,7 @@ class IPAllocation(Base):
 
     id: Mapped[int] = mapped_column(primary_key=True)
     ip_address: Mapped[str] = mapped_column(String, unique=True, index=True)
+    ip_key: Mapped[str] = mapped_column(String, index=True)
     peer_id: Mapped[Optional[int]] = mapped_column(ForeignKey("peers.id"), unique=True)
     is_reserved: Mapped[bool] = mapped_column(Boolean, default=False)
     created_at: Mapped[datetime] = mapped_column(DateTime, default=datetime.utcnow)
@@ -67,16 +91,71 @@ class IPAllocation(Base):
     # Relationship to peer
     peer: Mapped[Optional["Peer"]] = relationship(back_populates="ip_allocation")
 
+    @validates("ip_address")
+    def _set_ip_key(self, key: str, ip_address: str) -> str:
+        self.ip_key = ip_sort_key(ip_address)
+        return ip_address
+
+
+class AccessPolicy(Base):
+    """Egress policy of a peer or a group of peers"""
+
+    __tablename__ = "access_policies"
+
+    id: Mapped[int] = mapped_column(primary_key=True)
+    name: Mapped[str] = mapped_column(String, unique=True)
+    # destination networks the peers may reach, as normalized CIDRs
+    allowed_cidrs: Mapped[list] = mapped_column(JSON, default=list)
+    # TCP/UDP destination ports allowed on those networks, empty for any
+    allowed_ports: Mapped[list] = mapped_column(JSON, default=list)
+
+    created_at: Mapped[datetime] = mapped_column(
+        DateTime, default=datetime.now(timezone.utc)
+    )
+    last_modified: Mapped[datetime] = mapped_column(
+        DateTime,
+        default=datetime.now(timezone.utc),
+        onupdate=datetime.now(timezone.utc),
+    )
+
+
+class Change(Base):
+    """One entry of the append-only log of peer and allocation changes"""
+
+    __tablename__ = "changes"
+
+    # the revision clients resume from; assigned at commit, so ids grow in commit order
+    id: Mapped[int] = mapped_column(primary_key=True)
+    kind: Mapped[str] = mapped_column(String)
+    peer_id: Mapped[Optional[int]] = mapped_column(nullable=True)
+    data: Mapped[dict] = mapped_column(JSON)
+    created_at: Mapped[datetime] = mapped_column(DateTime, default=datetime.utcnow)
+
+
+class SchemaVersion(Base):
+    """Schema version an existing database was last upgraded to"""
+
+    __tablename__ = "schema_version"
+
+    version: Mapped[int] = mapped_column(primary_key=True)
+
 
 class Invite(Base):
     """Invite model for database"""
 
     __tablename__ = "invites"
+    # The expiry sweeper walks this index to delete a batch at a time
+    __table_args__ = (Index("ix_invites_expires_at", "expires_at"),)
 
     id: Mapped[int] = mapped_column(primary_key=True)
+    # unique, so redeeming a code is a single indexed update
     code: Mapped[str] = mapped_column(String, unique=True)
     expires_at: Mapped[Optional[datetime]] = mapped_column(DateTime, nullable=True)
+    # registrations the code still allows
+    uses_left: Mapped[int] = mapped_column(default=1)
+    description: Mapped[Optional[str]] = mapped_column(Text, nullable=True)
     created_at: Mapped[datetime] = mapped_column(DateTime, default=datetime.utcnow)
+    # peer that last registered with the code
     used_by: Mapped[Optional[int]] = mapped_column(ForeignKey("peers.id"), nullable=True)
     last_modified: Mapped[datetime] = mapped_column(
         DateTime,
@@ -95,4 +174,4 @@ class Invite(Base):
 
     def decrement_uses(self) -> None:
         """Decrement uses of invite"""
-        self.max_uses -= 1
\ No newline at end of file
+        self.uses_left -= 1
\ No newline at end of file
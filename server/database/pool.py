@@ -0,0 +1,102 @@
+"""Connection pools instrumented with checkout wait times"""
+
+import bisect
+import threading
+import time
+
+from sqlalchemy.pool import AsyncAdaptedQueuePool, QueuePool
+
+# Upper bounds in seconds of the checkout wait histogram
+WAIT_BUCKETS = (0.001, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0)
+
+
+class PoolStats:
+    """Checkout wait time statistics for one pool"""
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self.checkouts = 0
+        self.timeouts = 0
+        self.total_wait = 0.0
+        self.max_wait = 0.0
+        # One count per bucket plus the overflow bucket (+Inf)
+        self.bucket_counts = [0] * (len(WAIT_BUCKETS) + 1)
+
+    def observe(self, wait: float) -> None:
+        """Record a successful checkout that waited `wait` seconds"""
+        with self._lock:
+            self.checkouts += 1
+            self.total_wait += wait
+            self.max_wait = max(self.max_wait, wait)
+            self.bucket_counts[bisect.bisect_left(WAIT_BUCKETS, wait)] += 1
+
+    def observe_timeout(self) -> None:
+        """Record a checkout that gave up waiting"""
+        with self._lock:
+            self.timeouts += 1
+
+    def snapshot(self) -> dict:
+        """Current counters as a plain dict"""
+        with self._lock:
+            return {
+                "checkouts": self.checkouts,
+                "timeouts": self.timeouts,
+                "total_wait_seconds": self.total_wait,
+                "max_wait_seconds": self.max_wait,
+                "wait_buckets": dict(
+                    zip([*map(str, WAIT_BUCKETS), "+Inf"], self.bucket_counts)
+                ),
+            }
+
+
+class _TimedCheckout:
+    """Mixin timing how long `_do_get` waits for a free connection"""
+
+    stats: PoolStats
+
+    def _do_get(self):
+        start = time.perf_counter()
+        try:
+            connection = super()._do_get()
+        except Exception:
+            self.stats.observe_timeout()
+            raise
+        self.stats.observe(time.perf_counter() - start)
+        return connection
+
+    def recreate(self):
+        # Keep accumulating into the same stats when the pool is rebuilt
+        pool = super().recreate()
+        pool.stats = self.stats
+        return pool
+
+
+class TimedQueuePool(_TimedCheckout, QueuePool):
+    """QueuePool recording checkout wait times"""
+
+    def __init__(self, *args, **kwargs):
+        super().__init__(*args, **kwargs)
+        self.stats = PoolStats()
+
+
+class TimedAsyncAdaptedQueuePool(_TimedCheckout, AsyncAdaptedQueuePool):
+    """AsyncAdaptedQueuePool recording checkout wait times"""
+
+    def __init__(self, *args, **kwargs):
+        super().__init__(*args, **kwargs)
+        self.stats = PoolStats()
+
+
+def pool_status(pool) -> dict:
+    """Occupancy and wait statistics of an engine's pool"""
+    status = {}
+    if isinstance(pool, QueuePool):
+        status = {
+            "size": pool.size(),
+            "checked_out": pool.checkedout(),
+            "overflow": pool.overflow(),
+        }
+    stats = getattr(pool, "stats", None)
+    if stats is not None:
+        status.update(stats.snapshot())
+    return status
@@ -1,8 +1,19 @@
 """Database session management"""
 
-from sqlalchemy import create_engine
-from sqlalchemy.orm import sessionmaker, DeclarativeBase
-from contextlib import contextmanager
+from sqlalchemy import create_engine, event
+from sqlalchemy.engine import Engine, make_url
+from sqlalchemy.ext.asyncio import async_sessionmaker, create_async_engine
+from sqlalchemy.orm import Session, sessionmaker, DeclarativeBase
+from contextlib import asynccontextmanager, contextmanager
+
+from .. import config
+from .pool import TimedAsyncAdaptedQueuePool, TimedQueuePool, pool_status
+
+# Async drivers used for the API when the URL names a plain dialect
+ASYNC_DRIVERS = {
+    "sqlite": "sqlite+aiosqlite",
+    "postgresql": "postgresql+asyncpg",
+}
 
 
 class Base(DeclarativeBase):
@@ -11,25 +22,108 @@ class Base(DeclarativeBase):
     pass
 
 
+class AppSession(Session):
+    """Session class of the application's factories, a target for ORM event hooks"""
+
+    pass
+
+
+def async_url(url: str) -> str:
+    """Turn a sync database URL into the equivalent async driver URL"""
+    parsed = make_url(url)
+    drivername = ASYNC_DRIVERS.get(parsed.drivername, parsed.drivername)
+    return parsed.set(drivername=drivername).render_as_string(hide_password=False)
+
+
+def _is_sqlite_memory(url: str) -> bool:
+    database = make_url(url).database
+    return database in (None, "", ":memory:") or "mode=memory" in database
+
+
+def engine_options(url: str, is_async: bool = False) -> dict:
+    """Engine keyword arguments for the backend named by `url`"""
+    backend = make_url(url).get_backend_name()
+    if backend == "sqlite" and _is_sqlite_memory(url):
+        # In-memory databases live in one connection; keep SQLAlchemy's default pool
+        return {"connect_args": {"check_same_thread": False}}
+
+    options = {
+        "poolclass": TimedAsyncAdaptedQueuePool if is_async else TimedQueuePool,
+        "pool_size": config.DB_POOL_SIZE,
+        "max_overflow": config.DB_MAX_OVERFLOW,
+        "pool_timeout": config.DB_POOL_TIMEOUT,
+    }
+    if backend == "sqlite":
+        # sqlite3's own lock timeout is in seconds; busy_timeout is set per connection too
+        options["connect_args"] = {
+            "check_same_thread": False,
+            "timeout": config.SQLITE_BUSY_TIMEOUT_MS / 1000,
+        }
+    else:
+        # Server-side databases drop idle connections, SQLite files never do
+        options["pool_pre_ping"] = True
+        options["pool_recycle"] = config.DB_POOL_RECYCLE
+    return options
+
+
+def configure_sqlite(engine: Engine) -> None:
+    """Apply WAL mode and tuning pragmas to every new SQLite connection"""
+
+    @event.listens_for(engine, "connect")
+    def set_sqlite_pragmas(dbapi_connection, connection_record):
+        cursor = dbapi_connection.cursor()
+        # WAL lets readers proceed while a writer commits
+        cursor.execute("PRAGMA journal_mode=WAL")
+        # Durable across application crashes; only an OS crash can lose the last commits
+        cursor.execute("PRAGMA synchronous=NORMAL")
+        cursor.execute(f"PRAGMA busy_timeout={config.SQLITE_BUSY_TIMEOUT_MS}")
+        cursor.execute(f"PRAGMA mmap_size={config.SQLITE_MMAP_SIZE}")
+        cursor.execute(f"PRAGMA cache_size={config.SQLITE_CACHE_SIZE}")
+        cursor.close()
+
+
+def build_engines(url: str):
+    """Create the sync and async engines for a database URL"""
+    engine = create_engine(url, **engine_options(url))
+    async_engine = create_async_engine(async_url(url), **engine_options(url, True))
+    if engine.dialect.name == "sqlite" and not _is_sqlite_memory(url):
+        configure_sqlite(engine)
+        configure_sqlite(async_engine.sync_engine)
+    return engine, async_engine
+
+
 class DatabaseSession:
-    """Singleton database session factory"""
+    """Singleton database session factory
+
+    The sync engine serves CLI tools and startup code, the async engine
+    serves route handlers so they never block the event loop.
+    """
 
     _instance = None
     _engine = None
     _session_factory = None
+    _async_engine = None
+    _async_session_factory = None
 
     def __new__(cls):
         if cls._instance is None:
             cls._instance = super(DatabaseSession, cls).__new__(cls)
-            cls._instance._engine = create_engine(
-                "sqlite:///./vpn.db",
-                connect_args={"check_same_thread": False},
-                pool_pre_ping=True,
-                pool_size=5,
-                max_overflow=10,
-            )
+            engine, async_engine = build_engines(config.DATABASE_URL)
+            cls._instance._engine = engine
             cls._instance._session_factory = sessionmaker(
-                autocommit=False, autoflush=False, bind=cls._instance._engine
+                autocommit=False,
+                autoflush=False,
+                bind=cls._instance._engine,
+                class_=AppSession,
+            )
+            cls._instance._async_engine = async_engine
+            # Objects stay loaded after commit, since lazy loads can't run
+            # implicitly under asyncio
+            cls._instance._async_session_factory = async_sessionmaker(
+                bind=cls._instance._async_engine,
+                autoflush=False,
+                expire_on_commit=False,
+                sync_session_class=AppSession,
             )
         return cls._instance
 
@@ -46,11 +140,36 @@ class DatabaseSession:
         finally:
             session.close()
 
+    @asynccontextmanager
+    async def get_async_session(self):
+        """Get async database session with context management"""
+        session = self._async_session_factory()
+        try:
+            yield session
+            await session.commit()
+        except Exception:
+            await session.rollback()
+            raise
+        finally:
+            await session.close()
+
     @property
     def engine(self):
         """Get SQLAlchemy engine"""
         return self._engine
 
+    @property
+    def async_engine(self):
+        """Get SQLAlchemy async engine"""
+        return self._async_engine
+
+    def pool_status(self) -> dict:
+        """Occupancy and checkout wait statistics of both engine pools"""
+        return {
+            "sync": pool_status(self._engine.pool),
+            "async": pool_status(self._async_engine.sync_engine.pool),
+        }
+
 
 db = DatabaseSession()
 
@@ -59,3 +178,9 @@ def get_db():
     """Get database session for FastAPI dependency injection"""
     with db.get_session() as session:
         yield session
+
+
+async def get_async_db():
+    """Get async database session for FastAPI dependency injection"""
+    async with db.get_async_session() as session:
+        yield session
@@ -0,0 +1,160 @@
+"""Upgrades of databases created by earlier versions of the server
+
+create_all only creates missing tables. Columns and indexes added to
+existing tables since are brought in by the steps below, and the version
+reached is kept in the schema_version table. Databases from before the
+table existed can be at any point of the history, so every step checks
+what is already there.
+"""
+
+from sqlalchemy import Column, Connection, Engine, Table, delete, insert, inspect
+from sqlalchemy import select, text
+from sqlalchemy.schema import CreateTable
+
+from .models import Invite, IPAllocation, Peer, SchemaVersion, ip_sort_key
+from .session import Base
+
+# Key of the PostgreSQL advisory lock held while upgrading
+ADVISORY_LOCK_KEY = 0x61737065
+
+
+def _columns(connection: Connection, table: str) -> set[str]:
+    return {column["name"] for column in inspect(connection).get_columns(table)}
+
+
+def _add_column(connection: Connection, column: Column, default=None) -> None:
+    """Add a model column to its table if missing: nullable, or NOT NULL with `default`"""
+    table = column.table.name
+    if column.name in _columns(connection, table):
+        return
+    spec = f"{column.name} {column.type.compile(dialect=connection.dialect)}"
+    for foreign_key in column.foreign_keys:
+        target = foreign_key.column
+        spec += f" REFERENCES {target.table.name} ({target.name})"
+    if default is not None:
+        spec += f" NOT NULL DEFAULT {default}"
+    connection.exec_driver_sql(f"ALTER TABLE {table} ADD COLUMN {spec}")
+
+
+def _create_indexes(connection: Connection, table: Table) -> None:
+    for index in table.indexes:
+        index.create(connection, checkfirst=True)
+
+
+def _rebuild_sqlite_peers(connection: Connection) -> None:
+    """Recreate the peers table from the model, keeping its rows
+
+    SQLite can neither drop a UNIQUE column nor relax NOT NULL, so the
+    plaintext api_key column only goes with a new table. Its values are
+    copied into api_key_hash, to be hashed in place.
+    """
+    existing = _columns(connection, "peers")
+    kept = ", ".join(
+        column.name
+        for column in Peer.__table__.columns
+        if column.name in existing and column.name != "api_key_hash"
+    )
+    ddl = str(CreateTable(Peer.__table__).compile(dialect=connection.dialect))
+    connection.exec_driver_sql(
+        ddl.replace("CREATE TABLE peers", "CREATE TABLE peers_new", 1)
+    )
+    connection.exec_driver_sql(
+        f"INSERT INTO peers_new ({kept}, api_key_hash) SELECT {kept}, api_key FROM peers"
+    )
+    connection.exec_driver_sql("DROP TABLE peers")
+    connection.exec_driver_sql("ALTER TABLE peers_new RENAME TO peers")
+
+
+def _hash_api_keys(connection: Connection) -> None:
+    """Store API keys as hashes only"""
+    if "api_key" not in _columns(connection, "peers"):
+        return
+    keys = connection.execute(text("SELECT id, api_key FROM peers")).all()
+    if connection.dialect.name == "sqlite":
+        _rebuild_sqlite_peers(connection)
+    else:
+        _add_column(connection, Peer.__table__.c.api_key_hash)
+        connection.exec_driver_sql("ALTER TABLE peers DROP COLUMN api_key")
+    if keys:
+        connection.execute(
+            text("UPDATE peers SET api_key_hash = :key_hash WHERE id = :id"),
+            [{"id": id, "key_hash": Peer.hash_api_key(key)} for id, key in keys],
+        )
+    _create_indexes(connection, Peer.__table__)
+
+
+def _add_ip_keys(connection: Connection) -> None:
+    """Sortable IP keys for range filters, and the peer listing index"""
+    _add_column(connection, IPAllocation.__table__.c.ip_key)
+    rows = connection.execute(
+        text("SELECT id, ip_address FROM ip_allocations WHERE ip_key IS NULL")
+    ).all()
+    if rows:
+        connection.execute(
+            text("UPDATE ip_allocations SET ip_key = :ip_key WHERE id = :id"),
+            [{"id": id, "ip_key": ip_sort_key(ip)} for id, ip in rows],
+        )
+    _create_indexes(connection, IPAllocation.__table__)
+    _create_indexes(connection, Peer.__table__)
+
+
+def _add_last_seen(connection: Connection) -> None:
+    """Latest handshake of each peer"""
+    _add_column(connection, Peer.__table__.c.last_seen)
+
+
+def _add_policy_ids(connection: Connection) -> None:
+    """Egress policy of each peer"""
+    _add_column(connection, Peer.__table__.c.policy_id)
+    _create_indexes(connection, Peer.__table__)
+
+
+def _add_invite_uses(connection: Connection) -> None:
+    """Multi-use invites with a description, and the expiry index"""
+    _add_column(connection, Invite.__table__.c.uses_left, default=1)
+    _add_column(connection, Invite.__table__.c.description)
+    _create_indexes(connection, Invite.__table__)
+
+
+# Version reached by each step, in order
+STEPS = (
+    (1, _hash_api_keys),
+    (2, _add_ip_keys),
+    (3, _add_last_seen),
+    (4, _add_policy_ids),
+    (5, _add_invite_uses),
+)
+
+SCHEMA_VERSION = STEPS[-1][0]
+
+
+def _lock(connection: Connection) -> None:
+    """Serialize upgrades, so workers starting together run them once"""
+    if connection.dialect.name == "sqlite":
+        # Take the write lock now: a deferred transaction could not wait for it
+        connection.exec_driver_sql("BEGIN IMMEDIATE")
+    elif connection.dialect.name == "postgresql":
+        connection.execute(
+            text("SELECT pg_advisory_xact_lock(:key)"), {"key": ADVISORY_LOCK_KEY}
+        )
+
+
+def upgrade_database(engine: Engine) -> int:
+    """Create missing tables and bring existing ones to the current schema
+
+    Runs in one transaction and returns the version the database was at.
+    """
+    with engine.begin() as connection:
+        _lock(connection)
+        is_new = not inspect(connection).has_table(Peer.__tablename__)
+        Base.metadata.create_all(bind=connection)
+        stored = connection.scalar(select(SchemaVersion.version))
+        version = SCHEMA_VERSION if is_new else stored or 0
+        for number, step in STEPS:
+            if number > version:
+                print(f"[server]: Upgrading database schema: {step.__doc__}")
+                step(connection)
+        if stored is None or stored < SCHEMA_VERSION:
+            connection.execute(delete(SchemaVersion))
+            connection.execute(insert(SchemaVersion).values(version=SCHEMA_VERSION))
+    return version
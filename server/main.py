@@ -3,67 +3,187 @@ Command line tool to spin up FastAPI server to handle VPN requests
 """
 
 import argparse
+import os
 from contextlib import asynccontextmanager
 
 import uvicorn
-from fastapi import FastAPI, HTTPException
-from python_wireguard import Server, Key
+from fastapi import Depends, FastAPI, HTTPException, Request, Response, Security
+from fastapi.security import APIKeyHeader
+from python_wireguard import Key
 from pydantic import BaseModel
+from sqlalchemy.ext.asyncio import AsyncSession
+from typing import Optional
 
 
-from .database.session import DatabaseSession, Base
-from .routes import peers
-from services.ip_manager import IPManager
+from . import config
+from .agent import AgentBackend, AgentCounterSource
+from .database.session import DatabaseSession, get_async_db
+from .database.upgrade import upgrade_database
+from .routes import changes, health, invites, jobs, metrics, peers, policies
+from .services.changes import change_feed
+from .services.admission import admit
+from .services.invites import invite_sweeper
+from .services.shards import ip_manager
+from .services.peer_registry import peer_registry
+from .services.policies import policy_engine, policy_store
+from .services.metrics import MetricsMiddleware
+from .services.provisioner import provisioner
+from .services.revision import check_etag
+from .services.stats import stats_collector
+from .services.tracing import TracingMiddleware, tracer
+from .wireguard import (
+    KernelBackend,
+    PeerReconciler,
+    ShardedReconciler,
+    SharedPeerReconciler,
+    desired_peers,
+    load_or_create_key_pair,
+    open_server,
+    set_reconciler,
+)
 
 # Initialize database singleton
 db = DatabaseSession()
-with db.get_session() as session:
-    Base.metadata.create_all(bind=db.engine)
 
+wg_servers = []  # WireGuard server instance of every shard brought up here
+server_public_key = None  # Store public key separately
+# Default endpoint upon which server is accessible
+endpoint = os.environ.get("ASPEN_ENDPOINT", "127.0.0.1")
 
-# Initialize IP manager
-ip_manager = IPManager("10.0.0.0/24", "10.0.0.1")
-with db.get_session() as session:
-    ip_manager.initialize_ip_pool(session)
 
+def init_database() -> None:
+    """Create or upgrade the schema, then load the address pools and the peer registry
 
-wg_server = None  # WireGuard server instance
-server_public_key = None  # Store public key separately
-endpoint = "127.0.0.1"  # Default endpoint upon which server is accessible
+    Safe to run on every start: nothing is re-inserted, and databases of
+    earlier versions are upgraded in place.
+    """
+    upgrade_database(db.engine)
+    with db.get_session() as session:
+        ip_manager.initialize_ip_pool(session)
+        peer_registry.load(session)
+        policy_store.load(session)
+        change_feed.load(session)
+
+
+def open_local_shard(index: int, private: Key, public: Key) -> PeerReconciler:
+    """Enable the WireGuard interface of a shard, adopting a live one"""
+    shard = ip_manager.shard(index)
+    wg_server, adopted = open_server(
+        shard.interface, private, public, shard.address, shard.port
+    )
+    wg_servers.append(wg_server)
+    state = "adopted" if adopted else "enabled"
+    print(
+        f"[server]: WireGuard shard {shard.interface} {state}: "
+        f"{shard.address} on {endpoint}:{shard.port}"
+    )
+    return PeerReconciler(KernelBackend(wg_server))
+
+
+def load_desired_peers(network=None) -> dict[str, str]:
+    """Enabled peers committed by any worker, read from the database"""
+    with db.get_session() as session:
+        return desired_peers(session, network)
+
+
+def open_agent_shard(index: int) -> PeerReconciler:
+    """Have the agent bring up a shard's interface"""
+    shard = ip_manager.shard(index)
+    backend = AgentBackend(config.WG_AGENT_SOCKET, shard.interface)
+    backend.open(shard.address, shard.port)
+    return SharedPeerReconciler(backend, lambda: load_desired_peers(shard.network))
 
 
 @asynccontextmanager
 async def lifespan(app: FastAPI):
-    """Initialize WireGuard interface on server start"""
-    global wg_server, server_public_key
-
-    # Generate server keys
-    private, public = Key.key_pair()
-    server_public_key = public  # Store public key
-
-    print(f"Creating subnet 10.0.0.1/24 on {endpoint}")
-
-    # Create WireGuard interface
-    # Using 10.0.0.1/24 as our VPN subnet
-    wg_server = Server(
-        interface_name="wg0",
-        key=private,
-        local_ip="10.0.0.1/24",
-        port=51820,
+    """Initialize WireGuard interfaces on server start"""
+    global server_public_key
+
+    init_database()
+    if config.WG_AGENT_SOCKET:
+        # The agent owns the interfaces; other workers share them
+        server_public_key = AgentBackend(config.WG_AGENT_SOCKET).info()["public_key"]
+        reconciler = ShardedReconciler(ip_manager.shard_index, open_agent_shard)
+        stats_collector.source = AgentCounterSource(config.WG_AGENT_SOCKET)
+        peer_registry.shared = True
+        provisioner.load_desired = load_desired_peers
+        print(f"[server]: Using WireGuard agent at {config.WG_AGENT_SOCKET}")
+        if policy_engine.enabled:
+            # Each worker only sees its own changes; one of them would undo the rest
+            policy_engine.enabled = False
+            print("[server]: Access policies are not enforced behind the agent")
+    else:
+        # Server keys, shared by every shard and kept across restarts
+        private, public = load_or_create_key_pair(config.WG_KEY_FILE)
+        server_public_key = public  # Store public key
+        reconciler = ShardedReconciler(
+            ip_manager.shard_index,
+            lambda index: open_local_shard(index, private, public),
+        )
+    set_reconciler(reconciler)
+
+    # Bring up the shards in use, then load peers already in the database
+    for shard in ip_manager.shards:
+        reconciler.reconciler(shard.index)
+    # Adopted interfaces only get the changes made while the server was down
+    changes = reconciler.reconcile(peer_registry.desired_peers())
+    print(
+        f"[server]: Restored peers: {len(changes.add)} added, "
+        f"{len(changes.update)} updated, {len(changes.remove)} removed"
     )
-    wg_server.enable()
-    print("[server]: WireGuard server enabled")
+    if policy_engine.enabled:
+        policy_engine.sync(policy_store.rules(), peer_registry.policy_assignments())
+        print(
+            f"[server]: Enforcing access policies in nftables table {policy_engine.table}"
+        )
+    provisioner.start()
+    stats_collector.session_factory = db.get_session
+    stats_collector.start()
+    invite_sweeper.session_factory = db.get_session
+    invite_sweeper.start()
     yield
 
+    # Apply updates still queued before the interfaces go away
+    await invite_sweeper.stop()
+    await stats_collector.stop()
+    await provisioner.stop()
+    tracer.close()
+    if config.WG_KEEP_INTERFACES:
+        # Tunnels stay up; the next start adopts the interfaces
+        print("[server]: Leaving WireGuard interfaces up")
+        return
     print("[server]: Cleaning up WireGuard server")
+    if policy_engine.enabled:
+        policy_engine.remove()
     # Remove interfaces
-    wg_server.delete_interface()
+    for wg_server in wg_servers:
+        wg_server.delete_interface()
 
 
 app = FastAPI(title="Aspen VPN Server", lifespan=lifespan)
 
 # Include peer routes
-app.include_router(peers.router, prefix="/api/peers", tags=["peers"])
+# Rate limits and the concurrency cap; health checks and metrics are exempt
+ADMISSION = [Depends(admit)]
+app.include_router(
+    peers.router, prefix="/api/peers", tags=["peers"], dependencies=ADMISSION
+)
+app.include_router(
+    jobs.router, prefix="/api/jobs", tags=["jobs"], dependencies=ADMISSION
+)
+app.include_router(
+    policies.router, prefix="/api/policies", tags=["policies"], dependencies=ADMISSION
+)
+app.include_router(
+    changes.router, prefix="/api/changes", tags=["changes"], dependencies=ADMISSION
+)
+app.include_router(
+    invites.router, prefix="/api/invites", tags=["invites"], dependencies=ADMISSION
+)
+app.include_router(health.router, prefix="/api", tags=["health"])
+app.include_router(metrics.router, tags=["metrics"])
+app.add_middleware(MetricsMiddleware)
+app.add_middleware(TracingMiddleware)
 
 
 class ServerInfo(BaseModel):
@@ -73,34 +193,95 @@ class ServerInfo(BaseModel):
     endpoint: str
     port: int
     network_cidr: str
+    interface: str
 
 
-@app.get("/api/server-info", response_model=ServerInfo)
-async def get_server_info():
-    """Return server connection information"""
-    if not wg_server or not server_public_key:
-        detail = f"Server not initialized - {'Missing WireGuard server' if not wg_server else ''} - {'Missing public key' if not server_public_key else ''}"
-        raise HTTPException(status_code=500, detail=detail)
+# Optional here: without a key, peers get the first shard
+OPTIONAL_API_KEY_HEADER = APIKeyHeader(name="X-API-Key", auto_error=False)
+
+
+@app.get("/api/server-info", response_model=ServerInfo, dependencies=ADMISSION)
+async def get_server_info(
+    request: Request,
+    response: Response,
+    api_key: Optional[str] = Security(OPTIONAL_API_KEY_HEADER),
+    db: AsyncSession = Depends(get_async_db),
+):
+    """Return server connection information
+
+    With an API key, returns the endpoint of the shard the peer was placed on.
+    """
+    if not server_public_key:
+        raise HTTPException(
+            status_code=500, detail="Server not initialized - Missing public key"
+        )
+    # A 304 must not vouch for a key that is invalid or disabled
+    peer = await peers.verify_api_key(api_key, db) if api_key else None
+    # The shard depends on the caller
+    response.headers["Vary"] = "X-API-Key"
+    if not_modified := check_etag(request, response):
+        not_modified.headers["Vary"] = "X-API-Key"
+        return not_modified
+
+    shard = ip_manager.shard(0)
+    if peer:
+        ip_address = await ip_manager.get_peer_ip_async(db, peer.id)
+        shard = (ip_address and ip_manager.shard_for_ip(ip_address)) or shard
 
     return ServerInfo(
         public_key=str(server_public_key),
         endpoint=endpoint,
-        port=51820,
-        network_cidr="10.0.0.0/24",
+        port=shard.port,
+        network_cidr=str(shard.network),
+        interface=shard.interface,
     )
 
 
+@app.get("/api/server-info/shards", dependencies=ADMISSION)
+async def get_shards(
+    request: Request, response: Response, admin=Depends(peers.verify_admin)
+):
+    """Interface, port, subnet and peer count of every shard"""
+    if not_modified := check_etag(request, response):
+        return not_modified
+    return ip_manager.stats()
+
+
 if __name__ == "__main__":
     parser = argparse.ArgumentParser(description="Aspen VPN Server")
     parser.add_argument("--host", default="127.0.0.1", help="Host to bind to")
     parser.add_argument("--port", type=int, default=8000, help="Port to bind to")
+    parser.add_argument(
+        "--workers",
+        type=int,
+        default=1,
+        help="Worker processes, requires ASPEN_WG_AGENT_SOCKET when more than one",
+    )
     parser.add_argument(
         "--endpoint",
         default="127.0.0.1",
         help="Ip address upon which the server is accessible",
     )
+    parser.add_argument(
+        "--keep-interfaces",
+        action="store_true",
+        default=config.WG_KEEP_INTERFACES,
+        help="Leave WireGuard interfaces up on shutdown, for a warm restart",
+    )
     args = parser.parse_args()
     endpoint = args.endpoint
+    config.WG_KEEP_INTERFACES = args.keep_interfaces
+
+    if args.workers > 1 and not config.WG_AGENT_SOCKET:
+        parser.error("--workers needs the WireGuard agent (ASPEN_WG_AGENT_SOCKET)")
 
     print("[server]: Starting VPN")
-    uvicorn.run(app, host=args.host, port=args.port)
+    if args.workers > 1:
+        # Each worker imports the app itself; --endpoint reaches them through
+        # the environment
+        os.environ["ASPEN_ENDPOINT"] = endpoint
+        uvicorn.run(
+            "server.main:app", host=args.host, port=args.port, workers=args.workers
+        )
+    else:
+        uvicorn.run(app, host=args.host, port=args.port)
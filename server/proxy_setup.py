@@ -3,103 +3,201 @@ Aspen VPN 2024
 Handles setting up and tearing down the server proxy.
 """
 
+import os
 import subprocess
 
-def process_commands(commands: list, check: bool = True):
-    """Process a list of commands."""
-    for command in commands:
-        try:
-            subprocess.run(command, check=check)
-        except subprocess.CalledProcessError:
-            print(f"Error executing command: {command}")
-            break
+# Rules live in chains of our own, hung off the built-in ones with a single
+# jump each, so applying them never disturbs anyone else's rules
+FORWARD_CHAIN = "ASPEN-FORWARD"
+NAT_CHAIN = "ASPEN-POSTROUTING"
+# Our chain -> (table, built-in chain that jumps to it)
+CHAINS = {
+    NAT_CHAIN: ("nat", "POSTROUTING"),
+    FORWARD_CHAIN: ("filter", "FORWARD"),
+}
+
+IP_FORWARD = "/proc/sys/net/ipv4/ip_forward"
+RULES_FILE = "/etc/iptables/rules.v4"
+SUDO = [] if os.geteuid() == 0 else ["sudo"]
+
+class RulesPartlyApplied(Exception):
+    """Some tables were changed and could not be put back after another one failed."""
 
-def enable_ip_forwarding():
+def run_command(command: list, input: str = None) -> str:
+    """Run a command and return its output, raising CalledProcessError on failure."""
+    return subprocess.run(command, input=input, capture_output=True, text=True, check=True).stdout
+
+def set_ip_forwarding(enabled: bool, path: str = IP_FORWARD, run=run_command) -> bool:
+    """Set IPv4 forwarding through /proc/sys; returns whether it changed."""
+    value = "1" if enabled else "0"
+    with open(path) as file:
+        if file.read().strip() == value:
+            return False
+    try:
+        with open(path, "w") as file:
+            file.write(value)
+    except PermissionError:
+        run(SUDO + ["sysctl", "-w", f"net.ipv4.ip_forward={value}"])
+    return True
+
+def enable_ip_forwarding(path: str = IP_FORWARD, run=run_command):
     """Enable IP forwarding on the server."""
-    # Modify /etc/sysctl.conf to enable IP forwarding
-    with open("/etc/sysctl.conf", "r") as file:
-        sysctl_conf = file.readlines()
-
-    with open("/etc/sysctl.conf", "w") as file:
-        for line in sysctl_conf:
-            if line.strip() == "#net.ipv4.ip_forward=1":
-                file.write("net.ipv4.ip_forward=1\n")
-            elif line.strip() == "net.ipv4.ip_forward=1":
-                file.write("net.ipv4.ip_forward=1\n")
-            else:
-                file.write(line)
-
-    # Apply the changes
-    subprocess.run(["sudo", "sysctl", "-p"], check=True)
+    set_ip_forwarding(True, path, run)
     print("IP forwarding enabled.")
 
-def disable_ip_forwarding():
+def disable_ip_forwarding(path: str = IP_FORWARD, run=run_command):
     """Disable IP forwarding on the server."""
-    # Modify /etc/sysctl.conf to disable IP forwarding
-    with open("/etc/sysctl.conf", "r") as file:
-        sysctl_conf = file.readlines()
-
-    with open("/etc/sysctl.conf", "w") as file:
-        for line in sysctl_conf:
-            if line.strip() == "net.ipv4.ip_forward=1":
-                file.write("#net.ipv4.ip_forward=1\n")
-            else:
-                file.write(line)
-
-    # Apply the changes
-    subprocess.run(["sudo", "sysctl", "-p"], check=True)
+    set_ip_forwarding(False, path, run)
     print("IP forwarding disabled.")
 
-def configure_iptables(interface_name: str):
+def parse_ruleset(saved: str) -> dict:
+    """Parse iptables-save output into {table: {chain: [rules]}}."""
+    tables = {}
+    chains = None
+    for line in saved.splitlines():
+        line = line.strip()
+        if line.startswith("*"):
+            chains = tables.setdefault(line[1:], {})
+        elif chains is None or not line or line.startswith("#") or line == "COMMIT":
+            continue
+        elif line.startswith(":"):
+            chains.setdefault(line[1:].split()[0], [])
+        elif line.startswith("-A "):
+            chains.setdefault(line.split()[1], []).append(line)
+    return tables
+
+def desired_rules(interface_names: list, out_interface: str = "eth0") -> dict:
+    """Rules of each of our chains for NAT and forwarding of the VPN interfaces."""
+    forward = []
+    for name in interface_names:
+        forward += [
+            f"-A {FORWARD_CHAIN} -i {name} -o {out_interface} -m state --state RELATED,ESTABLISHED -j ACCEPT",
+            f"-A {FORWARD_CHAIN} -i {out_interface} -o {name} -j ACCEPT",
+        ]
+    return {
+        NAT_CHAIN: [f"-A {NAT_CHAIN} -o {out_interface} -j MASQUERADE"],
+        FORWARD_CHAIN: forward,
+    }
+
+def plan_restore(live: dict, desired: dict) -> dict:
+    """iptables-restore --noflush input of each table taking the live rules to the desired ones.
+
+    `desired` maps each of our chains to its rules, or to None to remove it.
+    Returns {table: input}, empty when the live rules already match.
+    """
+    tables = {}
+    for chain, rules in desired.items():
+        table, builtin = CHAINS[chain]
+        live_chains = live.get(table, {})
+        jump = f"-A {builtin} -j {chain}"
+        has_jump = jump in live_chains.get(builtin, [])
+        lines = []
+        if rules is None:
+            if has_jump:
+                lines.append(f"-D {builtin} -j {chain}")
+            if chain in live_chains:
+                # Declaring a chain under --noflush empties it, then drop it
+                lines += [f":{chain} - [0:0]", f"-X {chain}"]
+        else:
+            if live_chains.get(chain) != rules:
+                lines += [f":{chain} - [0:0]"] + rules
+            if not has_jump:
+                lines.append(jump)
+        if lines:
+            tables.setdefault(table, []).extend(lines)
+    return {table: f"*{table}\n" + "\n".join(lines) + "\nCOMMIT\n" for table, lines in tables.items()}
+
+def apply_rules(desired: dict, run=run_command, persist: bool = True) -> bool:
+    """Bring the live rules to `desired`, all or nothing; returns whether anything changed.
+
+    iptables-restore commits each table on its own, so the tables are restored
+    one at a time, and when one fails those already committed are put back as
+    they were saved.
+    """
+    saved = run(SUDO + ["iptables-save"])
+    plan = plan_restore(parse_ruleset(saved), desired)
+    if not plan:
+        return False
+    committed = []
+    for table, restore in plan.items():
+        try:
+            run(SUDO + ["iptables-restore", "--noflush"], input=restore)
+        except subprocess.CalledProcessError:
+            for done in reversed(committed):
+                # Without --noflush the table is replaced by its saved state
+                try:
+                    run(SUDO + ["iptables-restore", "--table", done], input=saved)
+                except subprocess.CalledProcessError as e:
+                    raise RulesPartlyApplied(f"{table} failed and {done} could not be put back: {e.stderr or e}")
+            raise
+        committed.append(table)
+    if persist:
+        persist_rules(run)
+    return True
+
+def persist_rules(run=run_command) -> bool:
+    """Save the live rules for the next boot; best effort, as they are already applied."""
+    try:
+        run(SUDO + ["sh", "-c", f"iptables-save > {RULES_FILE}"])
+    except subprocess.CalledProcessError as e:
+        print(f"IPTables rules applied but not persisted to {RULES_FILE}: {e.stderr or e}")
+        return False
+    return True
+
+def configure_iptables(*interface_names: str, out_interface: str = "eth0", run=run_command) -> bool:
     """Configure IPTables for NAT and forwarding."""
-    commands = [
-        ["sudo", "iptables", "-t", "nat", "-A", "POSTROUTING", "-o", "eth0", "-j", "MASQUERADE"],
-        ["sudo", "iptables", "-A", "FORWARD", "-i", interface_name, "-o", "eth0", "-m", "state", "--state", "RELATED,ESTABLISHED", "-j", "ACCEPT"],
-        ["sudo", "iptables", "-A", "FORWARD", "-i", "eth0", "-o", interface_name, "-j", "ACCEPT"],
-        ["sudo", "sh", "-c", "iptables-save > /etc/iptables/rules.v4"]
-    ]
-    # 0 - Set up IP masquerading
-    # 1 - Allow forwarding from the VPN interface to eth0
-    # 2 - Allow forwarding from eth0 to the VPN interface
-    # 3 - Save the IPTables rules
-    process_commands(commands)
-    print("IPTables configured for NAT and forwarding.")
-
-def clear_iptables(interface_name: str):
+    # - Masquerade traffic leaving through out_interface
+    # - Allow forwarding between each VPN interface and out_interface
+    try:
+        changed = apply_rules(desired_rules(interface_names, out_interface), run)
+    except RulesPartlyApplied as e:
+        print(f"Error applying IPTables rules, they are partly applied: {e}")
+        return False
+    except subprocess.CalledProcessError as e:
+        print(f"Error applying IPTables rules, nothing was changed: {e.stderr or e}")
+        return False
+    print("IPTables configured for NAT and forwarding." if changed else "IPTables already configured.")
+    return True
+
+def clear_iptables(run=run_command) -> bool:
     """Clear IPTables rules for NAT and forwarding."""
-    commands = [
-        ["sudo", "iptables", "-t", "nat", "-D", "POSTROUTING", "-o", "eth0", "-j", "MASQUERADE"],
-        ["sudo", "iptables", "-D", "FORWARD", "-i", interface_name, "-o", "eth0", "-m", "state", "--state", "RELATED,ESTABLISHED", "-j", "ACCEPT"],
-        ["sudo", "iptables", "-D", "FORWARD", "-i", "eth0", "-o", interface_name, "-j", "ACCEPT"],
-        ["sudo", "sh", "-c", "iptables-save > /etc/iptables/rules.v4"]
-    ]
-    # 0 - Remove IP masquerading
-    # 1, 2 - Remove forwarding rules
-    # 3 - Save the IPTables rules
-    process_commands(commands)
-    
+    try:
+        apply_rules({chain: None for chain in CHAINS}, run)
+    except RulesPartlyApplied as e:
+        print(f"Error clearing IPTables rules, they are partly cleared: {e}")
+        return False
+    except subprocess.CalledProcessError as e:
+        print(f"Error clearing IPTables rules, nothing was changed: {e.stderr or e}")
+        return False
     print("IPTables rules cleared.")
+    return True
 
-def setup_server_proxy(interface_name: str):
+def setup_server_proxy(*interface_names: str, out_interface: str = "eth0") -> bool:
     """Automate server proxy setup."""
     enable_ip_forwarding()
-    configure_iptables(interface_name)
+    if not configure_iptables(*interface_names, out_interface=out_interface):
+        return False
     print("Server proxy setup completed.")
+    return True
 
-def disable_server_proxy(interface_name: str):
+def disable_server_proxy() -> bool:
     """Automate server proxy remove."""
     disable_ip_forwarding()
-    clear_iptables(interface_name)
+    if not clear_iptables():
+        return False
     print("Server proxy remove completed.")
+    return True
 
 if __name__ == "__main__":
     import argparse
     parser = argparse.ArgumentParser(description="Setup or remove server proxy.")
     parser.add_argument("action", choices=["setup", "remove"], help="Action to perform: setup or remove the server proxy.")
-    parser.add_argument("--interface", default="wg1", help="Name of the VPN interface (default: wg1).")
+    parser.add_argument("--interface", action="append", help="Name of a VPN interface, repeatable (default: wg1).")
+    parser.add_argument("--out-interface", default="eth0", help="Interface traffic leaves through (default: eth0).")
     args = parser.parse_args()
 
     if args.action == "setup":
-        setup_server_proxy(args.interface)
+        ok = setup_server_proxy(*(args.interface or ["wg1"]), out_interface=args.out_interface)
     elif args.action == "remove":
-        disable_server_proxy(args.interface)
\ No newline at end of file
+        ok = disable_server_proxy()
+    raise SystemExit(0 if ok else 1)
\ No newline at end of file
@@ -0,0 +1,109 @@
+"""Change feed routes: long-poll and Server-Sent Events"""
+
+import json
+from typing import Optional
+from fastapi import APIRouter, Depends, Header, HTTPException, Query, Request
+from fastapi.encoders import jsonable_encoder
+from fastapi.responses import StreamingResponse
+from sqlalchemy.ext.asyncio import AsyncSession
+
+from .. import config
+from ..database.session import get_async_db
+from ..schemas.change import ChangePage
+from ..services.auth_cache import AuthenticatedPeer
+from ..services.changes import RevisionGone, change_feed
+from .peers import verify_api_key
+
+router = APIRouter()
+
+MAX_PAGE_SIZE = 1000
+
+SINCE_QUERY = Query(
+    None,
+    ge=0,
+    description="Last revision seen; omit to start from now. "
+    "`X-Change-Revision` of GET /api/peers/ matches the list it came with.",
+)
+
+GONE_DETAIL = "Revision no longer in the change log, reload the peer list"
+
+
+@router.get("/", response_model=ChangePage)
+async def get_changes(
+    peer: AuthenticatedPeer = Depends(verify_api_key),
+    db: AsyncSession = Depends(get_async_db),
+    since: Optional[int] = SINCE_QUERY,
+    limit: int = Query(MAX_PAGE_SIZE, ge=1, le=MAX_PAGE_SIZE),
+    wait: float = Query(
+        0, ge=0, le=config.CHANGES_MAX_WAIT, description="Seconds to long-poll"
+    ),
+):
+    """Peer and IP allocation changes after revision `since`
+
+    With `wait`, an empty answer is held until a change is committed or
+    the time is up. 410 means the revision is gone and the client must
+    reload the full peer list.
+    """
+    if since is None:
+        since = (await change_feed.bounds(db))[1]
+    try:
+        changes = await change_feed.read(db, since, limit)
+        if not changes and wait and await change_feed.wait(db, since, wait):
+            changes = await change_feed.read(db, since, limit)
+    except RevisionGone:
+        raise HTTPException(status_code=410, detail=GONE_DETAIL)
+    return ChangePage(
+        changes=changes,
+        next=changes[-1]["rev"] if changes else since,
+        more=len(changes) == limit,
+    )
+
+
+@router.get("/stream")
+async def stream_changes(
+    request: Request,
+    peer: AuthenticatedPeer = Depends(verify_api_key),
+    db: AsyncSession = Depends(get_async_db),
+    since: Optional[int] = SINCE_QUERY,
+    last_event_id: Optional[int] = Header(None, ge=0),
+):
+    """Server-Sent Events stream of changes after revision `since`
+
+    Each event's id is its revision and its name its kind; reconnecting
+    clients resume through `Last-Event-ID`.
+    """
+    if last_event_id is not None:
+        since = last_event_id
+    if since is None:
+        since = (await change_feed.bounds(db))[1]
+    try:
+        # Fail before the stream starts, while a status code can still be sent
+        first = await change_feed.read(db, since, MAX_PAGE_SIZE)
+    except RevisionGone:
+        raise HTTPException(status_code=410, detail=GONE_DETAIL)
+    return StreamingResponse(
+        _events(request, db, since, first),
+        media_type="text/event-stream",
+        # Proxies must pass events through as they come
+        headers={"Cache-Control": "no-cache", "X-Accel-Buffering": "no"},
+    )
+
+
+async def _events(request: Request, db: AsyncSession, since: int, changes: list):
+    yield "retry: 3000\n\n"
+    while True:
+        for change in changes:
+            data = json.dumps(jsonable_encoder(change), separators=(",", ":"))
+            yield f"id: {change['rev']}\nevent: {change['kind']}\ndata: {data}\n\n"
+            since = change["rev"]
+        if await request.is_disconnected():
+            return
+        if len(changes) < MAX_PAGE_SIZE and not await change_feed.wait(
+            db, since, config.CHANGES_KEEPALIVE
+        ):
+            yield ": keep-alive\n\n"
+        try:
+            changes = await change_feed.read(db, since, MAX_PAGE_SIZE)
+        except RevisionGone:
+            yield f"event: reset\ndata: {json.dumps(GONE_DETAIL)}\n\n"
+            return
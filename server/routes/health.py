@@ -5,6 +5,8 @@ Health check route
 from datetime import datetime
 from fastapi import APIRouter, FastAPI
 
+from ..database.session import db
+
 
 app = FastAPI(title="Aspen VPN Server")
 router = APIRouter()
@@ -15,4 +17,10 @@ async def health():
     return {"status": "ok", "time": datetime.now()}
 
 
+@router.get("/health/db-pool")
+async def db_pool():
+    """Connection pool occupancy and checkout wait times, for sizing the pool"""
+    return db.pool_status()
+
+
 app.include_router(router)
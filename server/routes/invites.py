@@ -1,22 +1,101 @@
-"""
-Health check route
-"""
+"""Invite routes: minting, listing and revoking invite codes"""
 
-from datetime import datetime
-from fastapi import APIRouter, FastAPI
+import asyncio
+from datetime import datetime, timedelta, timezone
+from typing import List, Optional
+from fastapi import APIRouter, Depends, HTTPException, Query, Request, Response
+from sqlalchemy.ext.asyncio import AsyncSession
 
+from ..crud import invite as invite_crud
+from ..database.session import get_async_db
+from ..schemas.invite import InviteBatch, InviteInDB, InviteMint
+from ..services.auth_cache import AuthenticatedPeer
+from ..services.invites import invite_sweeper
+from ..services.revision import check_etag
+from .peers import MAX_PAGE_SIZE, verify_admin
 
-app = FastAPI(title="Aspen VPN Server")
 router = APIRouter()
 
 
-@router.get("/create-invite")
-async def create_invite():
-    """ Generate a new invite code.
-        Requires admin privileges.
+def _expiry(mint: InviteMint) -> Optional[datetime]:
+    """Naive UTC expiry of a batch, as stored"""
+    if mint.expires_in is not None:
+        return datetime.utcnow() + timedelta(seconds=mint.expires_in)
+    expires_at = mint.expires_at
+    if expires_at is None:
+        return None
+    if expires_at.tzinfo is not None:
+        expires_at = expires_at.astimezone(timezone.utc).replace(tzinfo=None)
+    if expires_at <= datetime.utcnow():
+        raise HTTPException(status_code=422, detail="expires_at is in the past")
+    return expires_at
+
+
+@router.post("/", response_model=InviteBatch)
+async def mint_invites(
+    mint: InviteMint,
+    admin: AuthenticatedPeer = Depends(verify_admin),
+    db: AsyncSession = Depends(get_async_db),
+):
+    """Mint a batch of invite codes in one transaction
+
+    Each code lets `uses` peers register through POST /api/peers/register.
     """
-    
-    return {"status": "ok", "time": datetime.now()}
+    expires_at = _expiry(mint)
+    codes = await invite_crud.mint_invites_async(
+        db, mint.count, mint.uses, expires_at, mint.description
+    )
+    print(f"[server]: Minted {len(codes)} invites")
+    return InviteBatch(
+        count=len(codes), uses=mint.uses, expires_at=expires_at, codes=codes
+    )
+
+
+@router.get("/", response_model=List[InviteInDB])
+async def list_invites(
+    request: Request,
+    response: Response,
+    admin: AuthenticatedPeer = Depends(verify_admin),
+    db: AsyncSession = Depends(get_async_db),
+    after: Optional[int] = Query(None, description="Return invites with a greater id"),
+    limit: int = Query(100, ge=1, le=MAX_PAGE_SIZE),
+    active: Optional[bool] = Query(
+        None, description="Only invites that can (or can no longer) be redeemed"
+    ),
+):
+    """List invites a page at a time, keyed on id like the peer list"""
+    if not_modified := check_etag(request, response):
+        return not_modified
+    invites = await invite_crud.get_invites_async(db, after, limit, active)
+    if len(invites) == limit:
+        response.headers["X-Next-Cursor"] = str(invites[-1].id)
+    return invites
+
+
+@router.post("/sweep")
+async def sweep_invites(admin: AuthenticatedPeer = Depends(verify_admin)):
+    """Delete expired invites now instead of at the next scheduled sweep"""
+    if invite_sweeper.session_factory is None:
+        raise HTTPException(status_code=503, detail="Invite sweeper not running")
+    return {"deleted": await asyncio.to_thread(invite_sweeper.sweep)}
+
+
+@router.get("/{invite_id}", response_model=InviteInDB)
+async def get_invite(
+    invite_id: int,
+    admin: AuthenticatedPeer = Depends(verify_admin),
+    db: AsyncSession = Depends(get_async_db),
+):
+    """Get specific invite"""
+    return await invite_crud.get_invite_async(db, invite_id)
 
 
-app.include_router(router)
+@router.delete("/{invite_id}", response_model=InviteInDB)
+async def revoke_invite(
+    invite_id: int,
+    admin: AuthenticatedPeer = Depends(verify_admin),
+    db: AsyncSession = Depends(get_async_db),
+):
+    """Revoke an invite; peers already registered with it are kept"""
+    invite = await invite_crud.delete_invite_async(db, invite_id)
+    return InviteInDB.model_validate(invite)
@@ -0,0 +1,25 @@
+"""WireGuard provisioning job routes"""
+
+from fastapi import APIRouter, Depends, HTTPException
+
+from ..schemas.job import JobInfo
+from ..services.auth_cache import AuthenticatedPeer
+from ..services.provisioner import provisioner
+from .peers import verify_api_key
+
+router = APIRouter()
+
+
+@router.get("/")
+async def get_provisioning_stats(peer: AuthenticatedPeer = Depends(verify_api_key)):
+    """How many update requests were coalesced into how many batches"""
+    return provisioner.stats()
+
+
+@router.get("/{job_id}", response_model=JobInfo)
+async def get_job(job_id: str, peer: AuthenticatedPeer = Depends(verify_api_key)):
+    """Get the status of a provisioning job"""
+    job = provisioner.get_job(job_id)
+    if job is None:
+        raise HTTPException(status_code=404, detail="Job not found")
+    return job
@@ -0,0 +1,134 @@
+"""Prometheus metrics route"""
+
+from fastapi import APIRouter
+from fastapi.responses import PlainTextResponse
+
+from ..database.pool import WAIT_BUCKETS
+from ..database.session import db
+from ..services.auth_cache import auth_cache
+from ..services.metrics import CollectedMetric, histogram_samples, metrics
+from ..services.peer_registry import peer_registry
+from ..services.provisioner import provisioner
+from ..services.shards import ip_manager
+from ..services.stats import stats_collector
+
+router = APIRouter()
+
+CONTENT_TYPE = "text/plain; version=0.0.4; charset=utf-8"
+
+
+def _gauge(name: str, help: str, samples: list) -> CollectedMetric:
+    return CollectedMetric(name, "gauge", help, samples)
+
+
+def _counter(name: str, help: str, samples: list) -> CollectedMetric:
+    return CollectedMetric(name, "counter", help, samples)
+
+
+def collect_db_pools():
+    """Occupancy and checkout waits of both connection pools"""
+    status = db.pool_status()
+    occupancy = {"size": [], "checked_out": [], "overflow": []}
+    waits, timeouts = [], []
+    for engine, pool in status.items():
+        labels = {"engine": engine}
+        for field, samples in occupancy.items():
+            if field in pool:
+                samples.append(("", labels, pool[field]))
+        if "wait_buckets" in pool:
+            waits.extend(
+                histogram_samples(
+                    labels,
+                    WAIT_BUCKETS,
+                    list(pool["wait_buckets"].values()),
+                    pool["total_wait_seconds"],
+                )
+            )
+            timeouts.append(("", labels, pool["timeouts"]))
+
+    yield _gauge("aspen_db_pool_size", "Connections kept open", occupancy["size"])
+    yield _gauge(
+        "aspen_db_pool_checked_out",
+        "Connections in use",
+        occupancy["checked_out"],
+    )
+    yield _gauge(
+        "aspen_db_pool_overflow",
+        "Connections beyond the pool size",
+        occupancy["overflow"],
+    )
+    yield CollectedMetric(
+        "aspen_db_pool_checkout_wait_seconds",
+        "histogram",
+        "Time spent waiting for a free connection",
+        waits,
+    )
+    yield _counter(
+        "aspen_db_pool_checkout_timeouts_total",
+        "Checkouts that gave up waiting",
+        timeouts,
+    )
+
+
+def collect_ip_pools():
+    """Address pool utilization per interface shard"""
+    allocated, size = [], []
+    for shard in ip_manager.shards:
+        labels = {"interface": shard.interface}
+        allocated.append(("", labels, shard.peer_count))
+        size.append(("", labels, shard.ip_manager.pool.size - 1))
+    yield _gauge("aspen_ip_pool_allocated", "Addresses allocated to peers", allocated)
+    yield _gauge("aspen_ip_pool_size", "Addresses available to peers", size)
+
+
+def collect_peers():
+    """Peer counts and activity"""
+    yield _gauge(
+        "aspen_peers",
+        "Registered peers by state",
+        [
+            ("", {"state": state}, count)
+            for state, count in peer_registry.counts().items()
+        ],
+    )
+    yield _gauge(
+        "aspen_peers_active",
+        "Peers with a recent WireGuard handshake",
+        [("", {}, stats_collector.last_active)],
+    )
+
+
+def collect_services():
+    """Auth cache and provisioning queue counters"""
+    cache = auth_cache.stats()
+    yield _counter(
+        "aspen_auth_cache_requests_total",
+        "API key lookups by result",
+        [
+            ("", {"result": "hit"}, cache["hits"]),
+            ("", {"result": "miss"}, cache["misses"]),
+        ],
+    )
+    yield _gauge("aspen_auth_cache_size", "Cached API keys", [("", {}, cache["size"])])
+
+    jobs = provisioner.stats()
+    yield _counter(
+        "aspen_provision_requests_total",
+        "WireGuard update requests",
+        [("", {}, jobs["requests"])],
+    )
+    yield _counter(
+        "aspen_provision_batches_total",
+        "Coalesced WireGuard update batches",
+        [("", {}, jobs["batches"])],
+    )
+
+
+for collector in (collect_db_pools, collect_ip_pools, collect_peers, collect_services):
+    metrics.add_collector(collector)
+
+
+@router.get("/metrics", response_class=PlainTextResponse)
+async def get_metrics():
+    """Metrics in the Prometheus text format"""
+    return PlainTextResponse(metrics.render(), media_type=CONTENT_TYPE)
@@ -1,131 +1,474 @@
 """Peer management routes"""
 
-from fastapi import APIRouter, Depends, HTTPException, Security
+import ipaddress
+from typing import Any
+from fastapi import (
+    APIRouter,
+    Depends,
+    HTTPException,
+    Query,
+    Request,
+    Response,
+    Security,
+)
+from fastapi.encoders import jsonable_encoder
+from fastapi.responses import JSONResponse, StreamingResponse
 from fastapi.security import APIKeyHeader
-from sqlalchemy.orm import Session
-from typing import List
+from sqlalchemy.exc import IntegrityError
+from sqlalchemy.ext.asyncio import AsyncSession
+from typing import List, Optional
 
-from ..database.session import get_db
+from .. import config
+from ..database.session import get_async_db
 from ..database.models import Peer
-from ..schemas.peer import PeerCreate, PeerInDB, PeerUpdate
+from ..schemas.job import JobAccepted, JobInfo
+from ..schemas.peer import (
+    PeerBulkCreate,
+    PeerBulkIds,
+    PeerBulkItem,
+    PeerBulkResult,
+    PeerInDB,
+    PeerRegister,
+    PeerRegistered,
+    PeerUpdate,
+)
+from ..crud import invite as invite_crud
 from ..crud import peer as peer_crud
-from ..services.ip_manager import IPManager
-from ..wireguard import get_wg_server, sync_wireguard_peers
+from ..crud import policy as policy_crud
+from ..services.auth_cache import AuthenticatedPeer, auth_cache
+from ..services.changes import change_feed
+from ..services.shards import ip_manager
+from ..services.peer_registry import peer_registry
+from ..services.provisioner import provisioner
+from ..services.revision import check_etag
+from ..services.stats import DEFAULT_TIERS, stats_collector
 
 router = APIRouter()
 API_KEY_HEADER = APIKeyHeader(name="X-API-Key")
 
-# Initialize IP manager (move configuration to settings later)
-ip_manager = IPManager("10.0.0.0/24", "10.0.0.1")
+MAX_PAGE_SIZE = 1000
 
 
-def verify_api_key(
-    api_key: str = Security(API_KEY_HEADER), db: Session = Depends(get_db)
-):
+def background_requested(
+    background: bool = Query(
+        False, description="Return 202 with a job id instead of waiting for WireGuard"
+    ),
+) -> bool:
+    """The `background` flag, refused before any change if its job could not be polled"""
+    if background and peer_registry.shared:
+        # Jobs live in the worker that queued them; the poll may reach another
+        raise HTTPException(
+            status_code=400, detail="background=true needs a single server worker"
+        )
+    return background
+
+
+BACKGROUND_QUERY = Depends(background_requested)
+ACCEPTED_RESPONSE = {202: {"model": JobAccepted}}
+
+STATS_TIER_QUERY = Query(
+    DEFAULT_TIERS[0][0],
+    pattern="^(" + "|".join(name for name, _, _ in DEFAULT_TIERS) + ")$",
+    description="Resolution of the returned time series",
+)
+
+
+async def verify_api_key(
+    api_key: str = Security(API_KEY_HEADER), db: AsyncSession = Depends(get_async_db)
+) -> AuthenticatedPeer:
     """Verify API key belongs to an enabled peer"""
-    peer = db.query(Peer).filter(Peer.api_key == api_key, Peer.is_enabled).first()
+    key_hash = Peer.hash_api_key(api_key)
+    # Other workers' changes never reach this process's cache: with several
+    # workers, revoking a key must take effect everywhere at once
+    cached = None if peer_registry.shared else auth_cache.get(key_hash)
+    if cached:
+        return cached
+
+    peer = await peer_crud.get_peer_by_api_key_hash_async(db, key_hash)
     if not peer:
         raise HTTPException(status_code=403, detail="Invalid or disabled API key")
-    return peer
+    authenticated = AuthenticatedPeer(peer.id, peer.name, peer.is_admin)
+    if not peer_registry.shared:
+        auth_cache.put(key_hash, authenticated)
+    return authenticated
 
 
-def verify_admin(
-    api_key: str = Security(API_KEY_HEADER), db: Session = Depends(get_db)
-):
+async def verify_admin(
+    api_key: str = Security(API_KEY_HEADER), db: AsyncSession = Depends(get_async_db)
+) -> AuthenticatedPeer:
     """Verify API key belongs to an admin peer"""
-    peer = verify_api_key(api_key, db)
+    peer = await verify_api_key(api_key, db)
     if not peer.is_admin:
         raise HTTPException(status_code=403, detail="Admin access required")
     return peer
 
 
-@router.post("/register", response_model=PeerInDB)
-async def register_peer(peer: PeerCreate, db: Session = Depends(get_db)):
-    """Register a new peer"""
-    if peer_crud.get_peer_by_name(db, peer.name):
+async def provision(reason: str, background: bool, result: Any):
+    """Queue a WireGuard update for a committed change
+
+    Waits for the (coalesced) update and returns `result`, or with
+    `background` answers 202 right away with the job to poll.
+    """
+    job = provisioner.submit(reason)
+    if background:
+        body = JobAccepted(job=JobInfo.model_validate(job), result=result)
+        return JSONResponse(
+            status_code=202,
+            content=jsonable_encoder(body),
+            headers={"Location": f"/api/jobs/{job.id}"},
+        )
+
+    await provisioner.wait(job)
+    if job.status == "failed":
+        raise HTTPException(
+            status_code=500, detail=f"WireGuard update failed: {job.error}"
+        )
+    return result
+
+
+@router.post("/register", response_model=PeerRegistered, responses=ACCEPTED_RESPONSE)
+async def register_peer(
+    peer: PeerRegister,
+    db: AsyncSession = Depends(get_async_db),
+    background: bool = BACKGROUND_QUERY,
+):
+    """Register a new peer
+
+    Takes one use of `invite_code` when given; with ASPEN_INVITES_REQUIRED
+    a code is mandatory.
+    """
+    if config.INVITES_REQUIRED and peer.invite_code is None:
+        raise HTTPException(status_code=403, detail="Invite code required")
+    if await peer_crud.get_peer_by_name_async(db, peer.name):
         raise HTTPException(status_code=400, detail="Peer name already exists")
 
     # Create peer first to get ID
-    db_peer = peer_crud.create_peer(db, peer)
+    db_peer = await peer_crud.create_peer_async(db, peer, peer.invite_code)
 
     # Allocate IP address
     try:
-        ip_address = ip_manager.allocate_ip(db, db_peer.id)
+        ip_address = await ip_manager.allocate_ip_async(db, db_peer.id)
         print(f"[server]: Allocated IP {ip_address} to {peer.name}")
     except RuntimeError as e:
-        peer_crud.delete_peer(db, db_peer.id)
+        if peer.invite_code is not None:
+            # Committed together with the deletion below
+            await invite_crud.refund_invite_async(db, peer.invite_code, db_peer.id)
+        await peer_crud.delete_peer_async(db, db_peer.id)
         raise HTTPException(status_code=503, detail="No available IP addresses") from e
 
     # Add to WireGuard if successful
-    wg_server = get_wg_server()
-    sync_wireguard_peers(db, wg_server)
+    return await provision(
+        f"register peer {db_peer.id}",
+        background,
+        PeerRegistered.model_validate(db_peer),
+    )
+
 
-    return db_peer
+def _bulk_result(results: list[PeerBulkItem]) -> PeerBulkResult:
+    succeeded = sum(1 for item in results if item.ok)
+    return PeerBulkResult(
+        succeeded=succeeded, failed=len(results) - succeeded, results=results
+    )
+
+
+@router.post(
+    "/bulk/register", response_model=PeerBulkResult, responses=ACCEPTED_RESPONSE
+)
+async def bulk_register_peers(
+    request: PeerBulkCreate,
+    admin: AuthenticatedPeer = Depends(verify_admin),
+    db: AsyncSession = Depends(get_async_db),
+    background: bool = BACKGROUND_QUERY,
+):
+    """Register many peers in one transaction and one WireGuard update
+
+    Items whose name, public key or assigned IP is already taken (in the
+    database or earlier in the batch) fail individually; the rest are
+    created together.
+    """
+    results: list[Optional[PeerBulkItem]] = [None] * len(request.peers)
+    taken = await peer_crud.get_existing_peer_keys_async(db, request.peers)
+    accepted = []
+    for index, peer in enumerate(request.peers):
+        conflict = next(
+            (
+                field
+                for field, values in taken.items()
+                if getattr(peer, field) in values
+            ),
+            None,
+        )
+        if conflict:
+            results[index] = PeerBulkItem(
+                index=index, ok=False, error=f"Peer {conflict} already exists"
+            )
+            continue
+        for field, values in taken.items():
+            values.add(getattr(peer, field))
+        accepted.append((index, peer))
+
+    if accepted:
+        try:
+            db_peers = await peer_crud.create_peers_async(
+                db, [peer for _, peer in accepted]
+            )
+            ips = await ip_manager.allocate_many_async(db, [p.id for p in db_peers])
+        except RuntimeError as e:
+            await db.rollback()
+            raise HTTPException(
+                status_code=503, detail="No available IP addresses"
+            ) from e
+
+        try:
+            await db.commit()
+        except IntegrityError as e:
+            # Another process registered a conflicting peer or took one of
+            # the addresses; resync the pool so a retry gets fresh ones
+            await db.rollback()
+            ip_manager.release_addresses(ips)
+            await ip_manager.load_async(db)
+            raise HTTPException(
+                status_code=409, detail="Conflicting concurrent change, retry the batch"
+            ) from e
+
+        for (index, _), db_peer in zip(accepted, db_peers):
+            results[index] = PeerBulkItem(
+                index=index,
+                ok=True,
+                peer_id=db_peer.id,
+                peer=PeerRegistered.model_validate(db_peer),
+            )
+        print(f"[server]: Registered {len(db_peers)} peers in bulk")
+
+    return await provision(
+        f"bulk register {len(accepted)} peers", background, _bulk_result(results)
+    )
+
+
+def _id_results(peer_ids: list[int], found: set[int]) -> PeerBulkResult:
+    return _bulk_result(
+        [
+            PeerBulkItem(
+                index=index,
+                ok=peer_id in found,
+                peer_id=peer_id,
+                error=None if peer_id in found else "Peer not found",
+            )
+            for index, peer_id in enumerate(peer_ids)
+        ]
+    )
+
+
+@router.post("/bulk/enable", response_model=PeerBulkResult, responses=ACCEPTED_RESPONSE)
+async def bulk_enable_peers(
+    request: PeerBulkIds,
+    admin: AuthenticatedPeer = Depends(verify_admin),
+    db: AsyncSession = Depends(get_async_db),
+    background: bool = BACKGROUND_QUERY,
+):
+    """Enable many peers in one transaction and one WireGuard update"""
+    peers = await peer_crud.set_peers_status_async(db, request.peer_ids, True)
+    result = _id_results(request.peer_ids, {peer.id for peer in peers})
+    return await provision(f"bulk enable {len(peers)} peers", background, result)
+
+
+@router.post(
+    "/bulk/disable", response_model=PeerBulkResult, responses=ACCEPTED_RESPONSE
+)
+async def bulk_disable_peers(
+    request: PeerBulkIds,
+    admin: AuthenticatedPeer = Depends(verify_admin),
+    db: AsyncSession = Depends(get_async_db),
+    background: bool = BACKGROUND_QUERY,
+):
+    """Disable many peers in one transaction and one WireGuard update"""
+    peers = await peer_crud.set_peers_status_async(db, request.peer_ids, False)
+    result = _id_results(request.peer_ids, {peer.id for peer in peers})
+    return await provision(f"bulk disable {len(peers)} peers", background, result)
+
+
+@router.post("/bulk/delete", response_model=PeerBulkResult, responses=ACCEPTED_RESPONSE)
+async def bulk_delete_peers(
+    request: PeerBulkIds,
+    admin: AuthenticatedPeer = Depends(verify_admin),
+    db: AsyncSession = Depends(get_async_db),
+    background: bool = BACKGROUND_QUERY,
+):
+    """Delete many peers and release their IPs in one transaction"""
+    peers = await peer_crud.get_peers_by_ids_async(db, request.peer_ids)
+    ips = await ip_manager.deallocate_many_async(db, [peer.id for peer in peers])
+    found = {peer.id for peer in peers}
+    await peer_crud.delete_peers_async(db, peers)
+    ip_manager.release_addresses(ips)
+    result = _id_results(request.peer_ids, found)
+    return await provision(f"bulk delete {len(found)} peers", background, result)
 
 
 @router.get("/", response_model=List[PeerInDB])
 async def list_peers(
-    current_peer: Peer = Depends(verify_api_key),
-    db: Session = Depends(get_db),
-    skip: int = 0,
-    limit: int = 100,
+    request: Request,
+    response: Response,
+    current_peer: AuthenticatedPeer = Depends(verify_api_key),
+    db: AsyncSession = Depends(get_async_db),
+    after: Optional[int] = Query(None, description="Return peers with a greater id"),
+    limit: int = Query(100, ge=1, le=MAX_PAGE_SIZE),
+    enabled: Optional[bool] = None,
+    name_prefix: Optional[str] = Query(None, min_length=1),
+    ip_range: Optional[str] = Query(None, description="CIDR the peer IP falls in"),
+    format: str = Query("json", pattern="^(json|ndjson)$"),
+):
+    """List peers a page at a time
+
+    Pages are keyed on peer id: pass the `X-Next-Cursor` header of one page
+    as `after` to get the next. `format=ndjson` streams every matching peer
+    (admins only) instead of a page.
+    """
+    try:
+        network = ipaddress.ip_network(ip_range, strict=False) if ip_range else None
+    except ValueError as e:
+        raise HTTPException(status_code=422, detail=f"Invalid ip_range: {e}") from e
+    filters = {"enabled": enabled, "name_prefix": name_prefix, "network": network}
+
+    if format == "ndjson":
+        if not current_peer.is_admin:
+            raise HTTPException(status_code=403, detail="Admin access required")
+        return StreamingResponse(
+            _peers_ndjson(db, after, filters), media_type="application/x-ndjson"
+        )
+
+    if not_modified := check_etag(request, response):
+        return not_modified
+    # Read before the peers, so following the feed from here misses nothing
+    response.headers["X-Change-Revision"] = str(change_feed.latest)
+    if peer_registry.shared or any(value is not None for value in filters.values()):
+        peers = await peer_crud.get_peers_async(db, after, limit, **filters)
+    else:
+        # Unfiltered pages are served from memory
+        peers = peer_registry.page(after_id=after, limit=limit)
+
+    if len(peers) == limit:
+        response.headers["X-Next-Cursor"] = str(peers[-1].id)
+    return peers
+
+
+async def _peers_ndjson(db: AsyncSession, after: Optional[int], filters: dict):
+    async for row in peer_crud.stream_peers_async(db, after, **filters):
+        yield PeerInDB.model_validate(row).model_dump_json() + "\n"
+
+
+@router.get("/auth-cache")
+async def auth_cache_stats(admin: AuthenticatedPeer = Depends(verify_admin)):
+    """Hit/miss counters of the API key cache"""
+    return auth_cache.stats()
+
+
+@router.get("/stats")
+async def aggregate_stats(
+    admin: AuthenticatedPeer = Depends(verify_admin),
+    tier: str = STATS_TIER_QUERY,
+):
+    """Traffic of all peers together"""
+    return stats_collector.aggregate(tier)
+
+
+@router.get("/{peer_id}/stats")
+async def peer_stats(
+    peer_id: int,
+    current_peer: AuthenticatedPeer = Depends(verify_api_key),
+    db: AsyncSession = Depends(get_async_db),
+    tier: str = STATS_TIER_QUERY,
 ):
-    """List all peers"""
-    return peer_crud.get_peers(db, skip=skip, limit=limit)
+    """Transfer counters and latest handshake of a peer, with their history
+
+    Peers may read their own statistics; admins any peer's.
+    """
+    if current_peer.id != peer_id and not current_peer.is_admin:
+        raise HTTPException(status_code=403, detail="Admin access required")
+    if peer_registry.shared:
+        peer = await peer_crud.get_peer_async(db, peer_id)
+    else:
+        peer = peer_registry.get(peer_id)
+        if not peer:
+            raise HTTPException(status_code=404, detail="Peer not found")
+    return stats_collector.peer_stats(peer.public_key, tier)
 
 
 @router.get("/{peer_id}", response_model=PeerInDB)
 async def get_peer(
     peer_id: int,
-    current_peer: Peer = Depends(verify_api_key),
-    db: Session = Depends(get_db),
+    request: Request,
+    response: Response,
+    current_peer: AuthenticatedPeer = Depends(verify_api_key),
+    db: AsyncSession = Depends(get_async_db),
 ):
     """Get specific peer"""
-    return peer_crud.get_peer(db, peer_id)
+    if not_modified := check_etag(request, response):
+        return not_modified
+    if peer_registry.shared:
+        return await peer_crud.get_peer_async(db, peer_id)
+    peer = peer_registry.get(peer_id)
+    if not peer:
+        raise HTTPException(status_code=404, detail="Peer not found")
+    return peer
 
 
-@router.put("/{peer_id}", response_model=PeerInDB)
+@router.put("/{peer_id}", response_model=PeerInDB, responses=ACCEPTED_RESPONSE)
 async def update_peer(
     peer_id: int,
     peer_update: PeerUpdate,
-    current_peer: Peer = Depends(verify_admin),
-    db: Session = Depends(get_db),
+    current_peer: AuthenticatedPeer = Depends(verify_admin),
+    db: AsyncSession = Depends(get_async_db),
+    background: bool = BACKGROUND_QUERY,
 ):
     """Update peer information"""
-    return peer_crud.update_peer(db, peer_id, peer_update)
+    if peer_update.policy_id is not None:
+        await policy_crud.get_policy_async(db, peer_update.policy_id)
+    peer = await peer_crud.update_peer_async(db, peer_id, peer_update)
+    if not peer_update.model_fields_set & {"is_enabled", "policy_id"}:
+        return peer
+    # The data plane only changes with the peer's state or policy
+    return await provision(
+        f"update peer {peer_id}", background, PeerInDB.model_validate(peer)
+    )
 
 
-@router.post("/{peer_id}/enable", response_model=PeerInDB)
+@router.post("/{peer_id}/enable", response_model=PeerInDB, responses=ACCEPTED_RESPONSE)
 async def enable_peer(
-    peer_id: int, admin: Peer = Depends(verify_admin), db: Session = Depends(get_db)
+    peer_id: int,
+    admin: AuthenticatedPeer = Depends(verify_admin),
+    db: AsyncSession = Depends(get_async_db),
+    background: bool = BACKGROUND_QUERY,
 ):
     """Enable a peer"""
-    peer = peer_crud.toggle_peer_status(db, peer_id, True)
-    wg_server = get_wg_server()
-    sync_wireguard_peers(db, wg_server)
-    return peer
+    peer = await peer_crud.toggle_peer_status_async(db, peer_id, True)
+    return await provision(
+        f"enable peer {peer_id}", background, PeerInDB.model_validate(peer)
+    )
 
 
-@router.post("/{peer_id}/disable", response_model=PeerInDB)
+@router.post("/{peer_id}/disable", response_model=PeerInDB, responses=ACCEPTED_RESPONSE)
 async def disable_peer(
-    peer_id: int, admin: Peer = Depends(verify_admin), db: Session = Depends(get_db)
+    peer_id: int,
+    admin: AuthenticatedPeer = Depends(verify_admin),
+    db: AsyncSession = Depends(get_async_db),
+    background: bool = BACKGROUND_QUERY,
 ):
     """Disable a peer"""
-    peer = peer_crud.toggle_peer_status(db, peer_id, False)
-    wg_server = get_wg_server()
-    sync_wireguard_peers(db, wg_server)
-    return peer
+    peer = await peer_crud.toggle_peer_status_async(db, peer_id, False)
+    return await provision(
+        f"disable peer {peer_id}", background, PeerInDB.model_validate(peer)
+    )
 
 
-@router.delete("/{peer_id}", response_model=PeerInDB)
+@router.delete("/{peer_id}", response_model=PeerInDB, responses=ACCEPTED_RESPONSE)
 async def delete_peer(
-    peer_id: int, admin: Peer = Depends(verify_admin), db: Session = Depends(get_db)
+    peer_id: int,
+    admin: AuthenticatedPeer = Depends(verify_admin),
+    db: AsyncSession = Depends(get_async_db),
+    background: bool = BACKGROUND_QUERY,
 ):
     """Delete a peer and release their IP"""
-    peer = peer_crud.get_peer(db, peer_id)
-    if peer:
-        ip_manager.release_ip(db, peer_id)
-        peer_crud.delete_peer(db, peer_id)
-    wg_server = get_wg_server()
-    sync_wireguard_peers(db, wg_server)
-    return peer
+    peer = PeerInDB.model_validate(await peer_crud.get_peer_async(db, peer_id))
+    await ip_manager.release_ip_async(db, peer_id)
+    await peer_crud.delete_peer_async(db, peer_id)
+    return await provision(f"delete peer {peer_id}", background, peer)
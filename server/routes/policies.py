@@ -0,0 +1,132 @@
+"""Access policy routes"""
+
+from typing import List
+from fastapi import APIRouter, Depends
+from sqlalchemy.ext.asyncio import AsyncSession
+
+from ..crud import policy as policy_crud
+from ..database.session import get_async_db
+from ..schemas.peer import PeerBulkResult
+from ..schemas.policy import PolicyCreate, PolicyInDB, PolicyPeers, PolicyUpdate
+from ..services.auth_cache import AuthenticatedPeer
+from ..services.policies import policy_engine
+from .peers import (
+    ACCEPTED_RESPONSE,
+    BACKGROUND_QUERY,
+    _id_results,
+    provision,
+    verify_admin,
+)
+
+router = APIRouter()
+
+
+@router.post("/", response_model=PolicyInDB)
+async def create_policy(
+    policy: PolicyCreate,
+    admin: AuthenticatedPeer = Depends(verify_admin),
+    db: AsyncSession = Depends(get_async_db),
+):
+    """Create a policy; it applies to no peer until peers are added to it"""
+    return await policy_crud.create_policy_async(db, policy)
+
+
+@router.get("/", response_model=List[PolicyInDB])
+async def list_policies(
+    admin: AuthenticatedPeer = Depends(verify_admin),
+    db: AsyncSession = Depends(get_async_db),
+):
+    """List every policy"""
+    return await policy_crud.get_policies_async(db)
+
+
+@router.get("/enforcement")
+async def enforcement_stats(admin: AuthenticatedPeer = Depends(verify_admin)):
+    """Whether policies are enforced, and how many nftables updates were sent"""
+    return {
+        "enabled": policy_engine.enabled,
+        "syncs": policy_engine.syncs,
+        "statements": policy_engine.statements,
+    }
+
+
+@router.get("/{policy_id}", response_model=PolicyInDB)
+async def get_policy(
+    policy_id: int,
+    admin: AuthenticatedPeer = Depends(verify_admin),
+    db: AsyncSession = Depends(get_async_db),
+):
+    """Get specific policy"""
+    return await policy_crud.get_policy_async(db, policy_id)
+
+
+@router.put("/{policy_id}", response_model=PolicyInDB, responses=ACCEPTED_RESPONSE)
+async def update_policy(
+    policy_id: int,
+    policy_update: PolicyUpdate,
+    admin: AuthenticatedPeer = Depends(verify_admin),
+    db: AsyncSession = Depends(get_async_db),
+    background: bool = BACKGROUND_QUERY,
+):
+    """Change a policy's networks or ports, for every peer under it at once"""
+    policy = await policy_crud.update_policy_async(db, policy_id, policy_update)
+    return await provision(
+        f"update policy {policy_id}", background, PolicyInDB.model_validate(policy)
+    )
+
+
+@router.delete("/{policy_id}", response_model=PolicyInDB, responses=ACCEPTED_RESPONSE)
+async def delete_policy(
+    policy_id: int,
+    admin: AuthenticatedPeer = Depends(verify_admin),
+    db: AsyncSession = Depends(get_async_db),
+    background: bool = BACKGROUND_QUERY,
+):
+    """Delete a policy; its peers become unrestricted"""
+    policy = PolicyInDB.model_validate(
+        await policy_crud.get_policy_async(db, policy_id)
+    )
+    await policy_crud.delete_policy_async(db, policy_id)
+    return await provision(f"delete policy {policy_id}", background, policy)
+
+
+@router.post(
+    "/{policy_id}/peers", response_model=PeerBulkResult, responses=ACCEPTED_RESPONSE
+)
+async def add_policy_peers(
+    policy_id: int,
+    request: PolicyPeers,
+    admin: AuthenticatedPeer = Depends(verify_admin),
+    db: AsyncSession = Depends(get_async_db),
+    background: bool = BACKGROUND_QUERY,
+):
+    """Put peers under a policy, replacing any policy they had"""
+    await policy_crud.get_policy_async(db, policy_id)
+    peers = await policy_crud.set_peers_policy_async(db, request.peer_ids, policy_id)
+    result = _id_results(request.peer_ids, {peer.id for peer in peers})
+    return await provision(
+        f"add {len(peers)} peers to policy {policy_id}", background, result
+    )
+
+
+@router.post(
+    "/{policy_id}/peers/remove",
+    response_model=PeerBulkResult,
+    responses=ACCEPTED_RESPONSE,
+)
+async def remove_policy_peers(
+    policy_id: int,
+    request: PolicyPeers,
+    admin: AuthenticatedPeer = Depends(verify_admin),
+    db: AsyncSession = Depends(get_async_db),
+    background: bool = BACKGROUND_QUERY,
+):
+    """Lift a policy from some of its peers"""
+    await policy_crud.get_policy_async(db, policy_id)
+    peers = await policy_crud.set_peers_policy_async(
+        db, request.peer_ids, None, only_from=policy_id
+    )
+    result = _id_results(request.peer_ids, {peer.id for peer in peers})
+    return await provision(
+        f"remove {len(peers)} peers from policy {policy_id}", background, result
+    )
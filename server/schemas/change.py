@@ -0,0 +1,28 @@
+"""Pydantic models for the change feed"""
+
+from datetime import datetime
+from typing import Optional
+from pydantic import BaseModel
+
+
+class ChangeEntry(BaseModel):
+    """One change of a peer or of an IP allocation"""
+
+    rev: int
+    # peer.created, peer.updated, peer.enabled, peer.disabled, peer.deleted,
+    # ip.allocated or ip.released
+    kind: str
+    peer_id: Optional[int] = None
+    # The peer as GET /api/peers/{id} returns it, or the address for ip.*
+    data: dict
+    time: datetime
+
+
+class ChangePage(BaseModel):
+    """Changes after a revision, oldest first"""
+
+    changes: list[ChangeEntry]
+    # Revision to pass as `since` for the following changes
+    next: int
+    # More changes are waiting beyond this page
+    more: bool
@@ -4,12 +4,16 @@ from datetime import datetime
 from typing import Optional
 from pydantic import BaseModel, Field
 
+# Largest number of codes minted by one request
+MAX_MINT_BATCH = 10_000
+
 class InviteBase(BaseModel):
     """Base invite schema"""
 
     code: str = Field(..., min_length=1, max_length=64)
     expires_at: Optional[datetime] = None
     description: Optional[str] = None
+    uses_left: int = Field(1, ge=0)
     used_by: Optional[int] = None
 
 class InviteCreate(InviteBase):
@@ -22,8 +26,28 @@ class InviteUpdate(BaseModel):
 
     description: Optional[str] = None
     expires_at: Optional[datetime] = None
+    uses_left: Optional[int] = Field(None, ge=0)
     used_by: Optional[int] = None
 
+class InviteMint(BaseModel):
+    """Schema for minting a batch of invite codes"""
+
+    count: int = Field(1, ge=1, le=MAX_MINT_BATCH)
+    # registrations each code allows
+    uses: int = Field(1, ge=1)
+    # UTC; expires_in (seconds from now) takes precedence
+    expires_at: Optional[datetime] = None
+    expires_in: Optional[int] = Field(None, gt=0)
+    description: Optional[str] = None
+
+class InviteBatch(BaseModel):
+    """Schema returned for a minted batch"""
+
+    count: int
+    uses: int
+    expires_at: Optional[datetime] = None
+    codes: list[str]
+
 class InviteInDB(InviteBase):
     """Schema for invite information from database"""
 
@@ -0,0 +1,31 @@
+"""Pydantic models for background provisioning jobs"""
+
+from datetime import datetime
+from typing import Any, Optional
+from pydantic import BaseModel
+
+
+class JobInfo(BaseModel):
+    """State of a WireGuard provisioning job"""
+
+    id: str
+    status: str
+    reason: str
+    created_at: datetime
+    finished_at: Optional[datetime] = None
+    # Number of update requests applied together with this one
+    batch_size: int = 0
+    # Peer additions, updates and removals the batch applied
+    ops: int = 0
+    error: Optional[str] = None
+
+    class Config:
+        # Allow job objects to be passed to Pydantic models
+        from_attributes = True
+
+
+class JobAccepted(BaseModel):
+    """Response of a request whose WireGuard update runs in the background"""
+
+    job: JobInfo
+    result: Any
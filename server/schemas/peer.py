@@ -4,6 +4,9 @@ from datetime import datetime
 from typing import Optional
 from pydantic import BaseModel, Field
 
+# Largest number of items accepted by one bulk request
+MAX_BULK_ITEMS = 10_000
+
 
 class PeerBase(BaseModel):
     """Base peer schema"""
@@ -23,20 +26,28 @@ class PeerCreate(PeerBase):
     pass
 
 
+class PeerRegister(PeerCreate):
+    """Schema for self-registration, which may be gated by an invite code"""
+
+    invite_code: Optional[str] = Field(None, min_length=1, max_length=64)
+
+
 class PeerUpdate(BaseModel):
     """Schema for updating a peer"""
 
     description: Optional[str] = None
     is_enabled: Optional[bool] = None
+    # An explicit null removes the peer's policy
+    policy_id: Optional[int] = None
 
 
 class PeerInDB(PeerBase):
     """Schema for peer information from database"""
 
     id: int
-    api_key: str
     is_enabled: bool
     is_admin: bool
+    policy_id: Optional[int] = None
     last_seen: Optional[datetime] = None
     created_at: datetime
     last_modified: datetime
@@ -44,3 +55,39 @@ class PeerInDB(PeerBase):
     class Config:
         # Allow ORM models to be passed to Pydantic models
         from_attributes = True
+
+
+class PeerRegistered(PeerInDB):
+    """Schema returned once at registration, the only time the API key is visible"""
+
+    api_key: str
+
+
+class PeerBulkCreate(BaseModel):
+    """Schema for registering many peers in one request"""
+
+    peers: list[PeerCreate] = Field(..., min_length=1, max_length=MAX_BULK_ITEMS)
+
+
+class PeerBulkIds(BaseModel):
+    """Schema for enabling, disabling or deleting many peers in one request"""
+
+    peer_ids: list[int] = Field(..., min_length=1, max_length=MAX_BULK_ITEMS)
+
+
+class PeerBulkItem(BaseModel):
+    """Outcome of one item of a bulk request, in request order"""
+
+    index: int
+    ok: bool
+    peer_id: Optional[int] = None
+    error: Optional[str] = None
+    peer: Optional[PeerRegistered] = None
+
+
+class PeerBulkResult(BaseModel):
+    """Per-item outcomes of a bulk request"""
+
+    succeeded: int
+    failed: int
+    results: list[PeerBulkItem]
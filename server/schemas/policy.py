@@ -0,0 +1,78 @@
+"""Pydantic models for access policies"""
+
+import ipaddress
+from datetime import datetime
+from typing import Annotated, Optional
+from pydantic import BaseModel, Field, field_validator
+
+from .peer import MAX_BULK_ITEMS
+
+# Networks or ports one policy may list
+MAX_POLICY_ENTRIES = 1000
+
+Port = Annotated[int, Field(ge=1, le=65535)]
+
+
+def _normalize_cidrs(cidrs: Optional[list[str]]) -> Optional[list[str]]:
+    """Parse IPv4 networks and merge overlapping ones, as nftables interval sets require"""
+    if cidrs is None:
+        return None
+    try:
+        networks = [ipaddress.IPv4Network(cidr, strict=False) for cidr in cidrs]
+    except ValueError as e:
+        raise ValueError(f"Invalid IPv4 network: {e}") from e
+    return [str(network) for network in ipaddress.collapse_addresses(networks)]
+
+
+def _normalize_ports(ports: Optional[list[int]]) -> Optional[list[int]]:
+    return None if ports is None else sorted(set(ports))
+
+
+class PolicyBase(BaseModel):
+    """Base policy schema"""
+
+    name: str = Field(..., min_length=1, max_length=64)
+    allowed_cidrs: list[str] = Field(..., min_length=1, max_length=MAX_POLICY_ENTRIES)
+    # TCP/UDP destination ports; empty allows every port
+    allowed_ports: list[Port] = Field(
+        default_factory=list, max_length=MAX_POLICY_ENTRIES
+    )
+
+    _cidrs = field_validator("allowed_cidrs")(_normalize_cidrs)
+    _ports = field_validator("allowed_ports")(_normalize_ports)
+
+
+class PolicyCreate(PolicyBase):
+    """Schema for creating a policy"""
+
+    pass
+
+
+class PolicyUpdate(BaseModel):
+    """Schema for updating a policy"""
+
+    name: Optional[str] = Field(None, min_length=1, max_length=64)
+    allowed_cidrs: Optional[list[str]] = Field(
+        None, min_length=1, max_length=MAX_POLICY_ENTRIES
+    )
+    allowed_ports: Optional[list[Port]] = Field(None, max_length=MAX_POLICY_ENTRIES)
+
+    _cidrs = field_validator("allowed_cidrs")(_normalize_cidrs)
+    _ports = field_validator("allowed_ports")(_normalize_ports)
+
+
+class PolicyInDB(PolicyBase):
+    """Schema for policy information from database"""
+
+    id: int
+    created_at: datetime
+    last_modified: datetime
+
+    class Config:
+        from_attributes = True
+
+
+class PolicyPeers(BaseModel):
+    """Schema for adding peers to or removing them from a policy"""
+
+    peer_ids: list[int] = Field(..., min_length=1, max_length=MAX_BULK_ITEMS)
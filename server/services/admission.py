@@ -0,0 +1,169 @@
+"""Admission control: token-bucket rate limits and a cap on expensive requests"""
+
+import math
+import threading
+import time
+from collections import OrderedDict
+from typing import Optional
+
+from fastapi import HTTPException, Request
+
+from .. import config
+from ..database.models import Peer
+from .metrics import ADMISSION_REJECTED, route_template
+
+# Budgets whose requests also count against the concurrency cap
+EXPENSIVE = ("register", "bulk")
+
+
+class TokenBucket:
+    """`burst` tokens refilled at `rate` per second"""
+
+    __slots__ = ("tokens", "stamp")
+
+    def __init__(self, burst: float, now: float):
+        self.tokens = burst
+        self.stamp = now
+
+
+class RateLimiter:
+    """Token buckets by key, the least recently used dropped beyond `max_keys`
+
+    A dropped bucket comes back full, which only ever errs on the side of
+    letting a request through.
+    """
+
+    def __init__(
+        self, rate: float, burst: float, max_keys: int = config.RATE_LIMIT_MAX_KEYS
+    ):
+        self.rate = rate
+        self.burst = burst
+        self.max_keys = max_keys
+        self._buckets: OrderedDict[str, TokenBucket] = OrderedDict()
+        self._lock = threading.Lock()
+
+    def acquire(self, key: str, now: Optional[float] = None) -> float:
+        """Take a token for `key`: 0 if granted, else seconds until one is available"""
+        now = time.monotonic() if now is None else now
+        with self._lock:
+            bucket = self._buckets.get(key)
+            if bucket is None:
+                bucket = self._buckets[key] = TokenBucket(self.burst, now)
+                if len(self._buckets) > self.max_keys:
+                    self._buckets.popitem(last=False)
+            else:
+                self._buckets.move_to_end(key)
+                bucket.tokens = min(
+                    self.burst, bucket.tokens + (now - bucket.stamp) * self.rate
+                )
+                bucket.stamp = now
+            if bucket.tokens >= 1:
+                bucket.tokens -= 1
+                return 0.0
+            return (1 - bucket.tokens) / self.rate
+
+    def __len__(self) -> int:
+        return len(self._buckets)
+
+
+class ConcurrencyLimit:
+    """At most `limit` holders at once; the rest are turned away, not queued"""
+
+    def __init__(self, limit: int):
+        self.limit = limit
+        self.active = 0
+        self._lock = threading.Lock()
+
+    def try_acquire(self) -> bool:
+        with self._lock:
+            if self.active >= self.limit:
+                return False
+            self.active += 1
+            return True
+
+    def release(self) -> None:
+        with self._lock:
+            self.active -= 1
+
+
+def parse_budget(value: str) -> tuple[float, float]:
+    """Parse "<requests per second>/<burst>" """
+    rate, _, burst = value.partition("/")
+    return float(rate), float(burst or rate)
+
+
+def budget_for(method: str, template: str) -> str:
+    """Name of the rate budget a route draws from"""
+    if template.endswith("/register"):
+        return "register"
+    if "/bulk/" in template:
+        return "bulk"
+    return "read" if method in ("GET", "HEAD") else "write"
+
+
+class Admission:
+    """Per-route rate budgets, counted per client IP and per API key
+
+    A request needs a token from its IP's bucket and, when it carries an
+    API key, from that key's bucket too; short of one it gets a 429.
+    Registrations and bulk requests also need one of the slots of the
+    concurrency cap, or get a 503, so a retry storm cannot queue up
+    writes and interface rebuilds behind everyone else's requests.
+    """
+
+    def __init__(
+        self,
+        budgets: Optional[dict[str, tuple[float, float]]] = None,
+        max_expensive: int = config.MAX_EXPENSIVE_REQUESTS,
+        enabled: bool = config.RATE_LIMITS_ENABLED,
+    ):
+        self.enabled = enabled
+        budgets = budgets or {
+            name: parse_budget(value) for name, value in config.RATE_LIMITS.items()
+        }
+        self.by_ip = {name: RateLimiter(*budget) for name, budget in budgets.items()}
+        self.by_key = {name: RateLimiter(*budget) for name, budget in budgets.items()}
+        self.expensive = ConcurrencyLimit(max_expensive)
+
+    def reject(self, status_code: int, budget: str, reason: str, retry_after: float):
+        ADMISSION_REJECTED.inc(budget=budget, reason=reason)
+        raise HTTPException(
+            status_code=status_code,
+            detail="Too many requests" if status_code == 429 else "Server busy",
+            headers={"Retry-After": str(max(1, math.ceil(retry_after)))},
+        )
+
+    def check_rate(self, request: Request) -> str:
+        """Charge the request to its budgets, returning the budget name"""
+        budget = budget_for(request.method, route_template(request.scope) or "")
+        keys = []
+        if request.client:
+            keys.append((self.by_ip[budget], request.client.host))
+        api_key = request.headers.get("x-api-key")
+        if api_key:
+            keys.append((self.by_key[budget], Peer.hash_api_key(api_key)))
+        for limiter, key in keys:
+            wait = limiter.acquire(key)
+            if wait:
+                self.reject(429, budget, "rate", wait)
+        return budget
+
+
+admission = Admission()
+
+
+async def admit(request: Request):
+    """Dependency applying admission control to a route"""
+    if not admission.enabled:
+        yield
+        return
+    budget = admission.check_rate(request)
+    if budget not in EXPENSIVE:
+        yield
+        return
+    if not admission.expensive.try_acquire():
+        admission.reject(503, budget, "concurrency", 1)
+    try:
+        yield
+    finally:
+        admission.expensive.release()
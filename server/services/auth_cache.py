@@ -0,0 +1,84 @@
+"""In-process cache of authenticated API keys"""
+
+import threading
+import time
+from collections import OrderedDict
+from typing import Optional
+
+# Seconds an entry is trusted before the peer is looked up again
+AUTH_CACHE_TTL = 60.0
+# Maximum number of cached keys, least recently used are evicted first
+AUTH_CACHE_SIZE = 10_000
+
+
+class AuthenticatedPeer:
+    """The parts of an enabled peer that authorization needs"""
+
+    __slots__ = ("id", "name", "is_admin")
+
+    def __init__(self, id: int, name: str, is_admin: bool):
+        self.id = id
+        self.name = name
+        self.is_admin = is_admin
+
+
+class AuthCache:
+    """TTL + LRU cache mapping API key hashes to authenticated peers"""
+
+    def __init__(self, ttl: float = AUTH_CACHE_TTL, max_size: int = AUTH_CACHE_SIZE):
+        self.ttl = ttl
+        self.max_size = max_size
+        self.hits = 0
+        self.misses = 0
+        self._lock = threading.Lock()
+        # key hash -> (expiry, peer)
+        self._entries: OrderedDict[str, tuple[float, AuthenticatedPeer]] = OrderedDict()
+        # peer id -> key hash, so mutations can invalidate by peer
+        self._by_peer: dict[int, str] = {}
+
+    def get(self, key_hash: str) -> Optional[AuthenticatedPeer]:
+        """Return the cached peer for a key hash, or None on miss/expiry"""
+        with self._lock:
+            entry = self._entries.get(key_hash)
+            if entry is None or entry[0] < time.monotonic():
+                if entry is not None:
+                    self._evict(key_hash)
+                self.misses += 1
+                return None
+            self._entries.move_to_end(key_hash)
+            self.hits += 1
+            return entry[1]
+
+    def put(self, key_hash: str, peer: AuthenticatedPeer) -> None:
+        """Cache an authenticated peer"""
+        with self._lock:
+            self._entries[key_hash] = (time.monotonic() + self.ttl, peer)
+            self._entries.move_to_end(key_hash)
+            self._by_peer[peer.id] = key_hash
+            while len(self._entries) > self.max_size:
+                self._evict(next(iter(self._entries)))
+
+    def invalidate_peer(self, peer_id: int) -> None:
+        """Drop the entry for a peer that was changed or deleted"""
+        with self._lock:
+            key_hash = self._by_peer.get(peer_id)
+            if key_hash is not None:
+                self._evict(key_hash)
+
+    def clear(self) -> None:
+        """Drop every entry"""
+        with self._lock:
+            self._entries.clear()
+            self._by_peer.clear()
+
+    def stats(self) -> dict:
+        """Hit/miss counters and current size"""
+        return {"hits": self.hits, "misses": self.misses, "size": len(self._entries)}
+
+    def _evict(self, key_hash: str) -> None:
+        _, peer = self._entries.pop(key_hash)
+        if self._by_peer.get(peer.id) == key_hash:
+            del self._by_peer[peer.id]
+
+
+auth_cache = AuthCache()
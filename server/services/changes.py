@@ -0,0 +1,298 @@
+"""Append-only log of peer and IP allocation changes, for clients to sync from"""
+
+import asyncio
+import itertools
+import threading
+from collections import deque
+from datetime import datetime
+from typing import Optional
+
+from fastapi.encoders import jsonable_encoder
+from sqlalchemy import Connection, delete, event, func, insert, inspect, select, text
+from sqlalchemy.ext.asyncio import AsyncSession
+from sqlalchemy.orm import Session
+
+from .. import config
+from ..database.models import Change, IPAllocation, Peer
+from ..database.session import AppSession
+from ..schemas.peer import PeerInDB
+from .peer_registry import peer_registry
+
+# Key under Session.info where changes wait for the transaction to commit
+PENDING_KEY = "change_feed_pending"
+
+# Key of the PostgreSQL advisory lock ordering revisions by commit
+ADVISORY_LOCK_KEY = 0x61737066
+
+INSERT_CHANGES = insert(Change).returning(Change.id, sort_by_parameter_order=True)
+
+# The log is trimmed to its retention whenever a multiple of this many
+# revisions is crossed
+PRUNE_EVERY = 1000
+
+
+class RevisionGone(Exception):
+    """The requested revision is no longer, or not yet, in the log"""
+
+
+class ChangeFeed:
+    """Committed changes by revision, with waiters for new ones
+
+    Changes are written to the `changes` table in the transaction making
+    them, so revisions survive restarts and every worker reads one log.
+    The latest entries committed by this process are also kept in memory:
+    reads from a recent revision and wake-ups need no query. With several
+    workers (`peer_registry.shared`) other processes' commits are only in
+    the table, so reads query it and waiters poll it.
+    """
+
+    def __init__(
+        self,
+        tail_size: int = config.CHANGES_TAIL,
+        retention: int = config.CHANGES_RETENTION,
+    ):
+        self.retention = retention
+        self.loaded = False
+        self.latest = 0
+        self.oldest = 1
+        # Entries of revisions latest - len + 1 .. latest, without gaps
+        self._tail: deque[dict] = deque(maxlen=tail_size)
+        self._lock = threading.Lock()
+        self._waiters: set[tuple[asyncio.AbstractEventLoop, asyncio.Event]] = set()
+
+    def load(self, db: Session) -> None:
+        """Start from the revisions in the table"""
+        oldest, latest = db.execute(
+            select(func.min(Change.id), func.max(Change.id))
+        ).one()
+        with self._lock:
+            self.latest = latest or 0
+            self.oldest = oldest or self.latest + 1
+            self._tail.clear()
+            self.loaded = True
+
+    def clear(self) -> None:
+        with self._lock:
+            self._tail.clear()
+            self.latest = 0
+            self.oldest = 1
+            self.loaded = False
+
+    @property
+    def _tail_start(self) -> int:
+        return self.latest - len(self._tail) + 1
+
+    async def bounds(self, db: AsyncSession) -> tuple[int, int]:
+        """Oldest and latest revision in the log"""
+        if not peer_registry.shared:
+            return self.oldest, self.latest
+        oldest, latest = (
+            await db.execute(select(func.min(Change.id), func.max(Change.id)))
+        ).one()
+        # Only a short query; idle clients must not hold pooled connections
+        await db.close()
+        latest = latest or 0
+        return oldest or latest + 1, latest
+
+    async def read(self, db: AsyncSession, since: int, limit: int) -> list[dict]:
+        """Up to `limit` changes after revision `since`, oldest first
+
+        Raises RevisionGone when changes right after `since` were pruned
+        or `since` is ahead of the log (as after a database reset).
+        """
+        if not peer_registry.shared:
+            with self._lock:
+                if since > self.latest or since + 1 < self.oldest:
+                    raise RevisionGone(since)
+                if since + 1 >= self._tail_start:
+                    start = since + 1 - self._tail_start
+                    return list(itertools.islice(self._tail, start, start + limit))
+
+        oldest, latest = await self.bounds(db)
+        if since > latest or since + 1 < oldest:
+            raise RevisionGone(since)
+        rows = await db.scalars(
+            select(Change).where(Change.id > since).order_by(Change.id).limit(limit)
+        )
+        changes = [
+            _entry(row.id, row.kind, row.peer_id, row.data, row.created_at)
+            for row in rows
+        ]
+        await db.close()
+        return changes
+
+    async def wait(self, db: AsyncSession, since: int, timeout: float) -> bool:
+        """Wait up to `timeout` seconds for a change after `since`"""
+        # Nothing is read while waiting; give the connection back to the pool
+        await db.close()
+        loop = asyncio.get_running_loop()
+        deadline = loop.time() + timeout
+        while True:
+            waiter = (loop, asyncio.Event())
+            # Registered before checking, so a commit in between still wakes us
+            self._waiters.add(waiter)
+            try:
+                if (await self.bounds(db))[1] > since:
+                    return True
+                remaining = deadline - loop.time()
+                if remaining <= 0:
+                    return False
+                if peer_registry.shared:
+                    remaining = min(remaining, config.CHANGES_POLL_INTERVAL)
+                try:
+                    await asyncio.wait_for(waiter[1].wait(), remaining)
+                except asyncio.TimeoutError:
+                    pass
+            finally:
+                self._waiters.discard(waiter)
+
+    def append(self, entries: list[dict], pruned_to: int) -> None:
+        """Record entries committed by this process and wake the waiters"""
+        with self._lock:
+            for entry in entries:
+                if entry["rev"] <= self.latest:
+                    # Another thread's later commit got here first; the
+                    # table has this one, and latest must not go back
+                    continue
+                if entry["rev"] != self.latest + 1:
+                    # Another process committed in between; keep the tail gapless
+                    self._tail.clear()
+                self._tail.append(entry)
+                self.latest = entry["rev"]
+            self.oldest = max(self.oldest, pruned_to + 1)
+        for loop, wake in list(self._waiters):
+            loop.call_soon_threadsafe(wake.set)
+
+
+change_feed = ChangeFeed()
+
+
+def _entry(
+    rev: int, kind: str, peer_id: Optional[int], data: dict, time: datetime
+) -> dict:
+    return {"rev": rev, "kind": kind, "peer_id": peer_id, "data": data, "time": time}
+
+
+def _peer_data(peer: Peer) -> dict:
+    """The peer's API fields, JSON-ready; taken as they are, not validated"""
+    return jsonable_encoder(
+        {name: getattr(peer, name) for name in PeerInDB.model_fields}
+    )
+
+
+def _peer_change(peer: Peer) -> Optional[str]:
+    state = inspect(peer)
+    if state.attrs.is_enabled.history.has_changes():
+        return "peer.enabled" if peer.is_enabled else "peer.disabled"
+    # Handshake times are not worth a change of their own
+    changed = [
+        column.key
+        for column in state.mapper.column_attrs
+        if column.key != "last_seen" and state.attrs[column.key].history.has_changes()
+    ]
+    return "peer.updated" if changed else None
+
+
+def _collect(session: Session) -> list[tuple]:
+    changes = []
+    for obj in session.deleted:
+        if isinstance(obj, IPAllocation) and obj.peer_id is not None:
+            changes.append(("ip.released", obj.peer_id, {"ip_address": obj.ip_address}))
+    for obj in session.deleted:
+        if isinstance(obj, Peer):
+            changes.append(
+                (
+                    "peer.deleted",
+                    obj.id,
+                    {"id": obj.id, "name": obj.name, "public_key": obj.public_key},
+                )
+            )
+    for obj in session.new:
+        if isinstance(obj, Peer):
+            changes.append(("peer.created", obj.id, _peer_data(obj)))
+    for obj in session.dirty:
+        if isinstance(obj, Peer) and (kind := _peer_change(obj)):
+            changes.append((kind, obj.id, _peer_data(obj)))
+    for obj in (*session.new, *session.dirty):
+        if isinstance(obj, IPAllocation):
+            history = inspect(obj).attrs.peer_id.history
+            for released in history.deleted or ():
+                if released is not None:
+                    changes.append(
+                        ("ip.released", released, {"ip_address": obj.ip_address})
+                    )
+            if obj.peer_id is not None and history.has_changes():
+                changes.append(
+                    ("ip.allocated", obj.peer_id, {"ip_address": obj.ip_address})
+                )
+    return changes
+
+
+@event.listens_for(AppSession, "after_flush")
+def _collect_changes(session: Session, flush_context) -> None:
+    """Keep flushed peer and allocation changes until the transaction commits"""
+    changes = _collect(session)
+    if changes:
+        pending = session.info.setdefault(
+            PENDING_KEY, {"rows": [], "entries": [], "pruned_to": 0}
+        )
+        pending["rows"] += changes
+
+
+def _lock(connection: Connection) -> None:
+    """Hold other writers of the log until this transaction ends
+
+    Revisions are then handed out in commit order, so readers seeing one
+    can never miss an earlier revision still to be committed. SQLite has
+    one writer at a time already.
+    """
+    if connection.dialect.name == "postgresql":
+        connection.execute(
+            text("SELECT pg_advisory_xact_lock(:key)"), {"key": ADVISORY_LOCK_KEY}
+        )
+
+
+@event.listens_for(AppSession, "before_commit")
+def _log_changes(session: Session) -> None:
+    """Append the transaction's changes to the log, right before it commits"""
+    if session.in_nested_transaction():
+        return
+    # Commit flushes only after this hook; flush first to log everything
+    session.flush()
+    pending = session.info.get(PENDING_KEY)
+    if not pending or not pending["rows"]:
+        return
+    now = datetime.utcnow()
+    rows = [
+        {"kind": kind, "peer_id": peer_id, "data": data, "created_at": now}
+        for kind, peer_id, data in pending["rows"]
+    ]
+    pending["rows"] = []
+    connection = session.connection()
+    _lock(connection)
+    revs = connection.execute(INSERT_CHANGES, rows).scalars().all()
+
+    if revs[-1] // PRUNE_EVERY != (revs[0] - 1) // PRUNE_EVERY:
+        cutoff = revs[-1] - change_feed.retention
+        if cutoff > 0:
+            connection.execute(delete(Change).where(Change.id <= cutoff))
+            pending["pruned_to"] = cutoff
+    pending["entries"] += [
+        _entry(rev, row["kind"], row["peer_id"], row["data"], now)
+        for rev, row in zip(revs, rows)
+    ]
+
+
+@event.listens_for(AppSession, "after_commit")
+def _publish(session: Session) -> None:
+    if session.in_nested_transaction():
+        # Only a savepoint was released; the transaction is still open
+        return
+    pending = session.info.pop(PENDING_KEY, None)
+    if pending and change_feed.loaded:
+        change_feed.append(pending["entries"], pending["pruned_to"])
+
+
+@event.listens_for(AppSession, "after_rollback")
+def _discard(session: Session) -> None:
+    session.info.pop(PENDING_KEY, None)
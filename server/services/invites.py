@@ -0,0 +1,70 @@
+"""Background deletion of expired invites"""
+
+import asyncio
+from datetime import datetime
+from typing import Callable, Optional
+
+from sqlalchemy.orm import Session
+
+from .. import config
+from ..crud.invite import delete_expired_invites
+
+
+class InviteSweeper:
+    """Deletes expired invites every `interval` seconds
+
+    Each batch of `batch_size` is its own transaction, so registrations
+    redeeming codes never wait behind one long delete of a whole campaign.
+    """
+
+    def __init__(
+        self,
+        interval: float = config.INVITE_SWEEP_INTERVAL,
+        batch_size: int = config.INVITE_SWEEP_BATCH,
+        session_factory: Optional[Callable[[], Session]] = None,
+    ):
+        self.interval = interval
+        self.batch_size = batch_size
+        self.session_factory = session_factory
+        self.deleted = 0
+        self._task: Optional[asyncio.Task] = None
+
+    def sweep(self, now: Optional[datetime] = None) -> int:
+        """Delete every invite expired by `now`, returning how many"""
+        now = now or datetime.utcnow()
+        total = 0
+        while True:
+            with self.session_factory() as session:
+                deleted = delete_expired_invites(session, now, self.batch_size)
+            total += deleted
+            if deleted < self.batch_size:
+                break
+        self.deleted += total
+        if total:
+            print(f"[server]: Deleted {total} expired invites")
+        return total
+
+    def start(self) -> None:
+        """Start sweeping on the running event loop"""
+        self._task = asyncio.get_running_loop().create_task(self._run())
+
+    async def stop(self) -> None:
+        if self._task is None:
+            return
+        self._task.cancel()
+        try:
+            await self._task
+        except asyncio.CancelledError:
+            pass
+        self._task = None
+
+    async def _run(self) -> None:
+        while True:
+            try:
+                await asyncio.to_thread(self.sweep)
+            except Exception as e:  # try again next time, e.g. on a locked database
+                print(f"[server]: Sweeping expired invites failed: {e}")
+            await asyncio.sleep(self.interval)
+
+
+invite_sweeper = InviteSweeper()
@@ -1,9 +1,92 @@
 """IP address management service"""
 
 import ipaddress
-from typing import Optional
+import threading
+from collections import deque
+from typing import Iterable, Optional, Union
+from sqlalchemy import select
+from sqlalchemy.exc import IntegrityError
+from sqlalchemy.ext.asyncio import AsyncSession
 from sqlalchemy.orm import Session
 from ..database.models import IPAllocation
+from .peer_registry import peer_registry
+
+# How many addresses a caller may lose to other processes before giving up
+MAX_CLAIM_ATTEMPTS = 16
+
+
+class AddressPool:
+    """In-memory free-list of host addresses, tracked as offsets into the network
+
+    Addresses are handed out from a cursor that only moves forward, so a
+    fresh pool never materializes its hosts (an IPv6 /64 costs nothing up
+    front). Released offsets go on a free-list and are reused first. Only
+    allocated offsets are stored, so memory grows with peers, not pool size.
+    """
+
+    def __init__(self, network: Union[ipaddress.IPv4Network, ipaddress.IPv6Network]):
+        self.network = network
+        first, last = int(network.network_address), int(network.broadcast_address)
+        if isinstance(network, ipaddress.IPv4Network) and network.prefixlen < 31:
+            # Skip the network and broadcast addresses
+            first, last = first + 1, last - 1
+        elif isinstance(network, ipaddress.IPv6Network) and network.prefixlen < 127:
+            # Skip the Subnet-Router anycast address
+            first += 1
+        self._first = first
+        self.size = last - first + 1
+
+        self._lock = threading.Lock()
+        self._taken: set[int] = set()
+        self._free: deque[int] = deque()
+        self._cursor = 0
+
+    def offset(self, ip: str) -> int:
+        """Offset of `ip` within the pool"""
+        offset = int(ipaddress.ip_address(ip)) - self._first
+        if not 0 <= offset < self.size:
+            raise ValueError(f"{ip} is outside {self.network}")
+        return offset
+
+    def address(self, offset: int) -> str:
+        """Address at `offset` within the pool"""
+        return str(ipaddress.ip_address(self._first + offset))
+
+    def reset(self, taken: Iterable[int]) -> None:
+        """Replace the pool state with the given allocated offsets"""
+        with self._lock:
+            self._taken = set(taken)
+            self._free.clear()
+            self._cursor = 0
+
+    def claim(self) -> int:
+        """Atomically take a free offset"""
+        with self._lock:
+            while self._free:
+                offset = self._free.popleft()
+                if offset not in self._taken:
+                    self._taken.add(offset)
+                    return offset
+            # Each offset is stepped over at most once, so this is amortized O(1)
+            while self._cursor < self.size:
+                offset = self._cursor
+                self._cursor += 1
+                if offset not in self._taken:
+                    self._taken.add(offset)
+                    return offset
+        raise RuntimeError("No available IP addresses")
+
+    def release(self, offset: int) -> None:
+        """Return an offset to the free-list"""
+        with self._lock:
+            if offset in self._taken:
+                self._taken.remove(offset)
+                self._free.append(offset)
+
+    @property
+    def allocated(self) -> int:
+        """Number of offsets currently allocated"""
+        return len(self._taken)
 
 
 class IPManager:
@@ -12,27 +95,73 @@ class IPManager:
     def __init__(self, network_cidr: str, server_ip: Optional[str] = None):
         self.network = ipaddress.ip_network(network_cidr)
         self.server_ip = server_ip or str(next(self.network.hosts()))
+        self.pool = AddressPool(self.network)
+        self._loaded = False
 
     def initialize_ip_pool(self, db: Session) -> None:
         """Initialize IP allocation table with server IP reserved"""
-        # Reserve server IP
-        allocation = IPAllocation(ip_address=self.server_ip, is_reserved=True)
-        db.add(allocation)
-        db.commit()
+        self.reserve_server_ip(db)
+        self.load(db)
+
+    def reserve_server_ip(self, db: Session) -> None:
+        """Record the server IP as reserved, unless a previous start already did"""
+        if not self._is_allocated(db, self.server_ip):
+            db.add(IPAllocation(ip_address=self.server_ip, is_reserved=True))
+            try:
+                db.commit()
+            except IntegrityError:
+                db.rollback()
+
+    def load(self, db: Session) -> None:
+        """Build the in-memory pool from the allocation table"""
+        self.reset_pool(ip for (ip,) in db.query(IPAllocation.ip_address))
+
+    async def load_async(self, db: AsyncSession) -> None:
+        """Build the in-memory pool from the allocation table"""
+        self.reset_pool(await db.scalars(select(IPAllocation.ip_address)))
+
+    def reset_pool(self, allocated_ips: Iterable[str]) -> None:
+        """Rebuild the pool from allocated addresses, ignoring other networks"""
+        offsets = [self.pool.offset(self.server_ip)]
+        for ip_address in allocated_ips:
+            try:
+                offsets.append(self.pool.offset(ip_address))
+            except ValueError:
+                continue
+        self.pool.reset(offsets)
+        self._loaded = True
+
+    @property
+    def peer_count(self) -> int:
+        """Addresses allocated to peers, i.e. excluding the server's"""
+        return max(self.pool.allocated - 1, 0)
 
     def allocate_ip(self, db: Session, peer_id: int) -> str:
         """Allocate next available IP address"""
-        # Get all allocated IPs
-        allocated_ips = {alloc.ip_address for alloc in db.query(IPAllocation).all()}
-
-        # Find first available IP
-        for ip in self.network.hosts():
-            ip_str = str(ip)
-            if ip_str not in allocated_ips:
-                allocation = IPAllocation(ip_address=ip_str, peer_id=peer_id)
-                db.add(allocation)
+        if not self._loaded:
+            self.load(db)
+
+        for _ in range(MAX_CLAIM_ATTEMPTS):
+            offset = self._claim(db)
+            ip_str = self.pool.address(offset)
+            try:
+                # A conflict only undoes the savepoint: objects the caller
+                # committed before stay loaded
+                with db.begin_nested():
+                    db.add(IPAllocation(ip_address=ip_str, peer_id=peer_id))
                 db.commit()
                 return ip_str
+            except IntegrityError:
+                if not self._is_allocated(db, ip_str):
+                    # The conflict was not on the address (e.g. peer already has one)
+                    self.pool.release(offset)
+                    raise
+                # Another process claimed it after our pool was loaded; keep it
+                # marked as taken and try the next one
+                if peer_registry.shared:
+                    # Other workers allocate all the time: catch up at once
+                    # instead of colliding with each of their addresses
+                    self.load(db)
 
         raise RuntimeError("No available IP addresses")
 
@@ -42,8 +171,10 @@ class IPManager:
             db.query(IPAllocation).filter(IPAllocation.peer_id == peer_id).first()
         )
         if allocation and not allocation.is_reserved:
+            ip_address = allocation.ip_address
             db.delete(allocation)
             db.commit()
+            self.pool.release(self.pool.offset(ip_address))
 
     def get_peer_ip(self, db: Session, peer_id: int) -> Optional[str]:
         """Get IP address allocated to peer"""
@@ -51,3 +182,133 @@ class IPManager:
             db.query(IPAllocation).filter(IPAllocation.peer_id == peer_id).first()
         )
         return allocation.ip_address if allocation else None
+
+    async def allocate_ip_async(self, db: AsyncSession, peer_id: int) -> str:
+        """Allocate next available IP address"""
+        if not self._loaded:
+            await self.load_async(db)
+
+        for _ in range(MAX_CLAIM_ATTEMPTS):
+            offset = await self._claim_async(db)
+            ip_str = self.pool.address(offset)
+            try:
+                # As in allocate_ip; here an expired peer of the caller's
+                # could not even be lazy-loaded again
+                async with db.begin_nested():
+                    db.add(IPAllocation(ip_address=ip_str, peer_id=peer_id))
+                await db.commit()
+                return ip_str
+            except IntegrityError:
+                if not await self._is_allocated_async(db, ip_str):
+                    self.pool.release(offset)
+                    raise
+                if peer_registry.shared:
+                    await self.load_async(db)
+
+        raise RuntimeError("No available IP addresses")
+
+    async def allocate_many_async(
+        self, db: AsyncSession, peer_ids: list[int]
+    ) -> list[str]:
+        """Allocate one IP per peer in the current transaction, without committing
+
+        The addresses are claimed from the pool immediately. If the
+        transaction does not commit, pass them to `release_addresses`.
+        """
+        if not self._loaded or peer_registry.shared:
+            # Nothing retries conflicts here, so start from what every worker did
+            await self.load_async(db)
+
+        ips = []
+        try:
+            for _ in peer_ids:
+                ips.append(self.pool.address(self.pool.claim()))
+        except RuntimeError:
+            self.release_addresses(ips)
+            raise
+
+        db.add_all(
+            IPAllocation(ip_address=ip, peer_id=peer_id)
+            for ip, peer_id in zip(ips, peer_ids)
+        )
+        await db.flush()
+        return ips
+
+    async def deallocate_many_async(
+        self, db: AsyncSession, peer_ids: list[int]
+    ) -> list[str]:
+        """Delete the allocations of many peers in the current transaction
+
+        Returns the freed addresses; pass them to `release_addresses` once
+        the transaction has committed.
+        """
+        allocations = await db.scalars(
+            select(IPAllocation).where(
+                IPAllocation.peer_id.in_(peer_ids), IPAllocation.is_reserved.is_(False)
+            )
+        )
+        ips = []
+        for allocation in allocations:
+            ips.append(allocation.ip_address)
+            await db.delete(allocation)
+        await db.flush()
+        return ips
+
+    def release_addresses(self, ips: Iterable[str]) -> None:
+        """Return addresses to the pool"""
+        for ip in ips:
+            self.pool.release(self.pool.offset(ip))
+
+    async def release_ip_async(self, db: AsyncSession, peer_id: int) -> None:
+        """Release IP address allocated to peer"""
+        allocation = await db.scalar(
+            select(IPAllocation).where(IPAllocation.peer_id == peer_id)
+        )
+        if allocation and not allocation.is_reserved:
+            ip_address = allocation.ip_address
+            await db.delete(allocation)
+            await db.commit()
+            self.pool.release(self.pool.offset(ip_address))
+
+    async def get_peer_ip_async(self, db: AsyncSession, peer_id: int) -> Optional[str]:
+        """Get IP address allocated to peer"""
+        return await db.scalar(
+            select(IPAllocation.ip_address).where(IPAllocation.peer_id == peer_id)
+        )
+
+    def _claim(self, db: Session) -> int:
+        """Take a free offset; with several workers, reload the pool when it runs out"""
+        try:
+            return self.pool.claim()
+        except RuntimeError:
+            if not peer_registry.shared:
+                raise
+        # Addresses other workers released are still taken in this pool
+        self.load(db)
+        return self.pool.claim()
+
+    async def _claim_async(self, db: AsyncSession) -> int:
+        """Take a free offset; with several workers, reload the pool when it runs out"""
+        try:
+            return self.pool.claim()
+        except RuntimeError:
+            if not peer_registry.shared:
+                raise
+        await self.load_async(db)
+        return self.pool.claim()
+
+    @staticmethod
+    def _is_allocated(db: Session, ip_address: str) -> bool:
+        return (
+            db.query(IPAllocation.id)
+            .filter(IPAllocation.ip_address == ip_address)
+            .first()
+            is not None
+        )
+
+    @staticmethod
+    async def _is_allocated_async(db: AsyncSession, ip_address: str) -> bool:
+        allocation_id = await db.scalar(
+            select(IPAllocation.id).where(IPAllocation.ip_address == ip_address)
+        )
+        return allocation_id is not None
@@ -0,0 +1,324 @@
+"""Prometheus metrics, rendered in the text exposition format
+
+Counters, gauges and histograms are updated where things happen. Values
+that other services already keep in memory (pool occupancy, cache hits,
+peer counts) are read by collectors at scrape time, so a scrape never
+queries the database.
+"""
+
+import bisect
+import math
+import threading
+import time
+from typing import Callable, Iterable, Optional
+
+from sqlalchemy import event
+from sqlalchemy.engine import Engine
+
+# A sample: name suffix (e.g. "_bucket"), labels and value
+Sample = tuple[str, dict, float]
+
+HTTP_BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0)
+DB_BUCKETS = (0.0005, 0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0)
+RECONCILE_BUCKETS = (0.001, 0.005, 0.01, 0.05, 0.1, 0.5, 1.0, 5.0, 10.0, 30.0)
+
+
+def _format_value(value: float) -> str:
+    if math.isinf(value):
+        return "+Inf" if value > 0 else "-Inf"
+    if float(value).is_integer():
+        return str(int(value))
+    return repr(float(value))
+
+
+def _escape(value: str) -> str:
+    return value.replace("\\", "\\\\").replace('"', '\\"').replace("\n", "\\n")
+
+
+def _format_labels(labels: dict) -> str:
+    if not labels:
+        return ""
+    pairs = (f'{name}="{_escape(str(value))}"' for name, value in labels.items())
+    return "{" + ",".join(pairs) + "}"
+
+
+class Metric:
+    """A metric family with optional labels"""
+
+    type = "untyped"
+
+    def __init__(self, name: str, help: str, labelnames: Iterable[str] = ()):
+        self.name = name
+        self.help = help
+        self.labelnames = tuple(labelnames)
+        self._lock = threading.Lock()
+        self._values: dict[tuple, object] = {}
+
+    def _key(self, labels: dict) -> tuple:
+        return tuple(str(labels[name]) for name in self.labelnames)
+
+    def _labels(self, key: tuple) -> dict:
+        return dict(zip(self.labelnames, key))
+
+    def samples(self) -> list[Sample]:
+        with self._lock:
+            return [
+                ("", self._labels(key), value) for key, value in self._values.items()
+            ]
+
+
+class Counter(Metric):
+    """Monotonically increasing count"""
+
+    type = "counter"
+
+    def inc(self, amount: float = 1, **labels) -> None:
+        key = self._key(labels)
+        with self._lock:
+            self._values[key] = self._values.get(key, 0) + amount
+
+
+class Gauge(Metric):
+    """Value that goes up and down"""
+
+    type = "gauge"
+
+    def set(self, value: float, **labels) -> None:
+        with self._lock:
+            self._values[self._key(labels)] = value
+
+    def inc(self, amount: float = 1, **labels) -> None:
+        key = self._key(labels)
+        with self._lock:
+            self._values[key] = self._values.get(key, 0) + amount
+
+    def dec(self, amount: float = 1, **labels) -> None:
+        self.inc(-amount, **labels)
+
+
+class Histogram(Metric):
+    """Distribution of observed values over fixed buckets"""
+
+    type = "histogram"
+
+    def __init__(
+        self,
+        name: str,
+        help: str,
+        labelnames: Iterable[str] = (),
+        buckets: tuple = HTTP_BUCKETS,
+    ):
+        super().__init__(name, help, labelnames)
+        self.buckets = tuple(buckets)
+
+    def observe(self, value: float, **labels) -> None:
+        key = self._key(labels)
+        with self._lock:
+            state = self._values.get(key)
+            if state is None:
+                # Per-bucket counts (plus +Inf), sum
+                state = self._values[key] = [[0] * (len(self.buckets) + 1), 0.0]
+            state[0][bisect.bisect_left(self.buckets, value)] += 1
+            state[1] += value
+
+    def samples(self) -> list[Sample]:
+        with self._lock:
+            states = [
+                (key, list(counts), total)
+                for key, (counts, total) in self._values.items()
+            ]
+        samples = []
+        for key, counts, total in states:
+            samples.extend(
+                histogram_samples(self._labels(key), self.buckets, counts, total)
+            )
+        return samples
+
+
+def histogram_samples(
+    labels: dict, buckets: tuple, counts: list[int], total: float
+) -> list[Sample]:
+    """Cumulative bucket, sum and count samples from per-bucket counts"""
+    samples, cumulative = [], 0
+    for bound, count in zip((*buckets, math.inf), counts):
+        cumulative += count
+        le = "+Inf" if math.isinf(bound) else repr(float(bound))
+        samples.append(("_bucket", {**labels, "le": le}, cumulative))
+    samples.append(("_sum", labels, total))
+    samples.append(("_count", labels, cumulative))
+    return samples
+
+
+class CollectedMetric:
+    """Metric family whose samples a collector computed at scrape time"""
+
+    def __init__(self, name: str, type: str, help: str, samples: list[Sample]):
+        self.name = name
+        self.type = type
+        self.help = help
+        self._samples = samples
+
+    def samples(self) -> list[Sample]:
+        return self._samples
+
+
+class MetricsRegistry:
+    """All metrics of the process and the collectors adding to them"""
+
+    def __init__(self):
+        self._metrics: list[Metric] = []
+        self._collectors: list[Callable[[], Iterable[CollectedMetric]]] = []
+
+    def counter(self, name: str, help: str, labelnames: Iterable[str] = ()) -> Counter:
+        return self._register(Counter(name, help, labelnames))
+
+    def gauge(self, name: str, help: str, labelnames: Iterable[str] = ()) -> Gauge:
+        return self._register(Gauge(name, help, labelnames))
+
+    def histogram(
+        self,
+        name: str,
+        help: str,
+        labelnames: Iterable[str] = (),
+        buckets: tuple = HTTP_BUCKETS,
+    ) -> Histogram:
+        return self._register(Histogram(name, help, labelnames, buckets))
+
+    def add_collector(self, collector: Callable[[], Iterable[CollectedMetric]]) -> None:
+        """Register a function returning metrics computed at scrape time"""
+        self._collectors.append(collector)
+
+    def _register(self, metric):
+        self._metrics.append(metric)
+        return metric
+
+    def render(self) -> str:
+        """Every metric in the Prometheus text format"""
+        families = list(self._metrics)
+        for collector in self._collectors:
+            families.extend(collector())
+
+        lines = []
+        for family in families:
+            lines.append(f"# HELP {family.name} {family.help}")
+            lines.append(f"# TYPE {family.name} {family.type}")
+            for suffix, labels, value in family.samples():
+                lines.append(
+                    f"{family.name}{suffix}{_format_labels(labels)} {_format_value(value)}"
+                )
+        return "\n".join(lines) + "\n"
+
+
+metrics = MetricsRegistry()
+
+HTTP_REQUESTS_IN_FLIGHT = metrics.gauge(
+    "aspen_http_requests_in_flight", "Requests being handled"
+)
+HTTP_REQUEST_DURATION = metrics.histogram(
+    "aspen_http_request_duration_seconds",
+    "Time to handle a request, by route template",
+    ("method", "route", "status"),
+)
+DB_QUERY_DURATION = metrics.histogram(
+    "aspen_db_query_duration_seconds",
+    "Time spent executing database statements, by statement type",
+    ("operation",),
+    DB_BUCKETS,
+)
+WG_RECONCILE_DURATION = metrics.histogram(
+    "aspen_wg_reconcile_duration_seconds",
+    "Time to reconcile a WireGuard interface, including kernel calls",
+    ("result",),
+    RECONCILE_BUCKETS,
+)
+WG_PEER_OPS = metrics.counter(
+    "aspen_wg_peer_ops_total", "Peer operations applied to interfaces", ("op",)
+)
+
+ADMISSION_REJECTED = metrics.counter(
+    "aspen_admission_rejected_total",
+    "Requests turned away by rate limits (429) or the concurrency cap (503)",
+    ("budget", "reason"),
+)
+
+
+def route_template(scope) -> Optional[str]:
+    """Path of the matched route with its parameters, e.g. /api/peers/{peer_id}
+
+    Rebuilt from the path and the path parameters, since routes of included
+    routers do not carry their prefix.
+    """
+    if scope.get("route") is None:
+        return None
+    segments = scope["path"].split("/")
+    for name, value in (scope.get("path_params") or {}).items():
+        for index in range(len(segments) - 1, -1, -1):
+            if segments[index] == str(value):
+                segments[index] = f"{{{name}}}"
+                break
+    return "/".join(segments)
+
+
+class MetricsMiddleware:
+    """ASGI middleware timing every HTTP request
+
+    Requests are labelled with the matched route template rather than the
+    raw path, so peer ids do not create new series.
+    """
+
+    def __init__(self, app):
+        self.app = app
+
+    async def __call__(self, scope, receive, send):
+        if scope["type"] != "http":
+            await self.app(scope, receive, send)
+            return
+
+        status = 500
+
+        async def send_with_status(message):
+            nonlocal status
+            if message["type"] == "http.response.start":
+                status = message["status"]
+            await send(message)
+
+        start = time.perf_counter()
+        HTTP_REQUESTS_IN_FLIGHT.inc()
+        try:
+            await self.app(scope, receive, send_with_status)
+        finally:
+            HTTP_REQUESTS_IN_FLIGHT.dec()
+            route = route_template(scope) or "unmatched"
+            HTTP_REQUEST_DURATION.observe(
+                time.perf_counter() - start,
+                method=scope["method"],
+                route=route,
+                status=status,
+            )
+
+
+def _operation(statement: str) -> str:
+    verb = statement.lstrip().split(None, 1)[0].lower() if statement.strip() else ""
+    return verb if verb in ("select", "insert", "update", "delete") else "other"
+
+
+@event.listens_for(Engine, "before_cursor_execute")
+def _start_query_timer(conn, cursor, statement, parameters, context, executemany):
+    conn.info.setdefault("query_start", []).append(time.perf_counter())
+
+
+@event.listens_for(Engine, "after_cursor_execute")
+def _observe_query(conn, cursor, statement, parameters, context, executemany):
+    starts: Optional[list] = conn.info.get("query_start")
+    if starts:
+        DB_QUERY_DURATION.observe(
+            time.perf_counter() - starts.pop(), operation=_operation(statement)
+        )
+
+
+@event.listens_for(Engine, "handle_error")
+def _discard_query_timer(context):
+    if context.connection is not None:
+        starts = context.connection.info.get("query_start")
+        if starts:
+            starts.pop()
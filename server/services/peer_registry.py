@@ -0,0 +1,293 @@
+"""In-memory registry of peers, kept in sync with the database on commit"""
+
+import bisect
+import threading
+from datetime import datetime
+from typing import Iterable, Optional
+
+from sqlalchemy import event, select
+from sqlalchemy.ext.asyncio import AsyncSession
+from sqlalchemy.orm import Session
+
+from ..database.models import IPAllocation, Peer
+from ..database.session import AppSession
+
+# Key under Session.info where changes wait for the transaction to commit
+PENDING_KEY = "peer_registry_pending"
+
+
+class PeerRecord:
+    """Compact, read-only view of a peer and its allocated IP"""
+
+    __slots__ = (
+        "id",
+        "name",
+        "public_key",
+        "assigned_ip",
+        "description",
+        "is_enabled",
+        "is_admin",
+        "created_at",
+        "last_modified",
+        "last_seen",
+        "ip_address",
+        "policy_id",
+    )
+
+    def __init__(
+        self,
+        id: int,
+        name: str,
+        public_key: str,
+        assigned_ip: str,
+        description: Optional[str],
+        is_enabled: bool,
+        is_admin: bool,
+        created_at: datetime,
+        last_modified: datetime,
+        last_seen: Optional[datetime] = None,
+        ip_address: Optional[str] = None,
+        policy_id: Optional[int] = None,
+    ):
+        self.id = id
+        self.name = name
+        self.public_key = public_key
+        self.assigned_ip = assigned_ip
+        self.description = description
+        self.is_enabled = is_enabled
+        self.is_admin = is_admin
+        self.created_at = created_at
+        self.last_modified = last_modified
+        self.last_seen = last_seen
+        self.ip_address = ip_address
+        self.policy_id = policy_id
+
+    @classmethod
+    def from_peer(cls, peer: Peer) -> "PeerRecord":
+        return cls(
+            peer.id,
+            peer.name,
+            peer.public_key,
+            peer.assigned_ip,
+            peer.description,
+            peer.is_enabled,
+            peer.is_admin,
+            peer.created_at,
+            peer.last_modified,
+            peer.last_seen,
+            policy_id=peer.policy_id,
+        )
+
+
+class PeerRegistry:
+    """Peers indexed by id, name, public key and IP
+
+    Loaded once at startup, then updated from ORM flushes once their
+    transaction commits, so reads and WireGuard syncs need no queries.
+    Changes made with Core statements bypass the ORM and are not seen.
+
+    With several API workers each registry only sees its own process's
+    changes; `shared` is then set and reads go to the database instead.
+    """
+
+    def __init__(self):
+        self._lock = threading.RLock()
+        self.loaded = False
+        self.shared = False
+        self._reset()
+
+    def _reset(self) -> None:
+        self._by_id: dict[int, PeerRecord] = {}
+        self._by_name: dict[str, int] = {}
+        self._by_public_key: dict[str, int] = {}
+        self._by_ip: dict[str, int] = {}
+        self._ip_of: dict[int, str] = {}
+        # Sorted peer ids, for stable id-ordered listing
+        self._ids: list[int] = []
+        # Kept up to date on every change, for the peer gauges
+        self.enabled_count = 0
+
+    def load(self, db: Session) -> None:
+        """Replace the registry contents with the database state"""
+        self._load(db.execute(self._load_statement()))
+
+    async def load_async(self, db: AsyncSession) -> None:
+        """Replace the registry contents with the database state"""
+        self._load(await db.execute(self._load_statement()))
+
+    @staticmethod
+    def _load_statement():
+        return (
+            select(Peer, IPAllocation.ip_address)
+            .outerjoin(IPAllocation, IPAllocation.peer_id == Peer.id)
+            .order_by(Peer.id)
+        )
+
+    def _load(self, rows: Iterable) -> None:
+        with self._lock:
+            self._reset()
+            for peer, ip_address in rows:
+                self._upsert(PeerRecord.from_peer(peer))
+                if ip_address:
+                    self._set_ip(peer.id, ip_address)
+            self.loaded = True
+
+    def clear(self) -> None:
+        """Drop all records and mark the registry as not loaded"""
+        with self._lock:
+            self._reset()
+            self.loaded = False
+
+    # Reads
+
+    def get(self, peer_id: int) -> Optional[PeerRecord]:
+        """Get peer by ID"""
+        return self._by_id.get(peer_id)
+
+    def get_by_name(self, name: str) -> Optional[PeerRecord]:
+        """Get peer by name"""
+        return self._by_id.get(self._by_name.get(name))
+
+    def get_by_public_key(self, public_key: str) -> Optional[PeerRecord]:
+        """Get peer by WireGuard public key"""
+        return self._by_id.get(self._by_public_key.get(public_key))
+
+    def get_by_ip(self, ip_address: str) -> Optional[PeerRecord]:
+        """Get peer by allocated IP"""
+        return self._by_id.get(self._by_ip.get(ip_address))
+
+    def page(
+        self, after_id: Optional[int] = None, limit: int = 100
+    ) -> list[PeerRecord]:
+        """Peers with id greater than `after_id`, ordered by id"""
+        with self._lock:
+            start = 0 if after_id is None else bisect.bisect_right(self._ids, after_id)
+            return [
+                self._by_id[peer_id] for peer_id in self._ids[start : start + limit]
+            ]
+
+    def desired_peers(self) -> dict[str, str]:
+        """Enabled peers with an allocated IP, as public key -> ip"""
+        with self._lock:
+            return {
+                record.public_key: record.ip_address
+                for record in self._by_id.values()
+                if record.is_enabled and record.ip_address
+            }
+
+    def policy_assignments(self) -> dict[str, int]:
+        """Enabled peers with an allocated IP and a policy, as ip -> policy id"""
+        with self._lock:
+            return {
+                record.ip_address: record.policy_id
+                for record in self._by_id.values()
+                if record.is_enabled and record.ip_address and record.policy_id
+            }
+
+    def __len__(self) -> int:
+        return len(self._by_id)
+
+    def counts(self) -> dict[str, int]:
+        """Number of peers by state"""
+        with self._lock:
+            enabled = self.enabled_count
+            return {"enabled": enabled, "disabled": len(self._by_id) - enabled}
+
+    # Writes, only called with the lock held
+
+    def _upsert(self, record: PeerRecord) -> None:
+        existing = self._by_id.get(record.id)
+        if existing is None:
+            bisect.insort(self._ids, record.id)
+        else:
+            self._by_name.pop(existing.name, None)
+            self._by_public_key.pop(existing.public_key, None)
+            self.enabled_count -= existing.is_enabled
+        self.enabled_count += record.is_enabled
+        record.ip_address = self._ip_of.get(record.id)
+        self._by_id[record.id] = record
+        self._by_name[record.name] = record.id
+        self._by_public_key[record.public_key] = record.id
+
+    def _remove(self, peer_id: int) -> None:
+        record = self._by_id.pop(peer_id, None)
+        if record is None:
+            return
+        del self._ids[bisect.bisect_left(self._ids, peer_id)]
+        self.enabled_count -= record.is_enabled
+        self._by_name.pop(record.name, None)
+        self._by_public_key.pop(record.public_key, None)
+
+    def _set_ip(self, peer_id: int, ip_address: str) -> None:
+        self._release_ip(peer_id)
+        self._ip_of[peer_id] = ip_address
+        self._by_ip[ip_address] = peer_id
+        record = self._by_id.get(peer_id)
+        if record is not None:
+            record.ip_address = ip_address
+
+    def _release_ip(self, peer_id: int) -> None:
+        ip_address = self._ip_of.pop(peer_id, None)
+        if ip_address is not None and self._by_ip.get(ip_address) == peer_id:
+            del self._by_ip[ip_address]
+        record = self._by_id.get(peer_id)
+        if record is not None:
+            record.ip_address = None
+
+    def set_last_seen(self, seen: dict[str, datetime]) -> None:
+        """Record latest handshakes, given as public key -> time"""
+        with self._lock:
+            for public_key, last_seen in seen.items():
+                record = self.get_by_public_key(public_key)
+                if record is not None:
+                    record.last_seen = last_seen
+
+    def apply(self, changes: list[tuple]) -> None:
+        """Apply changes collected from committed flushes"""
+        with self._lock:
+            for change in changes:
+                kind, value = change[0], change[1]
+                if kind == "peer":
+                    self._upsert(value)
+                elif kind == "peer_deleted":
+                    self._remove(value)
+                elif kind == "ip":
+                    self._set_ip(value, change[2])
+                elif kind == "ip_released":
+                    self._release_ip(value)
+
+
+peer_registry = PeerRegistry()
+
+
+@event.listens_for(AppSession, "after_flush")
+def _collect_changes(session: Session, flush_context) -> None:
+    """Snapshot flushed peers and allocations until the transaction ends"""
+    if not peer_registry.loaded:
+        return
+
+    changes = session.info.setdefault(PENDING_KEY, [])
+    for obj in session.deleted:
+        if isinstance(obj, IPAllocation) and obj.peer_id is not None:
+            changes.append(("ip_released", obj.peer_id))
+    for obj in session.deleted:
+        if isinstance(obj, Peer):
+            changes.append(("peer_deleted", obj.id))
+    for obj in (*session.new, *session.dirty):
+        if isinstance(obj, Peer):
+            changes.append(("peer", PeerRecord.from_peer(obj)))
+    for obj in (*session.new, *session.dirty):
+        if isinstance(obj, IPAllocation) and obj.peer_id is not None:
+            changes.append(("ip", obj.peer_id, obj.ip_address))
+
+
+@event.listens_for(AppSession, "after_commit")
+def _apply_changes(session: Session) -> None:
+    changes = session.info.pop(PENDING_KEY, None)
+    if changes:
+        peer_registry.apply(changes)
+
+
+@event.listens_for(AppSession, "after_rollback")
+def _discard_changes(session: Session) -> None:
+    session.info.pop(PENDING_KEY, None)
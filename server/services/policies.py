@@ -0,0 +1,305 @@
+"""Per-peer egress policies, compiled into nftables sets and verdict maps"""
+
+import threading
+from dataclasses import dataclass, field
+from typing import Optional
+
+from sqlalchemy import event, select
+from sqlalchemy.orm import Session
+
+from .. import config
+from ..database.models import AccessPolicy
+from ..database.session import AppSession
+from ..proxy_setup import SUDO, run_command
+
+# Key under Session.info where policy changes wait for the transaction to commit
+PENDING_KEY = "policy_store_pending"
+
+# Verdict map from peer address to the chain of its policy
+PEER_MAP = "peer_policy"
+
+
+@dataclass(frozen=True)
+class PolicyRule:
+    """Destinations a policy allows, as compiled into nftables"""
+
+    cidrs: tuple[str, ...]
+    ports: tuple[int, ...] = ()
+
+    @classmethod
+    def from_policy(cls, policy: AccessPolicy) -> "PolicyRule":
+        return cls(tuple(policy.allowed_cidrs), tuple(policy.allowed_ports or ()))
+
+
+@dataclass(frozen=True)
+class PolicyState:
+    """Everything the nftables table is built from"""
+
+    # policy id -> rule
+    policies: dict[int, PolicyRule] = field(default_factory=dict)
+    # peer ip -> policy id
+    assignments: dict[str, int] = field(default_factory=dict)
+
+
+class PolicyStore:
+    """Policies by id, loaded at startup and updated from ORM commits"""
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._rules: dict[int, PolicyRule] = {}
+        self.loaded = False
+
+    def load(self, db: Session) -> None:
+        """Replace the store contents with the database state"""
+        rules = {
+            policy.id: PolicyRule.from_policy(policy)
+            for policy in db.scalars(select(AccessPolicy))
+        }
+        with self._lock:
+            self._rules = rules
+            self.loaded = True
+
+    def clear(self) -> None:
+        with self._lock:
+            self._rules = {}
+            self.loaded = False
+
+    def rules(self) -> dict[int, PolicyRule]:
+        with self._lock:
+            return dict(self._rules)
+
+    def apply(self, changes: list[tuple]) -> None:
+        """Apply changes collected from committed flushes"""
+        with self._lock:
+            for policy_id, rule in changes:
+                if rule is None:
+                    self._rules.pop(policy_id, None)
+                else:
+                    self._rules[policy_id] = rule
+
+
+policy_store = PolicyStore()
+
+
+def _chain(policy_id: int) -> str:
+    return f"policy_{policy_id}"
+
+
+def _elements(values) -> str:
+    return "{ " + ", ".join(str(value) for value in values) + " }"
+
+
+def _rules(policy_id: int, rule: PolicyRule) -> list[str]:
+    """Statements of a policy's chain"""
+    chain = _chain(policy_id)
+    allow = f"ip daddr @{chain}_nets"
+    if rule.ports:
+        allow += f" meta l4proto {{ tcp, udp }} th dport @{chain}_ports"
+    return ["ct state established,related accept", f"{allow} accept", "drop"]
+
+
+def _set_declarations(policy_id: int) -> list[tuple[str, str]]:
+    chain = _chain(policy_id)
+    return [
+        (f"{chain}_nets", "type ipv4_addr; flags interval;"),
+        (f"{chain}_ports", "type inet_service;"),
+    ]
+
+
+def _set_elements(policy_id: int, rule: PolicyRule) -> list[tuple[str, tuple]]:
+    chain = _chain(policy_id)
+    return [(f"{chain}_nets", rule.cidrs), (f"{chain}_ports", rule.ports)]
+
+
+def render_table(state: PolicyState, table: str) -> str:
+    """nft script replacing the whole table with `state`, atomically"""
+    lines = [
+        # Create-then-delete so the script works whether or not the table exists
+        f"add table inet {table}",
+        f"delete table inet {table}",
+        f"add table inet {table}",
+    ]
+    for policy_id, rule in sorted(state.policies.items()):
+        lines += _add_policy(policy_id, rule, table)
+    lines.append(f"add map inet {table} {PEER_MAP} {{ type ipv4_addr : verdict; }}")
+    if state.assignments:
+        lines.append(_add_assignments(state.assignments, table))
+    lines += [
+        f"add chain inet {table} forward"
+        " { type filter hook forward priority filter; policy accept; }",
+        # Peers without a policy miss the map and fall through to accept.
+        # WireGuard only accepts a peer's packets from its own address.
+        f"add rule inet {table} forward ip saddr vmap @{PEER_MAP}",
+    ]
+    return "\n".join(lines) + "\n"
+
+
+def _add_policy(policy_id: int, rule: PolicyRule, table: str) -> list[str]:
+    lines = [
+        f"add set inet {table} {name} {{ {spec} }}"
+        for name, spec in _set_declarations(policy_id)
+    ]
+    lines += _fill_sets(policy_id, rule, table)
+    lines.append(f"add chain inet {table} {_chain(policy_id)}")
+    lines += [
+        f"add rule inet {table} {_chain(policy_id)} {statement}"
+        for statement in _rules(policy_id, rule)
+    ]
+    return lines
+
+
+def _fill_sets(policy_id: int, rule: PolicyRule, table: str) -> list[str]:
+    return [
+        f"add element inet {table} {name} {_elements(values)}"
+        for name, values in _set_elements(policy_id, rule)
+        if values
+    ]
+
+
+def _add_assignments(assignments: dict[str, int], table: str) -> str:
+    pairs = (
+        f"{ip} : jump {_chain(policy_id)}"
+        for ip, policy_id in sorted(assignments.items())
+    )
+    return f"add element inet {table} {PEER_MAP} {_elements(pairs)}"
+
+
+def render_changes(old: PolicyState, new: PolicyState, table: str) -> str:
+    """nft script taking the table from `old` to `new`, touching only what changed
+
+    Runs as one transaction. Map elements go before the chains they jump to
+    are deleted and after the chains they jump to are added.
+    """
+    lines = []
+    stale = [
+        ip
+        for ip, policy_id in old.assignments.items()
+        if new.assignments.get(ip) != policy_id
+    ]
+    if stale:
+        lines.append(
+            f"delete element inet {table} {PEER_MAP} {_elements(sorted(stale))}"
+        )
+
+    for policy_id, rule in sorted(new.policies.items()):
+        previous = old.policies.get(policy_id)
+        if previous is None:
+            lines += _add_policy(policy_id, rule, table)
+        elif previous != rule:
+            chain = _chain(policy_id)
+            lines += [
+                f"flush set inet {table} {name}"
+                for name, _ in _set_elements(policy_id, rule)
+            ]
+            lines += _fill_sets(policy_id, rule, table)
+            lines.append(f"flush chain inet {table} {chain}")
+            lines += [
+                f"add rule inet {table} {chain} {statement}"
+                for statement in _rules(policy_id, rule)
+            ]
+
+    added = {
+        ip: policy_id
+        for ip, policy_id in new.assignments.items()
+        if old.assignments.get(ip) != policy_id
+    }
+    if added:
+        lines.append(_add_assignments(added, table))
+
+    for policy_id in sorted(old.policies.keys() - new.policies.keys()):
+        lines.append(f"delete chain inet {table} {_chain(policy_id)}")
+        lines += [
+            f"delete set inet {table} {name}"
+            for name, _ in _set_declarations(policy_id)
+        ]
+    return "\n".join(lines) + "\n" if lines else ""
+
+
+class PolicyEngine:
+    """Keeps the nftables table in line with the policies and their peers
+
+    The first sync replaces the table; later ones only send the difference
+    from what was applied last, so a change costs the same however many
+    peers there are. Classifying a packet is one verdict map lookup plus
+    set lookups, whatever the number of peers or policies.
+    """
+
+    def __init__(self, run=run_command, table: str = config.NFT_TABLE):
+        self.run = run
+        self.table = table
+        self.enabled = config.NFT_POLICIES
+        self.syncs = 0
+        self.statements = 0
+        self._applied: Optional[PolicyState] = None
+        # Syncs run from provisioner worker threads; one at a time
+        self._lock = threading.Lock()
+
+    def sync(self, policies: dict[int, PolicyRule], assignments: dict[str, int]) -> int:
+        """Apply the desired policies and assignments; returns the statements sent"""
+        state = PolicyState(
+            policies,
+            {ip: pid for ip, pid in assignments.items() if pid in policies},
+        )
+        with self._lock:
+            if state == self._applied:
+                return 0
+            if self._applied is None:
+                script = render_table(state, self.table)
+            else:
+                script = render_changes(self._applied, state, self.table)
+            try:
+                self.run(SUDO + ["nft", "-f", "-"], input=script)
+            except Exception:
+                # The transaction was rolled back; rebuild from scratch next time
+                self._applied = None
+                raise
+            self._applied = state
+            self.syncs += 1
+            count = script.count("\n")
+            self.statements += count
+            return count
+
+    def invalidate(self) -> None:
+        """Rebuild the whole table on the next sync"""
+        with self._lock:
+            self._applied = None
+
+    def remove(self) -> None:
+        """Delete the table, lifting every policy"""
+        with self._lock:
+            self.run(
+                SUDO + ["nft", "-f", "-"],
+                input=f"add table inet {self.table}\ndelete table inet {self.table}\n",
+            )
+            self._applied = None
+
+
+policy_engine = PolicyEngine()
+
+
+@event.listens_for(AppSession, "after_flush")
+def _collect_changes(session: Session, flush_context) -> None:
+    """Snapshot flushed policies until the transaction ends"""
+    if not policy_store.loaded:
+        return
+    changes = [
+        (obj.id, None) for obj in session.deleted if isinstance(obj, AccessPolicy)
+    ] + [
+        (obj.id, PolicyRule.from_policy(obj))
+        for obj in (*session.new, *session.dirty)
+        if isinstance(obj, AccessPolicy)
+    ]
+    if changes:
+        session.info.setdefault(PENDING_KEY, []).extend(changes)
+
+
+@event.listens_for(AppSession, "after_commit")
+def _apply_changes(session: Session) -> None:
+    changes = session.info.pop(PENDING_KEY, None)
+    if changes:
+        policy_store.apply(changes)
+
+
+@event.listens_for(AppSession, "after_rollback")
+def _discard_changes(session: Session) -> None:
+    session.info.pop(PENDING_KEY, None)
@@ -0,0 +1,164 @@
+"""Background queue applying WireGuard updates in coalesced batches"""
+
+import asyncio
+import uuid
+from collections import OrderedDict
+from datetime import datetime, timezone
+from typing import Callable, Optional
+
+from .. import config
+from ..wireguard import PeerChanges, get_reconciler
+from .peer_registry import peer_registry
+from .policies import policy_engine, policy_store
+from .tracing import tracer
+
+
+class ProvisioningJob:
+    """One request to bring the WireGuard interface up to date"""
+
+    __slots__ = (
+        "id",
+        "reason",
+        "status",
+        "created_at",
+        "finished_at",
+        "batch_size",
+        "ops",
+        "error",
+        "done",
+    )
+
+    def __init__(self, reason: str):
+        self.id = uuid.uuid4().hex
+        self.reason = reason
+        self.status = "queued"
+        self.created_at = datetime.now(timezone.utc)
+        self.finished_at: Optional[datetime] = None
+        self.batch_size = 0
+        self.ops = 0
+        self.error: Optional[str] = None
+        self.done = asyncio.Event()
+
+
+class Provisioner:
+    """Coalesces WireGuard update requests and applies them off the event loop
+
+    Every request only says "the desired peer set changed". The worker waits
+    `window` seconds after the first one, drains everything queued in the
+    meantime and runs a single reconcile against the peer registry for the
+    whole batch, in a worker thread. With several workers the registry only
+    holds this process's commits; the peer set is then read by
+    `load_desired` from the database.
+    """
+
+    def __init__(
+        self,
+        window: float = config.PROVISION_COALESCE_WINDOW,
+        history: int = config.PROVISION_JOB_HISTORY,
+    ):
+        self.window = window
+        self.history = history
+        self.batches = 0
+        self.requests = 0
+        self.ops = 0
+        self._jobs: OrderedDict[str, ProvisioningJob] = OrderedDict()
+        self._queue: Optional[asyncio.Queue] = None
+        self._worker: Optional[asyncio.Task] = None
+        self._loop: Optional[asyncio.AbstractEventLoop] = None
+        self.load_desired: Optional[Callable[[], dict[str, str]]] = None
+
+    def start(self) -> None:
+        """Start the worker on the running event loop"""
+        self._loop = asyncio.get_running_loop()
+        self._queue = asyncio.Queue()
+        self._worker = self._loop.create_task(self._run())
+
+    async def stop(self) -> None:
+        """Finish queued jobs, then stop the worker"""
+        if self._worker is None:
+            return
+        await self._queue.join()
+        self._worker.cancel()
+        try:
+            await self._worker
+        except asyncio.CancelledError:
+            pass
+        self._worker = None
+
+    def submit(self, reason: str) -> ProvisioningJob:
+        """Queue a WireGuard update and return its job"""
+        if self._worker is None or self._loop is not asyncio.get_running_loop():
+            self.start()
+        job = ProvisioningJob(reason)
+        self._jobs[job.id] = job
+        while len(self._jobs) > self.history:
+            self._jobs.popitem(last=False)
+        self._queue.put_nowait(job)
+        return job
+
+    async def wait(self, job: ProvisioningJob) -> ProvisioningJob:
+        """Wait for a job's batch to be applied"""
+        with tracer.span("provision.wait", job=job.id):
+            await job.done.wait()
+        return job
+
+    def get_job(self, job_id: str) -> Optional[ProvisioningJob]:
+        """Look up a recent job"""
+        return self._jobs.get(job_id)
+
+    def stats(self) -> dict:
+        """Counters showing how well updates are coalesced"""
+        return {"requests": self.requests, "batches": self.batches, "ops": self.ops}
+
+    async def _run(self) -> None:
+        while True:
+            batch = [await self._queue.get()]
+            if self.window:
+                await asyncio.sleep(self.window)
+            while not self._queue.empty():
+                batch.append(self._queue.get_nowait())
+            try:
+                await self._apply(batch)
+            finally:
+                for _ in batch:
+                    self._queue.task_done()
+
+    async def _apply(self, batch: list[ProvisioningJob]) -> None:
+        for job in batch:
+            job.status = "running"
+            job.batch_size = len(batch)
+
+        changes: Optional[PeerChanges] = None
+        error: Optional[str] = None
+        # A batch serves several requests, so it is a trace of its own
+        try:
+            with tracer.trace("provision.batch", jobs=len(batch)):
+                if peer_registry.shared and self.load_desired is not None:
+                    desired = await asyncio.to_thread(self.load_desired)
+                else:
+                    desired = peer_registry.desired_peers()
+                changes = await asyncio.to_thread(get_reconciler().reconcile, desired)
+                if policy_engine.enabled:
+                    with tracer.span("nft.sync_policies"):
+                        await asyncio.to_thread(
+                            policy_engine.sync,
+                            policy_store.rules(),
+                            peer_registry.policy_assignments(),
+                        )
+        except Exception as e:  # reported through the jobs, the worker keeps going
+            error = f"{type(e).__name__}: {e}"
+            print(f"[server]: WireGuard update failed: {error}")
+
+        self.batches += 1
+        self.requests += len(batch)
+        self.ops += changes.op_count if changes else 0
+        finished_at = datetime.now(timezone.utc)
+        for job in batch:
+            job.status = "failed" if error else "done"
+            job.error = error
+            job.ops = changes.op_count if changes else 0
+            job.finished_at = finished_at
+            job.done.set()
+
+
+provisioner = Provisioner()
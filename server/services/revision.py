@@ -0,0 +1,104 @@
+"""Revision of the peer state, for ETags and conditional GETs"""
+
+import os
+import threading
+from typing import Optional
+
+from fastapi import Request, Response
+from sqlalchemy import event
+from sqlalchemy.orm import Session
+
+from ..database.models import Invite, IPAllocation, Peer
+from ..database.session import AppSession
+from .peer_registry import peer_registry
+
+# Key under Session.info marking a transaction that changed tracked rows
+PENDING_KEY = "state_revision_pending"
+
+# Clients may keep a copy but must revalidate it before every use
+CACHE_CONTROL = "private, no-cache"
+
+TRACKED = (Peer, IPAllocation, Invite)
+
+
+class StateRevision:
+    """Counter bumped on every committed peer, allocation or invite change
+
+    ETags are the revision prefixed with a per-process epoch, so they never
+    repeat across restarts. Only this process's commits are seen: with
+    several workers (`peer_registry.shared`) no ETags are issued.
+    """
+
+    def __init__(self):
+        self.epoch = os.urandom(4).hex()
+        self.value = 0
+        self._lock = threading.Lock()
+
+    @property
+    def enabled(self) -> bool:
+        return not peer_registry.shared
+
+    @property
+    def etag(self) -> str:
+        return f'"{self.epoch}-{self.value}"'
+
+    def bump(self) -> None:
+        with self._lock:
+            self.value += 1
+
+
+state_revision = StateRevision()
+
+
+def _matches(header: str, etag: str) -> bool:
+    # Weak comparison, as If-None-Match requires
+    tags = [tag.strip().removeprefix("W/") for tag in header.split(",")]
+    return "*" in tags or etag in tags
+
+
+def check_etag(request: Request, response: Response) -> Optional[Response]:
+    """Tag `response` with the current revision; a 304 if the client has it
+
+    Call before reading any state, so a change made meanwhile gets a newer
+    ETag than the one sent with the (possibly already updated) body.
+    """
+    if not state_revision.enabled:
+        return None
+    etag = state_revision.etag
+    headers = {"ETag": etag, "Cache-Control": CACHE_CONTROL}
+    if_none_match = request.headers.get("if-none-match")
+    if if_none_match and _matches(if_none_match, etag):
+        return Response(status_code=304, headers=headers)
+    response.headers.update(headers)
+    return None
+
+
+def mark_changed(session: Session) -> None:
+    """Bump the revision when the transaction commits
+
+    For bulk statements changing tracked rows outside the unit of work,
+    which the flush hook never sees.
+    """
+    session.info[PENDING_KEY] = True
+
+
+@event.listens_for(AppSession, "after_flush")
+def _note_changes(session: Session, flush_context) -> None:
+    if session.info.get(PENDING_KEY):
+        return
+    for obj in (*session.new, *session.dirty, *session.deleted):
+        if isinstance(obj, TRACKED):
+            session.info[PENDING_KEY] = True
+            return
+
+
+@event.listens_for(AppSession, "after_commit")
+def _bump(session: Session) -> None:
+    # Registered after the peer registry's hook, so new ETags see new records
+    if session.info.pop(PENDING_KEY, False):
+        state_revision.bump()
+
+
+@event.listens_for(AppSession, "after_rollback")
+def _discard(session: Session) -> None:
+    session.info.pop(PENDING_KEY, None)
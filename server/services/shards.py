@@ -0,0 +1,260 @@
+"""WireGuard interface shards, each with its own port and address sub-pool"""
+
+import ipaddress
+import threading
+from collections import defaultdict
+from typing import Iterable, Optional
+
+from sqlalchemy import select
+from sqlalchemy.exc import IntegrityError
+from sqlalchemy.ext.asyncio import AsyncSession
+from sqlalchemy.orm import Session
+
+from .. import config
+from ..database.models import IPAllocation
+from .ip_manager import IPManager
+from .tracing import traced
+
+
+class Shard:
+    """One WireGuard interface and the subnet its peers get addresses from"""
+
+    __slots__ = ("index", "interface", "port", "network", "ip_manager")
+
+    def __init__(self, index: int, interface: str, port: int, network_cidr: str):
+        self.index = index
+        self.interface = interface
+        self.port = port
+        self.network = ipaddress.ip_network(network_cidr)
+        self.ip_manager = IPManager(network_cidr)
+
+    @property
+    def server_ip(self) -> str:
+        return self.ip_manager.server_ip
+
+    @property
+    def address(self) -> str:
+        """Interface address with prefix, e.g. 10.0.1.1/24"""
+        return f"{self.server_ip}/{self.network.prefixlen}"
+
+    @property
+    def peer_count(self) -> int:
+        return self.ip_manager.peer_count
+
+    def info(self) -> dict:
+        return {
+            "index": self.index,
+            "interface": self.interface,
+            "port": self.port,
+            "network": str(self.network),
+            "peers": self.peer_count,
+        }
+
+
+class ShardedIPManager:
+    """Allocates peer addresses across interface shards
+
+    Shard `i` is interface `wg<i>` on `base_port + i` with the `i`-th
+    `shard_prefix` subnet of `network_cidr`, so the shard of any address
+    follows from the address alone. New peers go to the least-loaded
+    shard; once every shard holds `peer_limit` peers another one is added,
+    up to `max_shards`. Exposes the same allocation methods as IPManager.
+    """
+
+    def __init__(
+        self,
+        network_cidr: str = config.WG_NETWORK,
+        shard_prefix: int = config.WG_SHARD_PREFIX,
+        base_port: int = config.WG_BASE_PORT,
+        shards: int = config.WG_SHARDS,
+        max_shards: int = config.WG_MAX_SHARDS,
+        peer_limit: int = config.WG_SHARD_PEER_LIMIT,
+        interface_prefix: str = "wg",
+    ):
+        self.network = ipaddress.ip_network(network_cidr)
+        if shard_prefix < self.network.prefixlen:
+            raise ValueError(f"Shards of /{shard_prefix} do not fit in {self.network}")
+        self.shard_size = 2 ** (self.network.max_prefixlen - shard_prefix)
+        self.shard_prefix = shard_prefix
+        self.base_port = base_port
+        self.max_shards = min(max_shards, 2 ** (shard_prefix - self.network.prefixlen))
+        self.initial_shards = min(max(shards, 1), self.max_shards)
+        self.peer_limit = peer_limit
+        self.interface_prefix = interface_prefix
+        self._lock = threading.Lock()
+        self.shards: list[Shard] = []
+        self._add_shards(self.initial_shards)
+
+    # Shard layout
+
+    def shard(self, index: int) -> Shard:
+        """Shard `index`, bringing it (and any below it) into use"""
+        if not 0 <= index < self.max_shards:
+            raise ValueError(f"No shard {index}, the limit is {self.max_shards}")
+        self._add_shards(index + 1)
+        return self.shards[index]
+
+    def shard_index(self, ip: str) -> Optional[int]:
+        """Index of the shard `ip` belongs to, or None outside the network"""
+        address = ipaddress.ip_address(ip.partition("/")[0])
+        if address not in self.network:
+            return None
+        index = (int(address) - int(self.network.network_address)) // self.shard_size
+        return index if index < self.max_shards else None
+
+    def shard_for_ip(self, ip: str) -> Optional[Shard]:
+        """Shard `ip` belongs to"""
+        index = self.shard_index(ip)
+        return None if index is None else self.shard(index)
+
+    def stats(self) -> list[dict]:
+        """Interface, port, subnet and peer count of every shard in use"""
+        return [shard.info() for shard in self.shards]
+
+    def _add_shards(self, count: int) -> None:
+        with self._lock:
+            for index in range(len(self.shards), count):
+                first = int(self.network.network_address) + index * self.shard_size
+                network = f"{ipaddress.ip_address(first)}/{self.shard_prefix}"
+                self.shards.append(
+                    Shard(
+                        index,
+                        f"{self.interface_prefix}{index}",
+                        self.base_port + index,
+                        network,
+                    )
+                )
+                if index >= self.initial_shards:
+                    print(f"[server]: Added WireGuard shard {index} ({network})")
+
+    def _place(self, loads: dict[int, int]) -> Shard:
+        """Pick the least-loaded shard, adding one when all are full"""
+        shard = min(self.shards, key=lambda shard: loads[shard.index])
+        if loads[shard.index] >= self.peer_limit and len(self.shards) < self.max_shards:
+            shard = self.shard(len(self.shards))
+            loads[shard.index] = shard.peer_count
+        return shard
+
+    def _loads(self) -> dict[int, int]:
+        return {shard.index: shard.peer_count for shard in self.shards}
+
+    # Pool state
+
+    def initialize_ip_pool(self, db: Session) -> None:
+        """Reserve the server IP of every initial shard and load the pools"""
+        for shard in self.shards:
+            shard.ip_manager.reserve_server_ip(db)
+        self.load(db)
+
+    def load(self, db: Session) -> None:
+        """Build every shard's pool from the allocation table"""
+        self._reset_pools(ip for (ip,) in db.query(IPAllocation.ip_address))
+
+    async def load_async(self, db: AsyncSession) -> None:
+        """Build every shard's pool from the allocation table"""
+        self._reset_pools(await db.scalars(select(IPAllocation.ip_address)))
+
+    def _reset_pools(self, allocated_ips: Iterable[str]) -> None:
+        by_shard = defaultdict(list)
+        for ip_address in allocated_ips:
+            index = self.shard_index(ip_address)
+            if index is not None:
+                by_shard[index].append(ip_address)
+        # Shards added automatically before a restart come back with their peers
+        if by_shard:
+            self.shard(max(by_shard))
+        for shard in self.shards:
+            shard.ip_manager.reset_pool(by_shard[shard.index])
+
+    # Allocation
+
+    def allocate_ip(self, db: Session, peer_id: int) -> str:
+        """Allocate an address on the least-loaded shard"""
+        return self._place(self._loads()).ip_manager.allocate_ip(db, peer_id)
+
+    @traced("ip.allocate")
+    async def allocate_ip_async(self, db: AsyncSession, peer_id: int) -> str:
+        """Allocate an address on the least-loaded shard"""
+        shard = self._place(self._loads())
+        return await shard.ip_manager.allocate_ip_async(db, peer_id)
+
+    @traced("ip.allocate_many")
+    async def allocate_many_async(
+        self, db: AsyncSession, peer_ids: list[int]
+    ) -> list[str]:
+        """Allocate one IP per peer in the current transaction, without committing
+
+        Peers are spread over the shards as if registered one at a time. If
+        the transaction does not commit, pass the addresses to
+        `release_addresses`.
+        """
+        loads = self._loads()
+        groups: dict[int, list[int]] = defaultdict(list)
+        for peer_id in peer_ids:
+            shard = self._place(loads)
+            groups[shard.index].append(peer_id)
+            loads[shard.index] += 1
+
+        ips_by_peer = {}
+        try:
+            for index, group in groups.items():
+                ips = await self.shards[index].ip_manager.allocate_many_async(db, group)
+                ips_by_peer.update(zip(group, ips))
+        except (RuntimeError, IntegrityError):
+            self.release_addresses(ips_by_peer.values())
+            raise
+        return [ips_by_peer[peer_id] for peer_id in peer_ids]
+
+    @traced("ip.release_many")
+    async def deallocate_many_async(
+        self, db: AsyncSession, peer_ids: list[int]
+    ) -> list[str]:
+        """Delete the allocations of many peers in the current transaction
+
+        Returns the freed addresses; pass them to `release_addresses` once
+        the transaction has committed.
+        """
+        # Allocations are looked up by peer, whatever their shard
+        return await self.shards[0].ip_manager.deallocate_many_async(db, peer_ids)
+
+    def release_addresses(self, ips: Iterable[str]) -> None:
+        """Return addresses to their shard's pool"""
+        for ip in ips:
+            shard = self.shard_for_ip(ip)
+            if shard is not None:
+                shard.ip_manager.release_addresses([ip])
+
+    def release_ip(self, db: Session, peer_id: int) -> None:
+        """Release IP address allocated to peer"""
+        allocation = (
+            db.query(IPAllocation).filter(IPAllocation.peer_id == peer_id).first()
+        )
+        if allocation and not allocation.is_reserved:
+            ip_address = allocation.ip_address
+            db.delete(allocation)
+            db.commit()
+            self.release_addresses([ip_address])
+
+    @traced("ip.release")
+    async def release_ip_async(self, db: AsyncSession, peer_id: int) -> None:
+        """Release IP address allocated to peer"""
+        allocation = await db.scalar(
+            select(IPAllocation).where(IPAllocation.peer_id == peer_id)
+        )
+        if allocation and not allocation.is_reserved:
+            ip_address = allocation.ip_address
+            await db.delete(allocation)
+            await db.commit()
+            self.release_addresses([ip_address])
+
+    def get_peer_ip(self, db: Session, peer_id: int) -> Optional[str]:
+        """Get IP address allocated to peer"""
+        return self.shards[0].ip_manager.get_peer_ip(db, peer_id)
+
+    async def get_peer_ip_async(self, db: AsyncSession, peer_id: int) -> Optional[str]:
+        """Get IP address allocated to peer"""
+        return await self.shards[0].ip_manager.get_peer_ip_async(db, peer_id)
+
+
+# Shared instance, so every route allocates from the same in-memory pools
+ip_manager = ShardedIPManager()
@@ -0,0 +1,353 @@
+"""Per-peer transfer and handshake statistics, kept as downsampled time series"""
+
+import asyncio
+import subprocess
+import time
+from array import array
+from datetime import datetime, timezone
+from typing import Callable, NamedTuple, Optional, Protocol
+
+from sqlalchemy import bindparam
+from sqlalchemy.orm import Session
+
+from .. import config
+from ..database.models import Peer
+from .peer_registry import peer_registry
+
+# Tier name, seconds per sample, samples kept. Memory is fixed at 16 bytes
+# per peer per kept sample: about 14 KiB per peer with these tiers.
+DEFAULT_TIERS = (("10s", 10, 360), ("1m", 60, 360), ("1h", 3600, 168))
+
+# Peers whose latest handshake is this recent count as connected; WireGuard
+# handshakes at least every two minutes while traffic flows
+ACTIVE_WINDOW = 180
+
+# Counter value of a slot in which the peer was not on any interface
+MISSING = -1
+
+
+class PeerCounters(NamedTuple):
+    """Transfer counters of one peer as reported by WireGuard"""
+
+    rx_bytes: int
+    tx_bytes: int
+    # Unix time, 0 if the peer never completed a handshake
+    latest_handshake: int
+
+
+class CounterSource(Protocol):
+    """Where the collector reads counters from"""
+
+    def read(self) -> dict[str, PeerCounters]:
+        """Counters of every peer, as public key -> counters"""
+        ...
+
+
+def parse_dump(output: str) -> dict[str, PeerCounters]:
+    """Parse `wg show all dump`, which has one line per interface and per peer"""
+    counters = {}
+    for line in output.splitlines():
+        fields = line.split("\t")
+        # Peer lines: interface, public key, preshared key, endpoint,
+        # allowed ips, latest handshake, rx, tx, keepalive
+        if len(fields) != 9:
+            continue
+        counters[fields[1]] = PeerCounters(
+            int(fields[6]), int(fields[7]), int(fields[5])
+        )
+    return counters
+
+
+class WgDumpSource:
+    """Reads every peer on every interface with a single `wg` call"""
+
+    def read(self) -> dict[str, PeerCounters]:
+        output = subprocess.run(
+            ["wg", "show", "all", "dump"],
+            capture_output=True,
+            text=True,
+            check=True,
+        ).stdout
+        return parse_dump(output)
+
+
+class FakeCounterSource:
+    """Counters set by hand, for tests and running without WireGuard"""
+
+    def __init__(self):
+        self.counters: dict[str, PeerCounters] = {}
+
+    def set(
+        self, public_key: str, rx_bytes: int, tx_bytes: int, latest_handshake: int = 0
+    ) -> None:
+        self.counters[public_key] = PeerCounters(rx_bytes, tx_bytes, latest_handshake)
+
+    def read(self) -> dict[str, PeerCounters]:
+        return dict(self.counters)
+
+
+def _delta(previous: int, current: int) -> int:
+    if previous == MISSING:
+        return 0
+    # Counters restart from zero when an interface is recreated
+    return current - previous if current >= previous else current
+
+
+class Tier:
+    """Ring of `capacity` samples taken every `step` seconds, for all peers
+
+    Sample times are shared; each peer has one preallocated array of rx/tx
+    pairs, and the per-sample totals over all peers are kept as they are
+    appended. Series of peers gone for a whole ring are dropped, so memory
+    stays bounded however long the server runs.
+    """
+
+    def __init__(self, name: str, step: int, capacity: int):
+        self.name = name
+        self.step = step
+        self.capacity = capacity
+        self.times = array("d", [0.0]) * capacity
+        # Bytes moved by all peers since the previous sample, and peers connected
+        self.rx_total = array("q", [0]) * capacity
+        self.tx_total = array("q", [0]) * capacity
+        self.active = array("q", [0]) * capacity
+        self.series: dict[str, array] = {}
+        self.head = 0
+        self.count = 0
+
+    def due(self, now: float) -> bool:
+        """Whether `now` starts a new `step` since the last sample"""
+        if not self.count:
+            return True
+        last = self.times[(self.head - 1) % self.capacity]
+        return int(now // self.step) != int(last // self.step)
+
+    def append(
+        self, now: float, counters: dict[str, PeerCounters], active: int
+    ) -> None:
+        slot, previous = self.head, (self.head - 1) % self.capacity
+        rx_total = tx_total = 0
+        for public_key, series in self.series.items():
+            if public_key not in counters:
+                series[2 * slot] = series[2 * slot + 1] = MISSING
+        for public_key, peer in counters.items():
+            series = self.series.get(public_key)
+            if series is None:
+                series = array("q", [MISSING]) * (2 * self.capacity)
+                self.series[public_key] = series
+            if self.count:
+                rx_total += _delta(series[2 * previous], peer.rx_bytes)
+                tx_total += _delta(series[2 * previous + 1], peer.tx_bytes)
+            series[2 * slot] = peer.rx_bytes
+            series[2 * slot + 1] = peer.tx_bytes
+
+        self.times[slot] = now
+        self.rx_total[slot] = rx_total
+        self.tx_total[slot] = tx_total
+        self.active[slot] = active
+        self.head = (slot + 1) % self.capacity
+        self.count = min(self.count + 1, self.capacity)
+        if self.head == 0:
+            self._drop_missing()
+
+    def _drop_missing(self) -> None:
+        gone = [key for key, series in self.series.items() if max(series) == MISSING]
+        for public_key in gone:
+            del self.series[public_key]
+
+    def _slots(self) -> list[int]:
+        """Slots oldest first"""
+        start = (self.head - self.count) % self.capacity
+        return [(start + i) % self.capacity for i in range(self.count)]
+
+    def peer_points(self, public_key: str) -> list[dict]:
+        """Bytes moved by one peer in each step, oldest first"""
+        series = self.series.get(public_key)
+        if series is None:
+            return []
+        points, previous = [], None
+        for slot in self._slots():
+            if series[2 * slot] == MISSING:
+                previous = None
+                continue
+            if previous is not None:
+                points.append(
+                    self._point(
+                        previous,
+                        slot,
+                        _delta(series[2 * previous], series[2 * slot]),
+                        _delta(series[2 * previous + 1], series[2 * slot + 1]),
+                    )
+                )
+            previous = slot
+        return points
+
+    def total_points(self) -> list[dict]:
+        """Bytes moved by all peers together in each step, oldest first"""
+        slots = self._slots()
+        return [
+            {
+                **self._point(previous, slot, self.rx_total[slot], self.tx_total[slot]),
+                "active_peers": self.active[slot],
+            }
+            for previous, slot in zip(slots, slots[1:])
+        ]
+
+    def _point(self, previous: int, slot: int, rx_bytes: int, tx_bytes: int) -> dict:
+        elapsed = (self.times[slot] - self.times[previous]) or 1.0
+        return {
+            "time": datetime.fromtimestamp(self.times[slot], timezone.utc),
+            "rx_bytes": rx_bytes,
+            "tx_bytes": tx_bytes,
+            "rx_rate": rx_bytes / elapsed,
+            "tx_rate": tx_bytes / elapsed,
+        }
+
+
+class StatsCollector:
+    """Samples every peer's counters in one read and keeps them in tiers
+
+    The first tier takes every sample; the others take the first sample of
+    each of their steps, which loses nothing since the counters are
+    cumulative. Handshake times go to the peer registry as they advance and
+    to `peers.last_seen` every `persist_interval` seconds, in one statement.
+    """
+
+    def __init__(
+        self,
+        source: CounterSource,
+        interval: float = config.STATS_INTERVAL,
+        tiers: tuple = DEFAULT_TIERS,
+        persist_interval: float = config.STATS_PERSIST_INTERVAL,
+        session_factory: Optional[Callable[[], Session]] = None,
+    ):
+        self.source = source
+        self.interval = interval
+        self.persist_interval = persist_interval
+        self.session_factory = session_factory
+        self.tiers = {
+            name: Tier(name, step, capacity) for name, step, capacity in tiers
+        }
+        self.latest: dict[str, PeerCounters] = {}
+        # Peers with a recent handshake as of the last sample
+        self.last_active = 0
+        self._unsaved_seen: dict[str, datetime] = {}
+        self._persisted_at = 0.0
+        self._task: Optional[asyncio.Task] = None
+
+    def sample(self, now: Optional[float] = None) -> int:
+        """Read all counters once; returns how many peers were read"""
+        now = time.time() if now is None else now
+        counters = self.source.read()
+
+        seen = {}
+        for public_key, peer in counters.items():
+            previous = self.latest.get(public_key)
+            if peer.latest_handshake and (
+                previous is None or peer.latest_handshake > previous.latest_handshake
+            ):
+                seen[public_key] = datetime.fromtimestamp(
+                    peer.latest_handshake, timezone.utc
+                )
+        self.latest = counters
+        if seen:
+            # Not a change of the revision: with active peers it would move
+            # every interval and no ETag would ever validate. Peer responses
+            # served as 304 may show an older last_seen; the stats routes
+            # have the latest handshakes.
+            peer_registry.set_last_seen(seen)
+            self._unsaved_seen.update(seen)
+
+        active = self.last_active = self.active_peers(now)
+        first, *rest = self.tiers.values()
+        first.append(now, counters, active)
+        for tier in rest:
+            if tier.due(now):
+                tier.append(now, counters, active)
+
+        if self._unsaved_seen and now - self._persisted_at >= self.persist_interval:
+            self.persist()
+            self._persisted_at = now
+        return len(counters)
+
+    def persist(self) -> None:
+        """Write handshakes seen since the last call to `peers.last_seen`"""
+        seen, self._unsaved_seen = self._unsaved_seen, {}
+        if not seen or self.session_factory is None:
+            return
+        peers = Peer.__table__
+        statement = (
+            peers.update()
+            .where(peers.c.public_key == bindparam("key"))
+            .values(last_seen=bindparam("seen"))
+        )
+        with self.session_factory() as session:
+            session.execute(
+                statement,
+                [{"key": key, "seen": last_seen} for key, last_seen in seen.items()],
+            )
+            session.commit()
+
+    def active_peers(self, now: Optional[float] = None) -> int:
+        """Peers with a recent handshake"""
+        now = time.time() if now is None else now
+        return sum(
+            1
+            for peer in self.latest.values()
+            if peer.latest_handshake and now - peer.latest_handshake < ACTIVE_WINDOW
+        )
+
+    def peer_stats(self, public_key: str, tier: str) -> dict:
+        """Current counters and the time series of one peer"""
+        counters = self.latest.get(public_key, PeerCounters(0, 0, 0))
+        return {
+            "tier": tier,
+            "step": self.tiers[tier].step,
+            "rx_bytes": counters.rx_bytes,
+            "tx_bytes": counters.tx_bytes,
+            "latest_handshake": (
+                datetime.fromtimestamp(counters.latest_handshake, timezone.utc)
+                if counters.latest_handshake
+                else None
+            ),
+            "points": self.tiers[tier].peer_points(public_key),
+        }
+
+    def aggregate(self, tier: str) -> dict:
+        """Totals over all peers and their time series"""
+        return {
+            "tier": tier,
+            "step": self.tiers[tier].step,
+            "peers": len(self.latest),
+            "active_peers": self.active_peers(),
+            "rx_bytes": sum(peer.rx_bytes for peer in self.latest.values()),
+            "tx_bytes": sum(peer.tx_bytes for peer in self.latest.values()),
+            "points": self.tiers[tier].total_points(),
+        }
+
+    def start(self) -> None:
+        """Start sampling on the running event loop"""
+        self._task = asyncio.get_running_loop().create_task(self._run())
+
+    async def stop(self) -> None:
+        """Stop sampling and save the handshakes not yet written"""
+        if self._task is None:
+            return
+        self._task.cancel()
+        try:
+            await self._task
+        except asyncio.CancelledError:
+            pass
+        self._task = None
+        await asyncio.to_thread(self.persist)
+
+    async def _run(self) -> None:
+        while True:
+            try:
+                await asyncio.to_thread(self.sample)
+            except Exception as e:  # keep sampling, e.g. after `wg` went missing
+                print(f"[server]: Reading peer statistics failed: {e}")
+            await asyncio.sleep(self.interval)
+
+
+stats_collector = StatsCollector(WgDumpSource())
@@ -0,0 +1,326 @@
+"""Request tracing with spans exported as OTLP/JSON lines
+
+Each request is a trace: a root span from the middleware with child spans
+for CRUD and IP allocation calls, every SQL statement and every WireGuard
+backend call. Finished traces are appended to a JSONL file, one OTLP
+`resourceSpans` document per line, and traces slower than the threshold
+are printed as a tree.
+
+When tracing is off, `span()` returns a shared no-op context manager and
+the SQL listeners return after one attribute check.
+"""
+
+import contextvars
+import functools
+import inspect
+import json
+import os
+import threading
+import time
+from contextlib import nullcontext
+from typing import Any, Optional
+
+from sqlalchemy import event
+from sqlalchemy.engine import Engine
+
+from .. import config
+from .metrics import route_template
+
+# OTLP span kinds
+KIND_INTERNAL = 1
+KIND_SERVER = 2
+KIND_CLIENT = 3
+
+# Longest SQL statement kept as a span attribute
+MAX_STATEMENT_LENGTH = 500
+
+_NOOP = nullcontext()
+_current_span: contextvars.ContextVar[Optional["Span"]] = contextvars.ContextVar(
+    "current_span", default=None
+)
+
+
+def _attribute_value(value: Any) -> dict:
+    if isinstance(value, bool):
+        return {"boolValue": value}
+    if isinstance(value, int):
+        # OTLP/JSON encodes 64-bit integers as strings
+        return {"intValue": str(value)}
+    if isinstance(value, float):
+        return {"doubleValue": value}
+    return {"stringValue": str(value)}
+
+
+class Span:
+    """One timed operation within a trace"""
+
+    __slots__ = (
+        "trace_id",
+        "span_id",
+        "parent",
+        "name",
+        "kind",
+        "start_ns",
+        "end_ns",
+        "attributes",
+        "error",
+        "children",
+        "_token",
+    )
+
+    def __init__(
+        self, name: str, parent: Optional["Span"], kind: int, attributes: dict
+    ):
+        self.trace_id = parent.trace_id if parent else os.urandom(16).hex()
+        self.span_id = os.urandom(8).hex()
+        self.parent = parent
+        self.name = name
+        self.kind = kind
+        self.attributes = attributes
+        self.error: Optional[str] = None
+        self.children: list[Span] = []
+        self.start_ns = time.time_ns()
+        self.end_ns = 0
+        self._token = None
+        if parent is not None:
+            parent.children.append(self)
+
+    @property
+    def duration_ms(self) -> float:
+        return (self.end_ns - self.start_ns) / 1e6
+
+    def set_attribute(self, key: str, value: Any) -> None:
+        self.attributes[key] = value
+
+    def walk(self):
+        """This span and its descendants, depth first"""
+        yield self
+        for child in self.children:
+            yield from child.walk()
+
+    def to_otlp(self) -> dict:
+        span = {
+            "traceId": self.trace_id,
+            "spanId": self.span_id,
+            "name": self.name,
+            "kind": self.kind,
+            "startTimeUnixNano": str(self.start_ns),
+            "endTimeUnixNano": str(self.end_ns),
+            "attributes": [
+                {"key": key, "value": _attribute_value(value)}
+                for key, value in self.attributes.items()
+            ],
+            # 1 = OK, 2 = ERROR
+            "status": (
+                {"code": 2, "message": self.error} if self.error else {"code": 1}
+            ),
+        }
+        if self.parent is not None:
+            span["parentSpanId"] = self.parent.span_id
+        return span
+
+    # Context manager protocol, so spans are used with `with`
+
+    def __enter__(self) -> "Span":
+        self._token = _current_span.set(self)
+        return self
+
+    def __exit__(self, exc_type, exc, traceback) -> None:
+        _current_span.reset(self._token)
+        self.end(exc)
+
+    def end(self, exc: Optional[BaseException] = None) -> None:
+        """Record the end time; spans never entered as context end this way"""
+        if exc is not None:
+            self.error = f"{type(exc).__name__}: {exc}"
+        self.end_ns = time.time_ns()
+        if self.parent is None:
+            tracer.finish(self)
+
+
+class Tracer:
+    """Creates spans and exports finished traces"""
+
+    def __init__(
+        self,
+        enabled: bool = config.TRACING_ENABLED,
+        export_path: str = config.TRACE_FILE,
+        slow_ms: float = config.TRACE_SLOW_MS,
+        service_name: str = "aspen-vpn",
+    ):
+        self.enabled = enabled
+        self.export_path = export_path
+        self.slow_ms = slow_ms
+        self.service_name = service_name
+        self._lock = threading.Lock()
+        self._file = None
+
+    def span(self, name: str, kind: int = KIND_INTERNAL, **attributes):
+        """Context manager timing `name` as a child of the current span"""
+        if not self.enabled:
+            return _NOOP
+        return Span(name, _current_span.get(), kind, attributes)
+
+    def trace(self, name: str, kind: int = KIND_INTERNAL, **attributes):
+        """Context manager starting a new trace, whatever span is current
+
+        For work that outlives the request it was started from, such as
+        background tasks created while a request span was current.
+        """
+        if not self.enabled:
+            return _NOOP
+        return Span(name, None, kind, attributes)
+
+    def current_span(self) -> Optional[Span]:
+        return _current_span.get() if self.enabled else None
+
+    def finish(self, root: Span) -> None:
+        """Export a finished trace and log it if it was slow"""
+        if self.export_path:
+            self._export(root)
+        if self.slow_ms and root.duration_ms >= self.slow_ms:
+            print(f"[server]: Slow operation:\n{format_tree(root)}")
+
+    def close(self) -> None:
+        with self._lock:
+            if self._file is not None:
+                self._file.close()
+                self._file = None
+
+    def _export(self, root: Span) -> None:
+        document = {
+            "resourceSpans": [
+                {
+                    "resource": {
+                        "attributes": [
+                            {
+                                "key": "service.name",
+                                "value": {"stringValue": self.service_name},
+                            }
+                        ]
+                    },
+                    "scopeSpans": [
+                        {
+                            "scope": {"name": "server"},
+                            "spans": [span.to_otlp() for span in root.walk()],
+                        }
+                    ],
+                }
+            ]
+        }
+        line = json.dumps(document, separators=(",", ":")) + "\n"
+        with self._lock:
+            if self._file is None:
+                self._file = open(self.export_path, "a", buffering=1)
+            self._file.write(line)
+
+
+def format_tree(root: Span) -> str:
+    """Indented span tree with durations"""
+    lines = []
+
+    def add(span: Span, depth: int) -> None:
+        detail = span.attributes.get("db.statement") or ""
+        if detail:
+            detail = " " + " ".join(detail.split())[:120]
+        error = f" [{span.error}]" if span.error else ""
+        lines.append(
+            f"{'  ' * depth}{span.name} {span.duration_ms:.1f} ms{detail}{error}"
+        )
+        for child in span.children:
+            add(child, depth + 1)
+
+    add(root, 0)
+    return "\n".join(lines)
+
+
+def traced(name: str):
+    """Decorator running a function, sync or async, inside a span"""
+
+    def decorate(function):
+        if inspect.iscoroutinefunction(function):
+
+            @functools.wraps(function)
+            async def async_wrapper(*args, **kwargs):
+                if not tracer.enabled:
+                    return await function(*args, **kwargs)
+                with tracer.span(name):
+                    return await function(*args, **kwargs)
+
+            return async_wrapper
+
+        @functools.wraps(function)
+        def wrapper(*args, **kwargs):
+            if not tracer.enabled:
+                return function(*args, **kwargs)
+            with tracer.span(name):
+                return function(*args, **kwargs)
+
+        return wrapper
+
+    return decorate
+
+
+class TracingMiddleware:
+    """ASGI middleware wrapping every HTTP request in a root span"""
+
+    def __init__(self, app):
+        self.app = app
+
+    async def __call__(self, scope, receive, send):
+        if scope["type"] != "http" or not tracer.enabled:
+            await self.app(scope, receive, send)
+            return
+
+        async def send_with_status(message):
+            if message["type"] == "http.response.start":
+                span.set_attribute("http.status_code", message["status"])
+            await send(message)
+
+        with tracer.trace(
+            f"{scope['method']} {scope['path']}",
+            KIND_SERVER,
+            **{"http.method": scope["method"], "http.target": scope["path"]},
+        ) as span:
+            try:
+                await self.app(scope, receive, send_with_status)
+            finally:
+                route = route_template(scope)
+                if route:
+                    span.name = f"{scope['method']} {route}"
+                    span.set_attribute("http.route", route)
+
+
+@event.listens_for(Engine, "before_cursor_execute")
+def _start_query_span(conn, cursor, statement, parameters, context, executemany):
+    if not tracer.enabled or _current_span.get() is None:
+        return
+    # Statements have no children, so the span never becomes the current one
+    span = tracer.span(
+        "db.query",
+        KIND_CLIENT,
+        **{
+            "db.system": conn.dialect.name,
+            "db.statement": statement[:MAX_STATEMENT_LENGTH],
+        },
+    )
+    conn.info.setdefault("query_spans", []).append(span)
+
+
+@event.listens_for(Engine, "after_cursor_execute")
+def _end_query_span(conn, cursor, statement, parameters, context, executemany):
+    spans = conn.info.get("query_spans")
+    if spans:
+        spans.pop().end()
+
+
+@event.listens_for(Engine, "handle_error")
+def _fail_query_span(context):
+    if context.connection is None:
+        return
+    spans = context.connection.info.get("query_spans")
+    if spans:
+        spans.pop().end(context.original_exception)
+
+
+tracer = Tracer()
@@ -1,11 +1,374 @@
 """WireGuard server management"""
 
-from typing import Optional
+import asyncio
+import hashlib
+import ipaddress
+import json
+import os
+import subprocess
+import threading
+import time
+from dataclasses import dataclass, field
+from typing import Callable, Optional, Protocol, Union
+from sqlalchemy import select
+from sqlalchemy.ext.asyncio import AsyncSession
 from sqlalchemy.orm import Session
 from python_wireguard import Server, ClientConnection, Key
-from .database.models import Peer, IPAllocation
+from .database.models import Peer, IPAllocation, ip_sort_key
+from .services.metrics import WG_PEER_OPS, WG_RECONCILE_DURATION
+from .services.peer_registry import peer_registry
+from .services.tracing import tracer
+
+
+@dataclass
+class PeerChanges:
+    """Peer operations needed to move an interface to its desired state"""
+
+    # public key -> allowed ip
+    add: dict[str, str] = field(default_factory=dict)
+    update: dict[str, str] = field(default_factory=dict)
+    remove: list[str] = field(default_factory=list)
+
+    def __bool__(self) -> bool:
+        return bool(self.add or self.update or self.remove)
+
+    @property
+    def op_count(self) -> int:
+        """Number of kernel operations this change set costs"""
+        return len(self.add) + len(self.update) + len(self.remove)
+
+
+class WireGuardBackend(Protocol):
+    """Interface the reconciler uses to read and mutate interface peers"""
+
+    def list_peers(self) -> dict[str, str]:
+        """Return the interface's current peers as public key -> allowed ip"""
+        ...
+
+    def apply(self, changes: PeerChanges) -> None:
+        """Apply a set of peer additions, updates and removals"""
+        ...
+
+
+def _strip_host_prefix(allowed_ip: str) -> str:
+    """Normalize `10.0.0.2/32` to `10.0.0.2` so it compares with IPAllocation rows"""
+    ip, _, prefix = allowed_ip.partition("/")
+    if prefix in ("32", "128"):
+        return ip
+    return allowed_ip
+
+
+class KernelBackend:
+    """Backend driving a real interface through python_wireguard and the `wg` tool"""
+
+    def __init__(self, server: Server):
+        self.server = server
+
+    @property
+    def interface_name(self) -> str:
+        return self.server.interface_name
+
+    def list_peers(self) -> dict[str, str]:
+        output = subprocess.run(
+            ["wg", "show", self.interface_name, "allowed-ips"],
+            capture_output=True,
+            text=True,
+            check=True,
+        ).stdout
+
+        peers = {}
+        for line in output.splitlines():
+            public_key, _, allowed_ips = line.partition("\t")
+            # A peer without allowed ips is listed as "(none)"
+            first_ip = allowed_ips.split(" ")[0]
+            peers[public_key] = (
+                "" if first_ip == "(none)" else _strip_host_prefix(first_ip)
+            )
+        return peers
+
+    def apply(self, changes: PeerChanges) -> None:
+        for public_key in changes.remove:
+            self._remove_peer(public_key)
+        for public_key, ip in changes.update.items():
+            # `wg set ... allowed-ips` replaces the list instead of appending to it
+            subprocess.run(
+                [
+                    "wg",
+                    "set",
+                    self.interface_name,
+                    "peer",
+                    public_key,
+                    "allowed-ips",
+                    ip,
+                ],
+                check=True,
+            )
+        for public_key, ip in changes.add.items():
+            self.server.add_client(ClientConnection(Key(public_key), ip))
+
+    def _remove_peer(self, public_key: str) -> None:
+        subprocess.run(
+            ["wg", "set", self.interface_name, "peer", public_key, "remove"],
+            check=True,
+        )
+
+
+class InMemoryBackend:
+    """Backend keeping peers in a dict, for tests and running without root"""
+
+    def __init__(self, peers: Optional[dict[str, str]] = None):
+        self.peers: dict[str, str] = dict(peers or {})
+        self.applied: list[PeerChanges] = []
+
+    def list_peers(self) -> dict[str, str]:
+        return dict(self.peers)
+
+    def apply(self, changes: PeerChanges) -> None:
+        for public_key in changes.remove:
+            self.peers.pop(public_key, None)
+        self.peers.update(changes.update)
+        self.peers.update(changes.add)
+        self.applied.append(changes)
+
+
+def load_or_create_key_pair(path: str) -> tuple[Key, Key]:
+    """Read the server key pair from `path`, generating and saving it on first use"""
+    try:
+        with open(path) as f:
+            stored = json.load(f)
+        return Key(stored["private_key"]), Key(stored["public_key"])
+    except FileNotFoundError:
+        pass
+
+    private, public = Key.key_pair()
+    # Written under another name and renamed, so a crash never leaves half a key
+    temporary = f"{path}.tmp"
+    fd = os.open(temporary, os.O_WRONLY | os.O_CREAT | os.O_TRUNC, 0o600)
+    with os.fdopen(fd, "w") as f:
+        json.dump({"private_key": str(private), "public_key": str(public)}, f)
+    os.replace(temporary, path)
+    print(f"[server]: Generated a new server key pair in {path}")
+    return private, public
+
+
+@dataclass
+class InterfaceState:
+    """How a live interface is configured"""
+
+    public_key: str
+    port: int
+    # With prefix, e.g. 10.0.0.1/24
+    addresses: list[str]
+
+
+def read_interface(
+    name: str, run: Callable[..., subprocess.CompletedProcess] = subprocess.run
+) -> Optional[InterfaceState]:
+    """Key, port and addresses of a live interface, None if there is none"""
+    dump = run(["wg", "show", name, "dump"], capture_output=True, text=True)
+    if dump.returncode != 0 or not dump.stdout:
+        return None
+    # The first line is the interface: private key, public key, port, fwmark
+    _, public_key, port, *_ = dump.stdout.splitlines()[0].split("\t")
+
+    output = run(
+        ["ip", "-o", "addr", "show", "dev", name],
+        capture_output=True,
+        text=True,
+        check=True,
+    ).stdout
+    addresses = []
+    for line in output.splitlines():
+        fields = line.split()
+        for family, address in zip(fields, fields[1:]):
+            if family in ("inet", "inet6"):
+                addresses.append(address)
+    return InterfaceState(public_key, int(port), addresses)
+
+
+def open_server(
+    name: str, private: Key, public: Key, address: str, port: int
+) -> tuple[Server, bool]:
+    """Bring up a server interface, adopting one left up by a previous run
+
+    An interface with the same key, port and address keeps its peers and
+    their sessions; one configured differently is recreated. Returns the
+    server and whether the interface was adopted.
+    """
+    server = Server(interface_name=name, key=private, local_ip=address, port=port)
+    state = read_interface(name)
+    if state is not None:
+        if (
+            state.public_key == str(public)
+            and state.port == port
+            and address in state.addresses
+        ):
+            # enable() then only sets the link up
+            server.interface_created = True
+            server.enable()
+            return server, True
+        print(f"[server]: Recreating {name}, its key, port or address changed")
+        server.delete_interface()
+    server.enable()
+    return server, False
+
+
+def diff_peers(current: dict[str, str], desired: dict[str, str]) -> PeerChanges:
+    """Compute the operations turning `current` into `desired`"""
+    changes = PeerChanges()
+    for public_key, ip in desired.items():
+        if public_key not in current:
+            changes.add[public_key] = ip
+        elif current[public_key] != ip:
+            changes.update[public_key] = ip
+    changes.remove = [key for key in current if key not in desired]
+    return changes
+
+
+def fingerprint(peers: dict[str, str]) -> str:
+    """Stable digest of a peer set, used to skip no-op reconciliations"""
+    digest = hashlib.sha256()
+    for public_key, ip in sorted(peers.items()):
+        digest.update(f"{public_key}={ip}\n".encode())
+    return digest.hexdigest()
+
+
+class PeerReconciler:
+    """Applies only the difference between the desired and the live peer set"""
+
+    def __init__(self, backend: WireGuardBackend):
+        self.backend = backend
+        self._applied_fingerprint: Optional[str] = None
+        # Reconciles may run from worker threads; one diff/apply at a time
+        self._lock = threading.Lock()
+
+    def reconcile(self, desired: dict[str, str]) -> PeerChanges:
+        """Bring the backend in line with `desired`, returning what was changed"""
+        desired_fingerprint = fingerprint(desired)
+        with self._lock:
+            if desired_fingerprint == self._applied_fingerprint:
+                return PeerChanges()
+
+            start = time.perf_counter()
+            try:
+                with tracer.span("wg.list_peers"):
+                    current = self._current()
+                desired = self._desired(desired)
+                changes = diff_peers(current, desired)
+                if changes:
+                    with tracer.span("wg.apply", ops=changes.op_count):
+                        self.backend.apply(changes)
+            except Exception:
+                WG_RECONCILE_DURATION.observe(
+                    time.perf_counter() - start, result="failed"
+                )
+                raise
+            WG_RECONCILE_DURATION.observe(
+                time.perf_counter() - start, result="applied" if changes else "in_sync"
+            )
+            for op, count in (
+                ("add", len(changes.add)),
+                ("update", len(changes.update)),
+                ("remove", len(changes.remove)),
+            ):
+                if count:
+                    WG_PEER_OPS.inc(count, op=op)
+
+            self._applied_fingerprint = desired_fingerprint
+            self._applied(desired)
+            return changes
+
+    def invalidate(self) -> None:
+        """Forget the last applied state so the next reconcile re-reads the interface"""
+        self._applied_fingerprint = None
+
+    def _current(self) -> dict[str, str]:
+        return self.backend.list_peers()
+
+    def _desired(self, desired: dict[str, str]) -> dict[str, str]:
+        return desired
+
+    def _applied(self, desired: dict[str, str]) -> None:
+        pass
+
+
+class SharedPeerReconciler(PeerReconciler):
+    """Reconciler for an interface that several API processes update
+
+    A process only knows the changes it committed itself, so the peer set
+    to apply is read from the database by `load_desired`, after listing
+    the interface. Any peer another process has put on the interface is
+    committed by then, and any it disabled or deleted is gone from the
+    database: no process undoes another's change. Nothing is skipped as
+    unchanged either, since other processes change the interface too.
+    """
+
+    def __init__(
+        self, backend: WireGuardBackend, load_desired: Callable[[], dict[str, str]]
+    ):
+        super().__init__(backend)
+        self.load_desired = load_desired
+
+    def _desired(self, desired: dict[str, str]) -> dict[str, str]:
+        with tracer.span("wg.load_desired"):
+            return self.load_desired()
+
+    def _applied(self, desired: dict[str, str]) -> None:
+        self._applied_fingerprint = None
+
+
+class ShardedReconciler:
+    """Reconciles each interface shard with its slice of the desired peer set
+
+    Peers are routed to a shard by their address. Per-shard reconcilers are
+    created on first use by `open_shard`, which brings the interface up.
+    """
+
+    def __init__(
+        self,
+        shard_index: Callable[[str], Optional[int]],
+        open_shard: Callable[[int], PeerReconciler],
+    ):
+        self.shard_index = shard_index
+        self.open_shard = open_shard
+        self.reconcilers: dict[int, PeerReconciler] = {}
+        self._lock = threading.Lock()
+
+    def reconciler(self, index: int) -> PeerReconciler:
+        """Reconciler of shard `index`, opening the shard if needed"""
+        with self._lock:
+            if index not in self.reconcilers:
+                self.reconcilers[index] = self.open_shard(index)
+            return self.reconcilers[index]
+
+    def reconcile(self, desired: dict[str, str]) -> PeerChanges:
+        """Reconcile every shard, returning the combined changes"""
+        # Shards that lost all their peers still need their removals
+        by_shard: dict[int, dict[str, str]] = {index: {} for index in self.reconcilers}
+        for public_key, ip in desired.items():
+            index = self.shard_index(ip)
+            if index is None:
+                print(f"[server]: No shard for {ip}, skipping peer {public_key}")
+                continue
+            by_shard.setdefault(index, {})[public_key] = ip
+
+        changes = PeerChanges()
+        for index, peers in sorted(by_shard.items()):
+            with tracer.span("wg.reconcile_shard", shard=index, peers=len(peers)):
+                shard_changes = self.reconciler(index).reconcile(peers)
+            changes.add.update(shard_changes.add)
+            changes.update.update(shard_changes.update)
+            changes.remove.extend(shard_changes.remove)
+        return changes
+
+    def invalidate(self) -> None:
+        """Re-read every interface on the next reconcile"""
+        for reconciler in list(self.reconcilers.values()):
+            reconciler.invalidate()
+
 
 _wg_server: Optional[Server] = None
+_reconciler: Optional[Union[PeerReconciler, ShardedReconciler]] = None
 
 
 def get_wg_server() -> Server:
@@ -20,19 +383,69 @@ def set_wg_server(server: Server) -> None:
     """Set WireGuard server instance"""
     global _wg_server
     _wg_server = server
+    set_reconciler(PeerReconciler(KernelBackend(server)))
+
+
+def get_reconciler() -> Union[PeerReconciler, ShardedReconciler]:
+    """Get the reconciler for the WireGuard interface"""
+    if not _reconciler:
+        raise RuntimeError("WireGuard server not initialized")
+    return _reconciler
+
+
+def set_reconciler(reconciler: Union[PeerReconciler, ShardedReconciler]) -> None:
+    """Set the reconciler, e.g. one wrapping an InMemoryBackend"""
+    global _reconciler
+    _reconciler = reconciler
 
 
-def sync_wireguard_peers(db: Session, wg_server: Server) -> None:
+def desired_peers(
+    db: Session,
+    network: Optional[Union[ipaddress.IPv4Network, ipaddress.IPv6Network]] = None,
+) -> dict[str, str]:
+    """Load enabled peers and their allocated IPs as public key -> ip
+
+    With `network`, only peers with an address in it, e.g. one shard's.
+    """
+    query = (
+        db.query(Peer.public_key, IPAllocation.ip_address)
+        .join(IPAllocation, IPAllocation.peer_id == Peer.id)
+        .filter(Peer.is_enabled)
+    )
+    if network is not None:
+        query = query.filter(
+            IPAllocation.ip_key.between(
+                ip_sort_key(str(network.network_address)),
+                ip_sort_key(str(network.broadcast_address)),
+            )
+        )
+    return {public_key: ip for public_key, ip in query.all()}
+
+
+async def desired_peers_async(db: AsyncSession) -> dict[str, str]:
+    """Load enabled peers and their allocated IPs as public key -> ip"""
+    rows = await db.execute(
+        select(Peer.public_key, IPAllocation.ip_address)
+        .join(IPAllocation, IPAllocation.peer_id == Peer.id)
+        .where(Peer.is_enabled)
+    )
+    return {public_key: ip for public_key, ip in rows}
+
+
+def sync_wireguard_peers(db: Session, reconciler: PeerReconciler) -> PeerChanges:
     """Sync WireGuard peers with database state"""
-    # Remove all current peers
-    wg_server.delete_interface()
-    wg_server.create_interface()
-    wg_server.enable()
-
-    # Add only enabled peers
-    enabled_peers = db.query(Peer).filter(Peer.is_enabled).all()
-    for peer in enabled_peers:
-        ip = db.query(IPAllocation).filter(IPAllocation.peer_id == peer.id).first()
-        if ip:
-            client = ClientConnection(Key(peer.public_key), ip.ip_address)
-            wg_server.add_client(client)
+    return reconciler.reconcile(desired_peers(db))
+
+
+async def sync_wireguard_peers_async(
+    db: AsyncSession, reconciler: PeerReconciler
+) -> PeerChanges:
+    """Sync WireGuard peers with database state, off the event loop"""
+    desired = await desired_peers_async(db)
+    # Kernel calls block, so they run in a worker thread
+    return await asyncio.to_thread(reconciler.reconcile, desired)
+
+
+async def sync_wireguard_registry(reconciler: PeerReconciler) -> PeerChanges:
+    """Sync WireGuard peers with the in-memory peer registry, without a query"""
+    return await asyncio.to_thread(reconciler.reconcile, peer_registry.desired_peers())
@@ -0,0 +1,91 @@
+"""Shared fixtures for the server tests"""
+
+import pytest
+from fastapi import FastAPI
+from fastapi.testclient import TestClient
+from sqlalchemy import create_engine
+from sqlalchemy.ext.asyncio import async_sessionmaker, create_async_engine
+from sqlalchemy.orm import sessionmaker
+
+from server.database.models import Base
+from server.database.session import AppSession, get_async_db
+from server.routes import changes, invites, jobs, peers, policies
+from server.services.auth_cache import auth_cache
+from server.services.ip_manager import IPManager
+from server.services.changes import change_feed
+from server.services.peer_registry import peer_registry
+from server.services.policies import policy_store
+from server.wireguard import InMemoryBackend, PeerReconciler, set_reconciler
+
+
+@pytest.fixture
+def session_factory(tmp_path):
+    """Sync session factory over a fresh SQLite file, with the registry loaded"""
+    engine = create_engine(f"sqlite:///{tmp_path / 'vpn.db'}")
+    Base.metadata.create_all(bind=engine)
+    factory = sessionmaker(bind=engine, class_=AppSession)
+    with factory() as session:
+        peer_registry.load(session)
+        policy_store.load(session)
+        change_feed.load(session)
+    yield factory
+    peer_registry.clear()
+    policy_store.clear()
+    change_feed.clear()
+    engine.dispose()
+
+
+@pytest.fixture
+def backend():
+    """In-memory WireGuard backend installed as the server's reconciler"""
+    backend = InMemoryBackend()
+    set_reconciler(PeerReconciler(backend))
+    return backend
+
+
+@pytest.fixture
+def client(tmp_path, session_factory, backend, monkeypatch):
+    """Test client for the peer routes, backed by the same SQLite file"""
+    async_engine = create_async_engine(f"sqlite+aiosqlite:///{tmp_path / 'vpn.db'}")
+    async_factory = async_sessionmaker(
+        async_engine, expire_on_commit=False, sync_session_class=AppSession
+    )
+
+    async def override_get_async_db():
+        async with async_factory() as session:
+            yield session
+
+    app = FastAPI()
+    app.include_router(peers.router, prefix="/api/peers")
+    app.include_router(jobs.router, prefix="/api/jobs")
+    app.include_router(policies.router, prefix="/api/policies")
+    app.include_router(changes.router, prefix="/api/changes")
+    app.include_router(invites.router, prefix="/api/invites")
+    app.dependency_overrides[get_async_db] = override_get_async_db
+    monkeypatch.setattr(peers, "ip_manager", IPManager("10.0.0.0/24", "10.0.0.1"))
+    auth_cache.clear()
+    with TestClient(app) as test_client:
+        yield test_client
+
+
+def register(client, name: str, host: int) -> dict:
+    """Register a peer through the API and return the response body"""
+    response = client.post(
+        "/api/peers/register",
+        json={
+            "name": name,
+            "public_key": f"{name:k<44}",
+            "assigned_ip": f"10.0.0.{host}/24",
+        },
+    )
+    assert response.status_code == 200, response.text
+    return response.json()
+
+
+def make_admin(session_factory, peer_id: int) -> None:
+    """Flag a registered peer as admin directly in the database"""
+    from server.database.models import Peer
+
+    with session_factory() as session:
+        session.get(Peer, peer_id).is_admin = True
+        session.commit()
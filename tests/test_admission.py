@@ -0,0 +1,87 @@
+"""Tests for rate limiting and the concurrency cap"""
+
+import pytest
+from fastapi import APIRouter, Depends, FastAPI
+from fastapi.testclient import TestClient
+
+from server.services import admission as admission_module
+from server.services.admission import Admission, RateLimiter, admit
+
+
+def test_token_bucket_refills_at_its_rate():
+    limiter = RateLimiter(rate=2, burst=3, max_keys=2)
+
+    assert [limiter.acquire("a", now=0) for _ in range(3)] == [0, 0, 0]
+    assert limiter.acquire("a", now=0) == pytest.approx(0.5)
+    assert limiter.acquire("a", now=0.5) == 0
+    # Other keys have buckets of their own; the oldest key is forgotten
+    assert limiter.acquire("b", now=0.5) == 0
+    assert limiter.acquire("c", now=0.5) == 0
+    assert len(limiter) == 2
+
+
+@pytest.fixture
+def limited(monkeypatch):
+    """An app with a register and a read route behind admission control"""
+    limits = Admission(
+        budgets={
+            "register": (0.01, 2),
+            "bulk": (0.01, 1),
+            "write": (1, 1),
+            "read": (0.01, 3),
+        },
+        max_expensive=1,
+        enabled=True,
+    )
+    monkeypatch.setattr(admission_module, "admission", limits)
+
+    router = APIRouter()
+
+    @router.post("/register")
+    async def register():
+        return {}
+
+    @router.get("/{peer_id}")
+    async def get_peer(peer_id: int):
+        return {}
+
+    app = FastAPI()
+    app.include_router(router, prefix="/api/peers", dependencies=[Depends(admit)])
+    with TestClient(app) as client:
+        yield client, limits
+
+
+def test_budgets_answer_429_with_retry_after(limited):
+    client, limits = limited
+
+    assert [client.post("/api/peers/register").status_code for _ in range(3)] == [
+        200,
+        200,
+        429,
+    ]
+    rejected = client.post("/api/peers/register")
+    assert rejected.headers["Retry-After"] == "100"
+
+    # Reads have their own budget, charged to the IP and then to the key
+    for peer_id in (1, 2, 3):
+        response = client.get(f"/api/peers/{peer_id}", headers={"X-API-Key": "a"})
+        assert response.status_code == 200
+    assert client.get("/api/peers/4", headers={"X-API-Key": "b"}).status_code == 429
+    # Keys are tracked by hash; "b" was turned away before its key was charged
+    assert len(limits.by_key["read"]) == 1
+    assert "a" not in limits.by_key["read"]._buckets
+
+
+def test_expensive_routes_shed_load_at_the_cap(limited):
+    client, limits = limited
+    limits.expensive.active = limits.expensive.limit
+
+    busy = client.post("/api/peers/register")
+    assert busy.status_code == 503
+    assert busy.headers["Retry-After"] == "1"
+    # Reads are not capped
+    assert client.get("/api/peers/1").status_code == 200
+
+    limits.expensive.active = 0
+    assert client.post("/api/peers/register").status_code == 200
+    assert limits.expensive.active == 0
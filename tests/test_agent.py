@@ -0,0 +1,131 @@
+"""Tests for the data-plane agent and the shared-interface reconciler"""
+
+import asyncio
+
+import pytest
+
+from server.agent import AgentBackend, AgentError, AgentServer
+from server.database.models import IPAllocation, Peer
+from server.services.peer_registry import PeerRegistry
+from server.wireguard import (
+    InMemoryBackend,
+    PeerChanges,
+    SharedPeerReconciler,
+    desired_peers,
+)
+
+
+def run_with_agent(tmp_path, check):
+    """Run `check(socket_path)` in a thread while an in-memory agent serves"""
+    socket_path = str(tmp_path / "agent.sock")
+    backend = InMemoryBackend()
+
+    async def run():
+        agent = AgentServer(
+            lambda name, address, port: backend,
+            socket_path,
+            {"public_key": "server-key"},
+        )
+        await agent.start()
+        try:
+            return await asyncio.to_thread(check, socket_path)
+        finally:
+            await agent.close()
+
+    return backend, asyncio.run(run())
+
+
+def test_batched_changes_round_trip(tmp_path):
+    def check(socket_path):
+        client = AgentBackend(socket_path, "wg1", timeout=5)
+        client.open("10.0.1.1/24", 51821)
+        client.apply(PeerChanges(add={"a-key": "10.0.0.2", "b-key": "10.0.0.3"}))
+        client.apply(PeerChanges(update={"a-key": "10.0.0.4"}, remove=["b-key"]))
+        return client.list_peers(), client.info()
+
+    backend, (peers, info) = run_with_agent(tmp_path, check)
+
+    assert peers == {"a-key": "10.0.0.4"}
+    assert len(backend.applied) == 2
+    assert info == {
+        "public_key": "server-key",
+        "interfaces": ["wg1"],
+        "batches": 2,
+        "ops": 4,
+    }
+
+
+def test_agent_errors_are_raised(tmp_path):
+    def check(socket_path):
+        client = AgentBackend(socket_path, timeout=5)
+        with pytest.raises(AgentError, match="Unknown method"):
+            client.call("format_disk")
+        with pytest.raises(AgentError, match="'wg0' is not open"):
+            client.list_peers()
+
+    run_with_agent(tmp_path, check)
+
+
+def add_peer(session, peer_id: int, key: str, ip: str) -> Peer:
+    peer = Peer(
+        id=peer_id,
+        name=key,
+        public_key=key,
+        assigned_ip=f"{ip}/24",
+        api_key_hash=key,
+    )
+    session.add_all([peer, IPAllocation(ip_address=ip, peer_id=peer_id)])
+    session.commit()
+    return peer
+
+
+def test_workers_sharing_an_interface_apply_each_others_changes(session_factory):
+    backend = InMemoryBackend({"stale-key": "10.0.0.9"})
+
+    def load():
+        with session_factory() as session:
+            return desired_peers(session)
+
+    first = SharedPeerReconciler(backend, load)
+    second = SharedPeerReconciler(backend, load)
+    # Worker B started before anything was registered; its registry stays empty
+    registry_b = PeerRegistry()
+    with session_factory() as session:
+        registry_b.load(session)
+        add_peer(session, 1, "a-key", "10.0.0.2")
+        registry_a = PeerRegistry()
+        registry_a.load(session)
+
+    # Registered on A; peers deleted while down go away too
+    first.reconcile(registry_a.desired_peers())
+    assert backend.peers == {"a-key": "10.0.0.2"}
+
+    # Disabled on B, which never saw the peer: it still comes off
+    with session_factory() as session:
+        session.get(Peer, 1).is_enabled = False
+        session.commit()
+    changes = second.reconcile(registry_b.desired_peers())
+    assert changes == PeerChanges(remove=["a-key"])
+    assert backend.peers == {}
+
+    # Re-enabled on A, deleted on B
+    with session_factory() as session:
+        session.get(Peer, 1).is_enabled = True
+        session.commit()
+    first.reconcile(registry_a.desired_peers())
+    with session_factory() as session:
+        session.delete(session.get(IPAllocation, 1))
+        session.delete(session.get(Peer, 1))
+        session.commit()
+    second.reconcile(registry_b.desired_peers())
+    assert backend.peers == {}
+
+    # Peers registered on either worker are kept by the other
+    with session_factory() as session:
+        add_peer(session, 2, "b-key", "10.0.0.3")
+    first.reconcile(registry_a.desired_peers())
+    with session_factory() as session:
+        add_peer(session, 3, "c-key", "10.0.0.4")
+    changes = second.reconcile(registry_b.desired_peers())
+    assert changes == PeerChanges(add={"c-key": "10.0.0.4"})
+    assert backend.peers == {"b-key": "10.0.0.3", "c-key": "10.0.0.4"}
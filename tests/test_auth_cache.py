@@ -0,0 +1,69 @@
+"""Tests for cached API key authentication"""
+
+from server.database.models import Peer
+from server.services.auth_cache import AuthCache, AuthenticatedPeer, auth_cache
+from server.services.peer_registry import peer_registry
+
+from conftest import make_admin, register
+
+
+def test_cache_expires_and_evicts():
+    cache = AuthCache(ttl=0, max_size=1)
+    cache.put("a", AuthenticatedPeer(1, "a", False))
+    assert cache.get("a") is None
+
+    cache = AuthCache(max_size=1)
+    cache.put("a", AuthenticatedPeer(1, "a", False))
+    cache.put("b", AuthenticatedPeer(2, "b", False))
+    assert cache.get("a") is None
+    assert cache.get("b").id == 2
+
+
+def test_api_key_is_stored_hashed_and_cached(client, session_factory):
+    registered = register(client, "peer-1", 2)
+    headers = {"X-API-Key": registered["api_key"]}
+
+    with session_factory() as db:
+        stored = db.get(Peer, registered["id"])
+        assert stored.api_key_hash == Peer.hash_api_key(registered["api_key"])
+
+    assert client.get("/api/peers/", headers=headers).status_code == 200
+    listed = client.get("/api/peers/", headers=headers).json()
+    assert "api_key" not in listed[0]
+    assert auth_cache.stats()["hits"] == 1
+    assert auth_cache.stats()["misses"] == 1
+
+
+def test_disabling_a_peer_invalidates_its_key(client, session_factory):
+    admin = register(client, "admin-1", 2)
+    target = register(client, "peer-2", 3)
+    make_admin(session_factory, admin["id"])
+
+    admin_headers = {"X-API-Key": admin["api_key"]}
+    target_headers = {"X-API-Key": target["api_key"]}
+    assert client.get("/api/peers/", headers=target_headers).status_code == 200
+
+    response = client.post(f"/api/peers/{target['id']}/disable", headers=admin_headers)
+    assert response.status_code == 200
+    assert client.get("/api/peers/", headers=target_headers).status_code == 403
+
+
+def test_keys_revoked_by_another_worker_stop_working_at_once(
+    client, session_factory, monkeypatch
+):
+    monkeypatch.setattr(peer_registry, "shared", True)
+    admin = register(client, "admin-1", 2)
+    headers = {"X-API-Key": admin["api_key"]}
+    make_admin(session_factory, admin["id"])
+    assert client.get("/api/invites/", headers=headers).status_code == 200
+
+    # Demoted, then disabled, by a worker whose cache this one cannot clear
+    with session_factory() as db:
+        db.get(Peer, admin["id"]).is_admin = False
+        db.commit()
+    assert client.get("/api/invites/", headers=headers).status_code == 403
+    with session_factory() as db:
+        db.get(Peer, admin["id"]).is_enabled = False
+        db.commit()
+    assert client.get("/api/peers/", headers=headers).status_code == 403
+    assert auth_cache.stats()["size"] == 0
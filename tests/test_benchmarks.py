@@ -0,0 +1,38 @@
+"""Tests for the benchmark harness"""
+
+from benchmarks import cases  # noqa: F401, registers the benchmarks
+from benchmarks.harness import Benchmark, compare, load_baseline, save_baseline, select
+
+
+def test_benchmark_times_calls_and_cleans_up():
+    events = []
+
+    def case(size):
+        events.append(("setup", size))
+        yield lambda: events.append("call")
+        events.append("teardown")
+
+    result = Benchmark("case", case, {"size": 3}, number=2, repeat=3).run()
+
+    # One warm-up call, then 3 timings of 2 calls
+    assert events == [("setup", 3)] + ["call"] * 7 + ["teardown"]
+    assert result["repeat"] == 3 and result["min"] <= result["median"]
+
+
+def test_regressions_beyond_tolerance_are_reported(tmp_path):
+    path = str(tmp_path / "baseline.json")
+    save_baseline(path, {"fast": {"min": 1.0, "median": 1.0}})
+    baseline = load_baseline(path)
+
+    assert compare({"fast": {"min": 1.4, "median": 2.0}}, baseline, 0.5) == []
+    regressions = compare({"fast": {"min": 1.6, "median": 1.6}}, baseline, 0.5)
+    assert len(regressions) == 1 and regressions[0].startswith("fast:")
+    # Benchmarks without a baseline never fail
+    assert compare({"new": {"min": 9.0, "median": 9.0}}, baseline) == []
+    assert load_baseline(str(tmp_path / "missing.json")) == {}
+
+
+def test_register_benchmark_runs():
+    (registered,) = select("api.register")
+    bench = Benchmark(registered.name, registered.function, {}, number=2, repeat=1)
+    assert bench.run()["median"] > 0
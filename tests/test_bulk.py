@@ -0,0 +1,65 @@
+"""Tests for the bulk peer endpoints"""
+
+from conftest import make_admin, register
+
+
+def peer_body(i: int) -> dict:
+    return {
+        "name": f"bulk-{i}",
+        "public_key": f"bulk-{i}".ljust(44, "k"),
+        "assigned_ip": f"10.1.{i // 256}.{i % 256}/16",
+    }
+
+
+def admin_headers(client, session_factory) -> dict:
+    admin = register(client, "admin", 250)
+    make_admin(session_factory, admin["id"])
+    return {"X-API-Key": admin["api_key"]}
+
+
+def test_bulk_register_reports_each_item(client, session_factory, backend):
+    headers = admin_headers(client, session_factory)
+    applied_before = len(backend.applied)
+    peers = [peer_body(i) for i in range(20)] + [peer_body(3)]
+
+    response = client.post(
+        "/api/peers/bulk/register", json={"peers": peers}, headers=headers
+    )
+
+    body = response.json()
+    assert body["succeeded"] == 20 and body["failed"] == 1
+    assert body["results"][20]["error"] == "Peer name already exists"
+    assert all(item["peer"]["api_key"] for item in body["results"][:20])
+    # One kernel update for the whole batch
+    assert len(backend.applied) == applied_before + 1
+    assert len(backend.peers) == 21
+
+
+def test_bulk_disable_and_delete(client, session_factory, backend):
+    headers = admin_headers(client, session_factory)
+    created = client.post(
+        "/api/peers/bulk/register",
+        json={"peers": [peer_body(i) for i in range(5)]},
+        headers=headers,
+    ).json()["results"]
+    ids = [item["peer_id"] for item in created]
+    freed_ips = {backend.peers[peer_body(i)["public_key"]] for i in range(5)}
+
+    disabled = client.post(
+        "/api/peers/bulk/disable", json={"peer_ids": ids[:2] + [9999]}, headers=headers
+    ).json()
+    assert disabled["succeeded"] == 2
+    assert disabled["results"][2]["error"] == "Peer not found"
+    assert len(backend.peers) == 4
+
+    deleted = client.post(
+        "/api/peers/bulk/delete", json={"peer_ids": ids}, headers=headers
+    ).json()
+    assert deleted["succeeded"] == 5
+    assert len(backend.peers) == 1
+
+    # Freed addresses are reused
+    client.post(
+        "/api/peers/bulk/register", json={"peers": [peer_body(7)]}, headers=headers
+    )
+    assert backend.peers[peer_body(7)["public_key"]] in freed_ips
@@ -0,0 +1,122 @@
+"""Tests for the change feed"""
+
+import asyncio
+from datetime import datetime
+
+from sqlalchemy import func, select
+
+from conftest import make_admin, register
+from server.database.models import Change, Peer
+from server.routes.changes import _events
+from server.services.changes import ChangeFeed, change_feed
+
+
+class NoDb:
+    """Stands in for the session when everything is served from memory"""
+
+    async def close(self):
+        pass
+
+
+def entry(rev: int) -> dict:
+    return {
+        "rev": rev,
+        "kind": "peer.updated",
+        "peer_id": 1,
+        "data": {},
+        "time": datetime.now(),
+    }
+
+
+def test_feed_follows_peer_changes(client, session_factory):
+    admin = register(client, "admin", 2)
+    make_admin(session_factory, admin["id"])
+    headers = {"X-API-Key": admin["api_key"]}
+    since = int(client.get("/api/peers/", headers=headers).headers["X-Change-Revision"])
+
+    peer = register(client, "laptop", 3)
+    client.post(f"/api/peers/{peer['id']}/disable", headers=headers)
+    client.delete(f"/api/peers/{peer['id']}", headers=headers)
+
+    page = client.get(f"/api/changes/?since={since}", headers=headers).json()
+    assert [change["kind"] for change in page["changes"]] == [
+        "peer.created",
+        "ip.allocated",
+        "peer.disabled",
+        "ip.released",
+        "peer.deleted",
+    ]
+    assert page["changes"][0]["data"]["name"] == "laptop"
+    assert page["changes"][1]["data"] == {"ip_address": "10.0.0.3"}
+    assert page["next"] == page["changes"][-1]["rev"] and not page["more"]
+
+    # Nothing newer: an empty page pointing at the same revision
+    empty = client.get(f"/api/changes/?since={page['next']}", headers=headers).json()
+    assert empty == {"changes": [], "next": page["next"], "more": False}
+
+    # The log survives restarts; the in-memory tail is only a cache
+    with session_factory() as session:
+        change_feed.load(session)
+    again = client.get(f"/api/changes/?since={since}", headers=headers).json()
+    assert again == page
+
+    ahead = client.get(f"/api/changes/?since={page['next'] + 5}", headers=headers)
+    assert ahead.status_code == 410
+
+
+def test_revisions_are_assigned_at_commit(session_factory):
+    with session_factory() as session:
+        session.add(
+            Peer(
+                name="laptop",
+                public_key="k" * 44,
+                assigned_ip="10.0.0.3/24",
+                api_key_hash="h",
+            )
+        )
+        session.flush()
+        # Flushed but not committed: no revision is taken yet
+        assert session.scalar(select(func.count(Change.id))) == 0
+        session.commit()
+        rev = session.scalar(select(func.max(Change.id)))
+    assert rev == change_feed.latest == 1
+
+
+def test_latest_never_goes_back():
+    feed = ChangeFeed(tail_size=10)
+    feed.loaded = True
+    feed.append([entry(1)], 0)
+    # Threads publish their commits in any order
+    feed.append([entry(3)], 0)
+    feed.append([entry(2)], 0)
+    assert feed.latest == 3
+    assert [e["rev"] for e in feed._tail] == [3]
+
+
+def test_long_poll_wakes_on_commit():
+    async def scenario():
+        feed = ChangeFeed(tail_size=10)
+        feed.loaded = True
+        loop = asyncio.get_running_loop()
+        loop.call_later(0.05, feed.append, [entry(1), entry(2)], 0)
+        start = loop.time()
+        assert await feed.wait(NoDb(), 0, 5)
+        assert loop.time() - start < 1
+        assert [e["rev"] for e in await feed.read(NoDb(), 1, 10)] == [2]
+        assert not await feed.wait(NoDb(), 2, 0.01)
+
+    asyncio.run(scenario())
+
+
+def test_event_stream_format():
+    class Request:
+        async def is_disconnected(self):
+            return True
+
+    async def collect():
+        return [chunk async for chunk in _events(Request(), NoDb(), 0, [entry(1)])]
+
+    chunks = asyncio.run(collect())
+    assert chunks[0] == "retry: 3000\n\n"
+    assert chunks[1].startswith('id: 1\nevent: peer.updated\ndata: {"rev":1,')
+    assert chunks[1].endswith("}\n\n")
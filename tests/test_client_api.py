@@ -0,0 +1,92 @@
+"""Tests for the client's API session and state cache"""
+
+import asyncio
+import os
+import sys
+
+import httpx
+
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), "..", "client"))
+
+from api import AspenApi  # noqa: E402
+from state import STATE_VERSION, ClientState, load_state, save_state  # noqa: E402
+from tasks import BackgroundTasks  # noqa: E402
+
+
+def make_state(**overrides) -> ClientState:
+    fields = {
+        "server_url": "http://vpn",
+        "name": "laptop",
+        "private_key": "p" * 44,
+        "public_key": "k" * 44,
+        "assigned_ip": "10.0.0.2/24",
+        "api_key": "vpn_key",
+        "server_public_key": "s" * 44,
+        "endpoint": "192.0.2.1",
+        "port": 51820,
+    }
+    return ClientState(**{**fields, **overrides})
+
+
+def test_state_is_reused_only_for_its_server_and_version(tmp_path):
+    path = str(tmp_path / "state.json")
+    save_state(make_state(), path)
+
+    assert load_state("http://vpn", path) == make_state()
+    assert load_state("http://other", path) is None
+    assert os.stat(path).st_mode & 0o777 == 0o600
+
+    save_state(make_state(version=STATE_VERSION - 1), path)
+    assert load_state("http://vpn", path) is None
+
+    # e.g. the pickle files of older clients
+    with open(path, "wb") as f:
+        f.write(b"\x80\x04garbage")
+    assert load_state("http://vpn", path) is None
+
+
+def test_register_then_revalidate_from_cache(client):
+    requests = []
+
+    async def scenario():
+        transport = httpx.ASGITransport(app=client.app)
+        original = transport.handle_async_request
+
+        async def counting(request):
+            requests.append(request.url.path)
+            return await original(request)
+
+        transport.handle_async_request = counting
+        async with AspenApi("http://vpn", transport=transport) as api:
+            registered = await api.register("laptop", "k" * 44, "10.0.0.2/24")
+            api.api_key = registered["api_key"]
+            first = await api.peers()
+            # The page is unchanged, so it comes back as a 304 with no body
+            again = await api.peers()
+        return first, again
+
+    first, again = asyncio.run(scenario())
+
+    assert [peer["name"] for peer in first] == ["laptop"]
+    assert again == first
+    assert requests == ["/api/peers/register", "/api/peers/", "/api/peers/"]
+
+
+def test_background_tasks_are_held_reported_and_cancelled(capsys):
+    async def scenario():
+        background = BackgroundTasks()
+
+        async def fail():
+            raise RuntimeError("server gone")
+
+        background.spawn(fail(), name="revalidate")
+        sleeper = background.spawn(asyncio.sleep(60))
+        assert len(background.tasks) == 2
+        await asyncio.sleep(0)
+        await background.shutdown()
+        return background, sleeper
+
+    background, sleeper = asyncio.run(scenario())
+
+    assert sleeper.cancelled() and not background.tasks
+    assert "revalidate failed: RuntimeError('server gone')" in capsys.readouterr().out
@@ -0,0 +1,63 @@
+"""Tests for the client's sysfs and netlink interface monitor"""
+
+import os
+import struct
+import sys
+
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), "..", "client"))
+
+from interfaces import (  # noqa: E402
+    IFF_UP,
+    RTM_DELLINK,
+    RTM_NEWLINK,
+    InterfaceMonitor,
+    read_link,
+)
+
+
+def make_link(root, name, index, flags):
+    path = root / name
+    path.mkdir()
+    (path / "ifindex").write_text(f"{index}\n")
+    (path / "flags").write_text(f"{flags:#x}\n")
+
+
+def link_message(kind, name, index, flags):
+    """An RTM_NEWLINK/RTM_DELLINK message as the kernel sends it"""
+    value = name.encode() + b"\0"
+    attr = struct.pack("=HH", 4 + len(value), 3) + value
+    attr += b"\0" * (-len(attr) % 4)
+    body = struct.pack("=BxHiII", 0, 1, index, flags, 0) + attr
+    return struct.pack("=IHHII", 16 + len(body), kind, 0, 0, 0) + body
+
+
+def test_read_link_matches_names_exactly(tmp_path):
+    make_link(tmp_path, "wg10", 7, IFF_UP)
+
+    assert read_link("wg1", str(tmp_path)) is None
+    link = read_link("wg10", str(tmp_path))
+    assert link.index == 7 and link.up
+
+
+def test_link_events_update_the_cache(tmp_path):
+    make_link(tmp_path, "wg1", 5, 0)
+    monitor = InterfaceMonitor(str(tmp_path))
+    # Pretend start() succeeded, so lookups are cached
+    monitor._socket = object()
+    seen = []
+    monitor.subscribe(lambda name, state: seen.append((name, state)))
+
+    assert not monitor.is_up("wg1")
+    assert not monitor.exists("wg2")
+
+    monitor.handle(
+        link_message(RTM_NEWLINK, "wg1", 5, IFF_UP)
+        + link_message(RTM_NEWLINK, "wg2", 6, 0)
+    )
+    assert monitor.is_up("wg1")
+    assert monitor.exists("wg2")
+
+    monitor.handle(link_message(RTM_DELLINK, "wg1", 5, 0))
+    assert not monitor.exists("wg1")
+    assert [name for name, _ in seen] == ["wg1", "wg2", "wg1"]
+    assert seen[-1][1] is None
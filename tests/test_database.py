@@ -0,0 +1,89 @@
+"""Tests for database engine configuration"""
+
+from sqlalchemy import inspect, text
+from sqlalchemy.orm import Session
+
+from server.database.models import Invite, IPAllocation, Peer, ip_sort_key
+from server.database.session import build_engines, engine_options
+from server.database.upgrade import SCHEMA_VERSION, upgrade_database
+
+
+def test_sqlite_file_uses_wal_and_timed_pool(tmp_path):
+    engine, _ = build_engines(f"sqlite:///{tmp_path / 'vpn.db'}")
+    with engine.connect() as connection:
+        assert connection.execute(text("PRAGMA journal_mode")).scalar() == "wal"
+        # 1 == NORMAL
+        assert connection.execute(text("PRAGMA synchronous")).scalar() == 1
+
+    assert engine.pool.stats.snapshot()["checkouts"] == 1
+
+
+def test_postgres_gets_server_pool_options():
+    options = engine_options("postgresql://vpn@db/vpn", is_async=True)
+    assert options["pool_pre_ping"]
+    assert options["poolclass"].__name__ == "TimedAsyncAdaptedQueuePool"
+
+
+def test_sqlite_memory_keeps_default_pool():
+    assert "poolclass" not in engine_options("sqlite://")
+
+
+# Tables as created by the first release, before keys were hashed
+BASELINE_SCHEMA = (
+    """CREATE TABLE peers (
+        id INTEGER NOT NULL, name VARCHAR NOT NULL, public_key VARCHAR NOT NULL,
+        assigned_ip VARCHAR NOT NULL, is_enabled BOOLEAN NOT NULL,
+        api_key VARCHAR NOT NULL, is_admin BOOLEAN NOT NULL, description TEXT,
+        created_at DATETIME NOT NULL, last_modified DATETIME NOT NULL,
+        PRIMARY KEY (id), UNIQUE (name), UNIQUE (public_key),
+        UNIQUE (assigned_ip), UNIQUE (api_key))""",
+    """CREATE TABLE ip_allocations (
+        id INTEGER NOT NULL, ip_address VARCHAR NOT NULL, peer_id INTEGER,
+        is_reserved BOOLEAN NOT NULL, created_at DATETIME NOT NULL,
+        PRIMARY KEY (id), UNIQUE (peer_id), FOREIGN KEY(peer_id) REFERENCES peers (id))""",
+    "CREATE UNIQUE INDEX ix_ip_allocations_ip_address ON ip_allocations (ip_address)",
+    """CREATE TABLE invites (
+        id INTEGER NOT NULL, code VARCHAR NOT NULL, expires_at DATETIME,
+        created_at DATETIME NOT NULL, used_by INTEGER, last_modified DATETIME NOT NULL,
+        PRIMARY KEY (id), UNIQUE (code), FOREIGN KEY(used_by) REFERENCES peers (id))""",
+    """INSERT INTO peers VALUES (1, 'laptop', 'key', '10.0.0.2/24', 1,
+        'vpn_secret', 0, NULL, '2024-01-01', '2024-01-01')""",
+    "INSERT INTO ip_allocations VALUES (1, '10.0.0.2', 1, 0, '2024-01-01')",
+    "INSERT INTO invites VALUES (1, 'code', NULL, '2024-01-01', NULL, '2024-01-01')",
+)
+
+
+def test_baseline_database_is_upgraded_in_place(tmp_path):
+    engine, _ = build_engines(f"sqlite:///{tmp_path / 'vpn.db'}")
+    with engine.begin() as connection:
+        for statement in BASELINE_SCHEMA:
+            connection.exec_driver_sql(statement)
+
+    assert upgrade_database(engine) == 0
+    with Session(engine) as session:
+        peer = session.get(Peer, 1)
+        assert peer.api_key_hash == Peer.hash_api_key("vpn_secret")
+        assert session.get(IPAllocation, 1).ip_key == ip_sort_key("10.0.0.2")
+        assert session.get(Invite, 1).uses_left == 1
+        # New rows fit the upgraded tables
+        session.add(
+            Peer(
+                name="phone",
+                public_key="key2",
+                assigned_ip="10.0.0.3/24",
+                api_key_hash=Peer.hash_api_key("vpn_other"),
+            )
+        )
+        session.commit()
+    with engine.connect() as connection:
+        columns = {c["name"] for c in inspect(connection).get_columns("peers")}
+    assert "api_key" not in columns and {"last_seen", "policy_id"} <= columns
+
+    # Already current: nothing left to do
+    assert upgrade_database(engine) == SCHEMA_VERSION
+
+
+def test_new_database_starts_at_the_current_version(tmp_path):
+    engine, _ = build_engines(f"sqlite:///{tmp_path / 'vpn.db'}")
+    assert upgrade_database(engine) == SCHEMA_VERSION
+    assert upgrade_database(engine) == SCHEMA_VERSION
@@ -0,0 +1,118 @@
+"""Tests for invite minting, redemption and expiry"""
+
+from datetime import datetime, timedelta
+
+import pytest
+from sqlalchemy import Engine, event, insert, select
+
+from conftest import make_admin, register
+from server import config
+from server.database.models import Invite, Peer
+from server.services.invites import InviteSweeper
+
+
+def register_with(client, name: str, host: int, code=None):
+    body = {
+        "name": name,
+        "public_key": f"{name:k<44}",
+        "assigned_ip": f"10.0.0.{host}/24",
+    }
+    if code is not None:
+        body["invite_code"] = code
+    return client.post("/api/peers/register", json=body)
+
+
+def test_minted_codes_are_redeemed_once_per_use(client, session_factory):
+    admin = register(client, "admin", 2)
+    make_admin(session_factory, admin["id"])
+    headers = {"X-API-Key": admin["api_key"]}
+
+    batch = client.post(
+        "/api/invites/",
+        json={"count": 500, "uses": 2, "expires_in": 3600, "description": "fall"},
+        headers=headers,
+    ).json()
+    assert batch["count"] == 500 and len(set(batch["codes"])) == 500
+    code = batch["codes"][0]
+
+    first = register_with(client, "laptop", 3, code)
+    assert first.status_code == 200
+    assert register_with(client, "phone", 4, code).status_code == 200
+    used_up = register_with(client, "tablet", 5, code)
+    assert used_up.status_code == 403
+    assert register_with(client, "tablet", 5, "nope").status_code == 403
+
+    # A failed redemption leaves no peer behind
+    with session_factory() as session:
+        assert session.scalar(select(Peer).where(Peer.name == "tablet")) is None
+        invite = session.scalar(select(Invite).where(Invite.code == code))
+        assert invite.uses_left == 0 and invite.used_by is not None
+
+    page = client.get("/api/invites/?active=false", headers=headers).json()
+    assert [invite["code"] for invite in page] == [code]
+    assert len(client.get("/api/invites/?limit=1000", headers=headers).json()) == 500
+
+
+def test_invite_required_for_self_registration(client, monkeypatch):
+    monkeypatch.setattr(config, "INVITES_REQUIRED", True)
+    response = register_with(client, "laptop", 3)
+    assert response.status_code == 403
+    assert response.json()["detail"] == "Invite code required"
+
+
+def test_sweeper_deletes_expired_invites_in_batches(session_factory):
+    now = datetime.utcnow()
+    rows = [
+        {"code": f"old-{i}", "expires_at": now - timedelta(hours=1)} for i in range(5)
+    ]
+    rows += [{"code": "fresh", "expires_at": now + timedelta(hours=1)}]
+    rows += [{"code": "forever", "expires_at": None}]
+    with session_factory() as session:
+        session.execute(insert(Invite), rows)
+        session.commit()
+
+    sweeper = InviteSweeper(batch_size=2, session_factory=session_factory)
+    assert sweeper.sweep(now) == 5
+    assert sweeper.sweep(now) == 0
+    with session_factory() as session:
+        left = session.scalars(select(Invite.code).order_by(Invite.code)).all()
+    assert left == ["forever", "fresh"]
+
+
+@pytest.fixture
+def foreign_keys():
+    """Enforce foreign keys on SQLite connections, as PostgreSQL does"""
+
+    def enable(dbapi_connection, connection_record):
+        cursor = dbapi_connection.cursor()
+        cursor.execute("PRAGMA foreign_keys=ON")
+        cursor.close()
+
+    event.listen(Engine, "connect", enable)
+    yield
+    event.remove(Engine, "connect", enable)
+
+
+# Requested before the client, so its connections are opened with the pragma
+def test_deleting_invited_peers_releases_their_invites(
+    foreign_keys, client, session_factory
+):
+    admin = register(client, "admin", 2)
+    make_admin(session_factory, admin["id"])
+    headers = {"X-API-Key": admin["api_key"]}
+    codes = client.post(
+        "/api/invites/", json={"count": 2}, headers=headers
+    ).json()["codes"]
+    laptop = register_with(client, "laptop", 3, codes[0]).json()
+    phone = register_with(client, "phone", 4, codes[1]).json()
+
+    deleted = client.delete(f"/api/peers/{laptop['id']}", headers=headers)
+    assert deleted.status_code == 200
+    bulk = client.post(
+        "/api/peers/bulk/delete", json={"peer_ids": [phone["id"]]}, headers=headers
+    )
+    assert bulk.status_code == 200
+
+    # No invite points at a deleted peer, whose id could be handed out again
+    with session_factory() as session:
+        assert session.scalars(select(Invite.used_by)).all() == [None, None]
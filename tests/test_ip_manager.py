@@ -0,0 +1,139 @@
+"""Tests for the free-list IP allocator"""
+
+import asyncio
+import ipaddress
+from concurrent.futures import ThreadPoolExecutor
+
+import pytest
+from sqlalchemy import create_engine
+from sqlalchemy.ext.asyncio import AsyncSession, create_async_engine
+from sqlalchemy.orm import sessionmaker
+
+from server.database.models import Base, IPAllocation
+from server.services.ip_manager import AddressPool, IPManager
+from server.services.peer_registry import peer_registry
+
+
+def make_session_factory(url: str = "sqlite://"):
+    engine = create_engine(url, connect_args={"check_same_thread": False})
+    Base.metadata.create_all(bind=engine)
+    return sessionmaker(bind=engine)
+
+
+def test_pool_reuses_released_addresses():
+    pool = AddressPool(ipaddress.ip_network("10.0.0.0/30"))
+    first, second = pool.claim(), pool.claim()
+    assert {pool.address(first), pool.address(second)} == {"10.0.0.1", "10.0.0.2"}
+    with pytest.raises(RuntimeError):
+        pool.claim()
+
+    pool.release(first)
+    assert pool.claim() == first
+
+
+def test_pool_handles_large_ipv6_networks():
+    pool = AddressPool(ipaddress.ip_network("fd00::/64"))
+    assert pool.size == 2**64 - 1
+    assert pool.address(pool.claim()) == "fd00::1"
+
+
+def test_allocation_skips_rows_loaded_from_table():
+    db = make_session_factory()()
+    manager = IPManager("10.0.0.0/24", "10.0.0.1")
+    db.add(IPAllocation(ip_address="10.0.0.3", peer_id=None))
+    manager.initialize_ip_pool(db)
+
+    assert manager.allocate_ip(db, 1) == "10.0.0.2"
+    assert manager.allocate_ip(db, 2) == "10.0.0.4"
+
+    manager.release_ip(db, 1)
+    assert manager.allocate_ip(db, 3) == "10.0.0.2"
+
+
+def test_allocation_retries_addresses_taken_by_another_process():
+    db = make_session_factory()()
+    manager = IPManager("10.0.0.0/24", "10.0.0.1")
+    manager.initialize_ip_pool(db)
+
+    # Written behind the manager's back, as another worker would
+    db.add(IPAllocation(ip_address="10.0.0.2", peer_id=99))
+    db.commit()
+
+    assert manager.allocate_ip(db, 1) == "10.0.0.3"
+
+
+def test_concurrent_allocations_get_distinct_addresses(tmp_path):
+    factory = make_session_factory(f"sqlite:///{tmp_path / 'vpn.db'}")
+    manager = IPManager("10.0.0.0/16", "10.0.0.1")
+    with factory() as db:
+        manager.initialize_ip_pool(db)
+
+    def allocate(peer_id):
+        with factory() as db:
+            return manager.allocate_ip(db, peer_id)
+
+    with ThreadPoolExecutor(max_workers=8) as executor:
+        ips = list(executor.map(allocate, range(1, 201)))
+
+    assert len(set(ips)) == 200
+
+
+def test_async_allocation_shares_the_pool(tmp_path):
+    path = tmp_path / "vpn.db"
+    db = make_session_factory(f"sqlite:///{path}")()
+    manager = IPManager("10.0.0.0/24", "10.0.0.1")
+    manager.initialize_ip_pool(db)
+    assert manager.allocate_ip(db, 1) == "10.0.0.2"
+
+    async def allocate():
+        engine = create_async_engine(f"sqlite+aiosqlite:///{path}")
+        async with AsyncSession(engine) as session:
+            ip = await manager.allocate_ip_async(session, 2)
+            await manager.release_ip_async(session, 1)
+        await engine.dispose()
+        return ip
+
+    assert asyncio.run(allocate()) == "10.0.0.3"
+    assert manager.allocate_ip(db, 3) == "10.0.0.2"
+
+
+def test_registration_survives_an_address_taken_by_another_process(
+    client, session_factory
+):
+    from conftest import register
+
+    register(client, "laptop", 3)
+    # Another worker takes the next address; the API's pool does not know
+    with session_factory() as session:
+        session.add(IPAllocation(ip_address="10.0.0.3", peer_id=None))
+        session.commit()
+
+    peer = register(client, "phone", 4)
+    assert peer["name"] == "phone" and peer["api_key"].startswith("vpn_")
+    with session_factory() as session:
+        allocation = session.query(IPAllocation).filter_by(peer_id=peer["id"]).one()
+    assert allocation.ip_address == "10.0.0.4"
+
+
+def test_workers_catch_up_with_each_others_allocations(tmp_path, monkeypatch):
+    monkeypatch.setattr(peer_registry, "shared", True)
+    factory = make_session_factory(f"sqlite:///{tmp_path / 'vpn.db'}")
+    # Two workers' managers over one database; the /27 has 29 peer addresses
+    a, b = IPManager("10.0.0.0/27", "10.0.0.1"), IPManager("10.0.0.0/27", "10.0.0.1")
+    with factory() as db:
+        a.initialize_ip_pool(db)
+        b.initialize_ip_pool(db)
+
+        # More addresses than b would get through one conflict at a time
+        for peer_id in range(1, 21):
+            a.allocate_ip(db, peer_id)
+        assert b.allocate_ip(db, 21) == "10.0.0.22"
+
+        # Addresses released on one worker are reused by the other
+        a.release_ip(db, 1)
+        assert [b.allocate_ip(db, peer_id) for peer_id in range(22, 31)] == [
+            *(f"10.0.0.{host}" for host in range(23, 31)),
+            "10.0.0.2",
+        ]
+        with pytest.raises(RuntimeError):
+            a.allocate_ip(db, 31)
@@ -0,0 +1,46 @@
+"""Tests for the Prometheus metrics endpoint"""
+
+from fastapi import FastAPI
+from fastapi.testclient import TestClient
+
+from conftest import register
+from server.routes import metrics as metrics_route
+from server.services.metrics import MetricsMiddleware, MetricsRegistry
+
+
+def test_registry_renders_text_format():
+    registry = MetricsRegistry()
+    requests = registry.counter("requests_total", "Requests", ("route",))
+    latency = registry.histogram("latency_seconds", "Latency", buckets=(0.1, 1.0))
+    requests.inc(route='/a"b')
+    requests.inc(2, route='/a"b')
+    latency.observe(0.05)
+    latency.observe(5)
+
+    text = registry.render()
+
+    assert '# TYPE requests_total counter\nrequests_total{route="/a\\"b"} 3\n' in text
+    assert 'latency_seconds_bucket{le="0.1"} 1\n' in text
+    assert 'latency_seconds_bucket{le="1.0"} 1\n' in text
+    assert 'latency_seconds_bucket{le="+Inf"} 2\n' in text
+    assert "latency_seconds_count 2\n" in text
+
+
+def test_metrics_cover_requests_peers_and_reconciles(client, backend):
+    register(client, "alpha", 2)
+    app = FastAPI()
+    app.include_router(metrics_route.router)
+    app.add_middleware(MetricsMiddleware)
+
+    with TestClient(app) as metrics_client:
+        metrics_client.get("/metrics")
+        text = metrics_client.get("/metrics").text
+
+    assert 'aspen_peers{state="enabled"} 1' in text
+    assert 'aspen_wg_peer_ops_total{op="add"}' in text
+    assert 'aspen_db_query_duration_seconds_count{operation="insert"}' in text
+    assert 'aspen_ip_pool_size{interface="wg0"} 253' in text
+    assert (
+        'aspen_http_request_duration_seconds_count{method="GET",route="/metrics",'
+        'status="200"} 1'
+    ) in text
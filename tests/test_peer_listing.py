@@ -0,0 +1,50 @@
+"""Tests for keyset pagination, filtering and NDJSON export of peers"""
+
+import json
+
+from conftest import make_admin, register
+
+
+def test_pages_follow_the_cursor(client):
+    keys = [register(client, f"peer-{i}", i + 2)["api_key"] for i in range(5)]
+    headers = {"X-API-Key": keys[0]}
+
+    first = client.get("/api/peers/?limit=2", headers=headers)
+    assert [peer["name"] for peer in first.json()] == ["peer-0", "peer-1"]
+
+    cursor = first.headers["X-Next-Cursor"]
+    second = client.get(f"/api/peers/?limit=2&after={cursor}", headers=headers)
+    assert [peer["name"] for peer in second.json()] == ["peer-2", "peer-3"]
+
+
+def test_filters_use_prefix_and_ip_range(client):
+    for i, name in enumerate(["web-1", "web-2", "db-1"]):
+        key = register(client, name, i + 2)["api_key"]
+    headers = {"X-API-Key": key}
+
+    by_prefix = client.get("/api/peers/?name_prefix=web", headers=headers).json()
+    assert [peer["name"] for peer in by_prefix] == ["web-1", "web-2"]
+
+    # Allocated IPs are 10.0.0.2, .3 and .4
+    by_range = client.get("/api/peers/?ip_range=10.0.0.4/31", headers=headers).json()
+    assert [peer["name"] for peer in by_range] == ["db-1"]
+
+    assert client.get("/api/peers/?ip_range=nope", headers=headers).status_code == 422
+
+
+def test_ndjson_export_is_admin_only(client, session_factory):
+    admin = register(client, "admin", 2)
+    other = register(client, "other", 3)
+    make_admin(session_factory, admin["id"])
+
+    response = client.get(
+        "/api/peers/?format=ndjson", headers={"X-API-Key": admin["api_key"]}
+    )
+    assert response.headers["content-type"] == "application/x-ndjson"
+    lines = [json.loads(line) for line in response.text.splitlines()]
+    assert [peer["name"] for peer in lines] == ["admin", "other"]
+
+    forbidden = client.get(
+        "/api/peers/?format=ndjson", headers={"X-API-Key": other["api_key"]}
+    )
+    assert forbidden.status_code == 403
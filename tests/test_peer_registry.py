@@ -0,0 +1,71 @@
+"""Tests for the in-memory peer registry"""
+
+import pytest
+from sqlalchemy import create_engine
+from sqlalchemy.orm import sessionmaker
+
+from server.database.models import Base, IPAllocation, Peer
+from server.database.session import AppSession
+from server.services.peer_registry import peer_registry
+
+
+@pytest.fixture
+def db():
+    engine = create_engine("sqlite://")
+    Base.metadata.create_all(bind=engine)
+    session = sessionmaker(bind=engine, class_=AppSession)()
+    peer_registry.load(session)
+    yield session
+    session.close()
+    peer_registry.clear()
+
+
+def add_peer(db, name: str, ip: str) -> Peer:
+    peer = Peer(
+        name=name,
+        public_key=f"{name}-key",
+        assigned_ip=f"{ip}/24",
+        api_key_hash=f"{name}-api",
+    )
+    db.add(peer)
+    db.flush()
+    db.add(IPAllocation(ip_address=ip, peer_id=peer.id))
+    db.commit()
+    return peer
+
+
+def test_commits_update_every_index(db):
+    peer = add_peer(db, "a", "10.0.0.2")
+
+    record = peer_registry.get(peer.id)
+    assert record.ip_address == "10.0.0.2"
+    assert peer_registry.get_by_name("a") is record
+    assert peer_registry.get_by_public_key("a-key") is record
+    assert peer_registry.get_by_ip("10.0.0.2") is record
+    assert not hasattr(record, "__dict__")
+
+
+def test_disable_and_delete_are_reflected(db):
+    first = add_peer(db, "a", "10.0.0.2")
+    second = add_peer(db, "b", "10.0.0.3")
+
+    first.is_enabled = False
+    db.commit()
+    assert peer_registry.desired_peers() == {"b-key": "10.0.0.3"}
+
+    db.delete(db.query(IPAllocation).filter_by(peer_id=second.id).one())
+    db.delete(second)
+    db.commit()
+    assert peer_registry.get(second.id) is None
+    assert peer_registry.get_by_ip("10.0.0.3") is None
+    assert [record.name for record in peer_registry.page()] == ["a"]
+
+
+def test_rolled_back_changes_are_discarded(db):
+    peer = add_peer(db, "a", "10.0.0.2")
+
+    peer.description = "changed"
+    db.flush()
+    db.rollback()
+
+    assert peer_registry.get(peer.id).description is None
@@ -0,0 +1,124 @@
+"""Tests for access policies and their nftables compilation"""
+
+import pytest
+
+from conftest import make_admin, register
+from server.services.policies import PolicyEngine, PolicyRule, policy_engine
+
+
+class FakeNft:
+    """Records the scripts sent to `nft -f -`"""
+
+    def __init__(self):
+        self.scripts = []
+
+    def __call__(self, command, input=None):
+        assert command[-3:] == ["nft", "-f", "-"]
+        self.scripts.append(input)
+        return ""
+
+
+def test_changes_only_touch_what_changed():
+    nft = FakeNft()
+    engine = PolicyEngine(run=nft, table="aspen")
+    web = PolicyRule(("10.1.0.0/16",), (80, 443))
+    assignments = {f"10.0.{i // 250}.{i % 250 + 2}": 1 for i in range(1000)}
+
+    engine.sync({1: web}, assignments)
+    first = nft.scripts[-1]
+    assert first.startswith("add table inet aspen\ndelete table inet aspen\n")
+    assert "add element inet aspen policy_1_ports { 80, 443 }" in first
+    assert "10.0.3.251 : jump policy_1" in first
+
+    # Nothing changed: nothing is sent
+    assert engine.sync({1: web}, dict(assignments)) == 0
+    assert len(nft.scripts) == 1
+
+    # One more peer under a new policy: one set pair, one chain, one element
+    ssh = PolicyRule(("192.168.0.0/24",), (22,))
+    engine.sync({1: web, 2: ssh}, {**assignments, "10.0.9.9": 2})
+    script = nft.scripts[-1]
+    assert "add chain inet aspen policy_2" in script
+    assert "add element inet aspen peer_policy { 10.0.9.9 : jump policy_2 }" in script
+    assert "policy_1" not in script
+
+    # Dropping a policy removes its peers from the map before its chain
+    engine.sync({1: web}, assignments)
+    lines = nft.scripts[-1].splitlines()
+    assert lines == [
+        "delete element inet aspen peer_policy { 10.0.9.9 }",
+        "delete chain inet aspen policy_2",
+        "delete set inet aspen policy_2_nets",
+        "delete set inet aspen policy_2_ports",
+    ]
+
+
+def test_failed_sync_rebuilds_the_table_next_time():
+    calls = []
+
+    def flaky(command, input=None):
+        calls.append(input)
+        if len(calls) == 2:
+            raise RuntimeError("nft: Could not process rule")
+        return ""
+
+    engine = PolicyEngine(run=flaky)
+    rule = PolicyRule(("10.1.0.0/16",))
+    engine.sync({1: rule}, {})
+    with pytest.raises(RuntimeError):
+        engine.sync({1: rule}, {"10.0.0.2": 1})
+    engine.sync({1: rule}, {"10.0.0.2": 1})
+    assert calls[-1].startswith("add table")
+    # Without ports, any port on the allowed networks is accepted
+    assert "add rule inet aspen policy_1 ip daddr @policy_1_nets accept" in calls[-1]
+
+
+def test_policy_routes_drive_the_engine(client, session_factory, monkeypatch):
+    nft = FakeNft()
+    monkeypatch.setattr(policy_engine, "run", nft)
+    monkeypatch.setattr(policy_engine, "enabled", True)
+    monkeypatch.setattr(policy_engine, "_applied", None)
+    admin = register(client, "admin", 2)
+    make_admin(session_factory, admin["id"])
+    peer = register(client, "laptop", 3)
+    headers = {"X-API-Key": admin["api_key"]}
+
+    created = client.post(
+        "/api/policies/",
+        json={
+            "name": "web",
+            "allowed_cidrs": ["10.1.2.0/24", "10.1.0.0/16"],
+            "allowed_ports": [443, 80],
+        },
+        headers=headers,
+    )
+    assert created.status_code == 200, created.text
+    policy = created.json()
+    assert policy["allowed_cidrs"] == ["10.1.0.0/16"]
+    assert policy["allowed_ports"] == [80, 443]
+
+    added = client.post(
+        f"/api/policies/{policy['id']}/peers",
+        json={"peer_ids": [peer["id"], 999]},
+        headers=headers,
+    )
+    assert added.json()["succeeded"] == 1
+    assert f"10.0.0.3 : jump policy_{policy['id']}" in nft.scripts[-1]
+    peer_info = client.get(f"/api/peers/{peer['id']}", headers=headers).json()
+    assert peer_info["policy_id"] == policy["id"]
+
+    # Lifting it from the peer only deletes the map element
+    lifted = client.put(
+        f"/api/peers/{peer['id']}", json={"policy_id": None}, headers=headers
+    )
+    assert lifted.status_code == 200 and lifted.json()["policy_id"] is None
+    assert nft.scripts[-1] == "delete element inet aspen peer_policy { 10.0.0.3 }\n"
+
+    missing = client.put(
+        f"/api/peers/{peer['id']}", json={"policy_id": 999}, headers=headers
+    )
+    assert missing.status_code == 404
+
+    deleted = client.delete(f"/api/policies/{policy['id']}", headers=headers)
+    assert deleted.status_code == 200
+    assert f"delete chain inet aspen policy_{policy['id']}" in nft.scripts[-1]
@@ -0,0 +1,110 @@
+"""Tests for the coalescing WireGuard provisioner"""
+
+import asyncio
+
+from conftest import make_admin, register
+from server.database.models import Peer
+from server.services.provisioner import Provisioner
+
+
+def test_concurrent_requests_share_one_update(session_factory, backend):
+    provisioner = Provisioner(window=0.01)
+
+    async def run():
+        jobs = [provisioner.submit(f"change {i}") for i in range(50)]
+        await asyncio.gather(*(provisioner.wait(job) for job in jobs))
+        await provisioner.stop()
+        return jobs
+
+    jobs = asyncio.run(run())
+
+    assert {job.status for job in jobs} == {"done"}
+    assert {job.batch_size for job in jobs} == {50}
+    assert provisioner.stats() == {"requests": 50, "batches": 1, "ops": 0}
+    # Nothing changed, so the reconciler skipped the kernel entirely
+    assert backend.applied == []
+
+
+def test_failed_update_is_reported_on_the_job(session_factory, monkeypatch):
+    class BrokenReconciler:
+        def reconcile(self, desired):
+            raise OSError("interface missing")
+
+    monkeypatch.setattr(
+        "server.services.provisioner.get_reconciler", lambda: BrokenReconciler()
+    )
+    provisioner = Provisioner(window=0)
+
+    async def run():
+        job = await provisioner.wait(provisioner.submit("change"))
+        await provisioner.stop()
+        return job
+
+    job = asyncio.run(run())
+    assert job.status == "failed"
+    assert job.error == "OSError: interface missing"
+
+
+def test_background_register_returns_pollable_job(client, backend):
+    peer = register(client, "alpha", 2)
+
+    response = client.post(
+        "/api/peers/register?background=true",
+        json={
+            "name": "beta",
+            "public_key": "beta".ljust(44, "k"),
+            "assigned_ip": "10.0.0.3/24",
+        },
+    )
+
+    assert response.status_code == 202
+    body = response.json()
+    assert body["result"]["name"] == "beta" and body["result"]["api_key"]
+    assert response.headers["Location"] == f"/api/jobs/{body['job']['id']}"
+
+    headers = {"X-API-Key": peer["api_key"]}
+    for _ in range(100):
+        job = client.get(response.headers["Location"], headers=headers).json()
+        if job["status"] == "done":
+            break
+    assert job["status"] == "done"
+    assert "beta".ljust(44, "k") in backend.peers
+    assert client.get("/api/jobs/missing", headers=headers).status_code == 404
+
+
+def test_background_jobs_are_refused_with_several_workers(
+    client, session_factory, monkeypatch
+):
+    admin = register(client, "admin", 2)
+    make_admin(session_factory, admin["id"])
+    monkeypatch.setattr("server.routes.peers.peer_registry.shared", True)
+
+    # Refused before the change, as the job could only be polled on this worker
+    response = client.post(
+        f"/api/peers/{admin['id']}/disable?background=true",
+        headers={"X-API-Key": admin["api_key"]},
+    )
+    assert response.status_code == 400
+    with session_factory() as session:
+        assert session.get(Peer, admin["id"]).is_enabled
+
+
+def test_shared_mode_reads_every_workers_peers(monkeypatch):
+    class RecordingReconciler:
+        def reconcile(self, desired):
+            self.desired = desired
+
+    reconciler = RecordingReconciler()
+    monkeypatch.setattr(
+        "server.services.provisioner.get_reconciler", lambda: reconciler
+    )
+    monkeypatch.setattr("server.services.provisioner.peer_registry.shared", True)
+    provisioner = Provisioner(window=0)
+    provisioner.load_desired = lambda: {"other-worker-key": "10.0.0.7"}
+
+    async def run():
+        await provisioner.wait(provisioner.submit("change"))
+        await provisioner.stop()
+
+    asyncio.run(run())
+    assert reconciler.desired == {"other-worker-key": "10.0.0.7"}
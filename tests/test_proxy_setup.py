@@ -0,0 +1,148 @@
+"""Tests for the firewall rule engine in proxy_setup"""
+
+import subprocess
+
+from server import proxy_setup
+from server.proxy_setup import (
+    FORWARD_CHAIN,
+    NAT_CHAIN,
+    clear_iptables,
+    configure_iptables,
+    parse_ruleset,
+    set_ip_forwarding,
+)
+
+BASE = """# Generated by iptables-save
+*filter
+:INPUT ACCEPT [0:0]
+:FORWARD DROP [0:0]
+-A FORWARD -i docker0 -j ACCEPT
+COMMIT
+*nat
+:POSTROUTING ACCEPT [0:0]
+COMMIT
+"""
+
+
+class FakeIptables:
+    """Stands in for iptables-save/iptables-restore, keeping rules in memory"""
+
+    def __init__(self, saved: str = BASE):
+        self.tables = parse_ruleset(saved)
+        self.commands = []
+        self.fail_persist = False
+        # Table whose restores fail, as on a bad rule, and whether putting
+        # tables back fails too
+        self.fail_table = None
+        self.fail_put_back = False
+
+    def save(self) -> str:
+        lines = []
+        for table, chains in self.tables.items():
+            lines.append(f"*{table}")
+            lines += [f":{chain} - [0:0]" for chain in chains]
+            lines += [rule for rules in chains.values() for rule in rules]
+            lines.append("COMMIT")
+        return "\n".join(lines) + "\n"
+
+    def restore(self, text: str):
+        chains = None
+        for line in text.splitlines():
+            if line.startswith("*"):
+                chains = self.tables.setdefault(line[1:], {})
+            elif line.startswith(":"):
+                chains[line[1:].split()[0]] = []
+            elif line.startswith("-A "):
+                chains[line.split()[1]].append(line)
+            elif line.startswith("-D "):
+                chains[line.split()[1]].remove("-A" + line[2:])
+            elif line.startswith("-X "):
+                del chains[line.split()[1]]
+
+    def __call__(self, command, input=None):
+        if command[-1].endswith(proxy_setup.RULES_FILE) and self.fail_persist:
+            raise subprocess.CalledProcessError(1, command, stderr="read-only file system")
+        if command[-1] == "iptables-save":
+            self.commands.append("iptables-save")
+            return self.save()
+        if command[-1] == "--noflush":
+            if input.startswith(f"*{self.fail_table}\n"):
+                raise subprocess.CalledProcessError(1, command, stderr="bad rule")
+            self.commands.append("restore")
+            self.restore(input)
+        elif command[-2] == "--table":
+            if self.fail_put_back:
+                raise subprocess.CalledProcessError(1, command, stderr="locked")
+            # Without --noflush the table is replaced by the saved one
+            self.commands.append(f"put back {command[-1]}")
+            self.tables[command[-1]] = parse_ruleset(input)[command[-1]]
+        else:
+            self.commands.append(command[-1])
+        return ""
+
+def test_rules_apply_once_and_leave_other_rules_alone(monkeypatch):
+    monkeypatch.setattr(proxy_setup, "SUDO", [])
+    iptables = FakeIptables()
+
+    assert configure_iptables("wg0", "wg1", run=iptables)
+    forward = iptables.tables["filter"]
+    assert forward["FORWARD"] == [
+        "-A FORWARD -i docker0 -j ACCEPT",
+        f"-A FORWARD -j {FORWARD_CHAIN}",
+    ]
+    assert len(forward[FORWARD_CHAIN]) == 4
+    assert iptables.tables["nat"]["POSTROUTING"] == [f"-A POSTROUTING -j {NAT_CHAIN}"]
+    # One restore per table, as each commits on its own
+    assert iptables.commands.count("restore") == 2
+
+    # Already in place: only the read, no restore and no duplicate rules
+    iptables.commands.clear()
+    assert configure_iptables("wg0", "wg1", run=iptables)
+    assert iptables.commands == ["iptables-save"]
+
+    assert clear_iptables(run=iptables)
+    assert iptables.tables["filter"]["FORWARD"] == ["-A FORWARD -i docker0 -j ACCEPT"]
+    assert FORWARD_CHAIN not in iptables.tables["filter"]
+    assert NAT_CHAIN not in iptables.tables["nat"]
+
+
+def test_rules_that_cannot_be_persisted_still_count_as_applied(monkeypatch, capsys):
+    monkeypatch.setattr(proxy_setup, "SUDO", [])
+    iptables = FakeIptables()
+    iptables.fail_persist = True
+
+    assert configure_iptables("wg0", run=iptables)
+    assert len(iptables.tables["filter"][FORWARD_CHAIN]) == 2
+    out = capsys.readouterr().out
+    assert "applied but not persisted" in out and "nothing was changed" not in out
+
+    assert clear_iptables(run=iptables)
+    assert FORWARD_CHAIN not in iptables.tables["filter"]
+    assert "applied but not persisted" in capsys.readouterr().out
+
+
+def test_tables_are_put_back_when_a_later_one_fails(monkeypatch, capsys):
+    monkeypatch.setattr(proxy_setup, "SUDO", [])
+    iptables = FakeIptables()
+    before = parse_ruleset(iptables.save())
+    iptables.fail_table = "filter"
+
+    # nat commits first; the failed filter restore takes it back out
+    assert not configure_iptables("wg0", run=iptables)
+    assert iptables.commands[-1] == "put back nat"
+    assert iptables.tables == before
+    assert "nothing was changed" in capsys.readouterr().out
+
+    iptables.fail_put_back = True
+    assert not configure_iptables("wg0", run=iptables)
+    assert NAT_CHAIN in iptables.tables["nat"]
+    assert "partly applied" in capsys.readouterr().out
+
+
+def test_ip_forwarding_is_written_only_when_it_differs(tmp_path):
+    path = tmp_path / "ip_forward"
+    path.write_text("0\n")
+
+    assert set_ip_forwarding(True, str(path))
+    assert path.read_text() == "1"
+    assert not set_ip_forwarding(True, str(path))
@@ -0,0 +1,76 @@
+"""Tests for ETags and conditional GETs on peer reads"""
+
+from sqlalchemy import event
+from sqlalchemy.engine import Engine
+
+from conftest import make_admin, register
+from server import main
+from server.services.revision import state_revision
+
+
+def count_queries(call):
+    """Run `call` and return its result and the number of SQL statements"""
+    statements = []
+
+    def record(conn, cursor, statement, *args):
+        statements.append(statement)
+
+    event.listen(Engine, "before_cursor_execute", record)
+    try:
+        return call(), len(statements)
+    finally:
+        event.remove(Engine, "before_cursor_execute", record)
+
+
+def test_unchanged_list_is_answered_with_304_without_queries(client):
+    peer = register(client, "alpha", 2)
+    headers = {"X-API-Key": peer["api_key"]}
+
+    first = client.get("/api/peers/", headers=headers)
+    etag = first.headers["ETag"]
+    assert first.headers["Cache-Control"] == "private, no-cache"
+
+    again, queries = count_queries(
+        lambda: client.get("/api/peers/", headers={**headers, "If-None-Match": etag})
+    )
+    assert again.status_code == 304 and again.content == b""
+    assert again.headers["ETag"] == etag
+    assert queries == 0
+
+
+def test_mutations_bump_the_revision(client, session_factory):
+    peer = register(client, "alpha", 2)
+    make_admin(session_factory, peer["id"])
+    headers = {"X-API-Key": peer["api_key"]}
+    etag = client.get(f"/api/peers/{peer['id']}", headers=headers).headers["ETag"]
+    revision = state_revision.value
+
+    updated = client.put(
+        f"/api/peers/{peer['id']}", json={"description": "laptop"}, headers=headers
+    )
+    assert updated.status_code == 200
+
+    assert state_revision.value > revision
+    response = client.get(
+        f"/api/peers/{peer['id']}", headers={**headers, "If-None-Match": etag}
+    )
+    assert response.status_code == 200
+    assert response.json()["description"] == "laptop"
+    assert response.headers["ETag"] != etag
+
+
+def test_server_info_checks_the_key_before_answering_304(client, monkeypatch):
+    monkeypatch.setattr(main, "server_public_key", "server-key")
+    client.app.add_api_route("/api/server-info", main.get_server_info)
+    peer = register(client, "laptop", 2)
+    headers = {"X-API-Key": peer["api_key"]}
+
+    etag = client.get("/api/server-info", headers=headers).headers["ETag"]
+    cached = client.get("/api/server-info", headers={**headers, "If-None-Match": etag})
+    assert cached.status_code == 304
+
+    forged = client.get(
+        "/api/server-info",
+        headers={"X-API-Key": "vpn_forged", "If-None-Match": etag},
+    )
+    assert forged.status_code == 403
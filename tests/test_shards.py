@@ -0,0 +1,80 @@
+"""Tests for spreading peers over WireGuard interface shards"""
+
+from sqlalchemy import create_engine
+from sqlalchemy.orm import sessionmaker
+
+from server.database.models import Base
+from server.services.shards import ShardedIPManager
+from server.wireguard import InMemoryBackend, PeerReconciler, ShardedReconciler
+
+
+def make_session():
+    engine = create_engine("sqlite://")
+    Base.metadata.create_all(bind=engine)
+    return sessionmaker(bind=engine)()
+
+
+def make_manager(**kwargs) -> ShardedIPManager:
+    options = {"shards": 1, "max_shards": 3, "peer_limit": 2}
+    return ShardedIPManager("10.0.0.0/16", 24, 51820, **{**options, **kwargs})
+
+
+def test_peers_go_to_least_loaded_shard_and_new_shards_are_added():
+    db = make_session()
+    manager = make_manager()
+    manager.initialize_ip_pool(db)
+
+    ips = [manager.allocate_ip(db, peer_id) for peer_id in range(1, 8)]
+
+    assert ips == [
+        "10.0.0.2",
+        "10.0.0.3",
+        "10.0.1.2",  # wg0 full, wg1 added
+        "10.0.1.3",
+        "10.0.2.2",  # both full, wg2 added
+        "10.0.2.3",
+        "10.0.0.4",  # no more shards, least loaded wins
+    ]
+    assert [(s["interface"], s["port"], s["peers"]) for s in manager.stats()] == [
+        ("wg0", 51820, 3),
+        ("wg1", 51821, 2),
+        ("wg2", 51822, 2),
+    ]
+
+    # A restart brings back the shards that hold peers
+    restarted = make_manager()
+    restarted.load(db)
+    assert len(restarted.shards) == 3
+    assert restarted.shard_for_ip("10.0.1.3").interface == "wg1"
+    assert restarted.shard_index("192.168.0.1") is None
+
+
+def test_released_addresses_return_to_their_shard():
+    db = make_session()
+    manager = make_manager(shards=2)
+    manager.initialize_ip_pool(db)
+    manager.allocate_ip(db, 1)
+    ip = manager.allocate_ip(db, 2)
+    assert manager.shard_index(ip) == 1
+
+    manager.release_ip(db, 2)
+
+    assert manager.shards[1].peer_count == 0
+    assert manager.allocate_ip(db, 3) == ip
+
+
+def test_reconciler_keeps_each_shard_on_its_own_interface():
+    manager = make_manager()
+    backends = {}
+
+    def open_shard(index):
+        backends[index] = InMemoryBackend()
+        return PeerReconciler(backends[index])
+
+    reconciler = ShardedReconciler(manager.shard_index, open_shard)
+    reconciler.reconcile({"a-key": "10.0.0.2", "b-key": "10.0.1.2"})
+    changes = reconciler.reconcile({"a-key": "10.0.0.2"})
+
+    assert changes.remove == ["b-key"]
+    assert backends[0].peers == {"a-key": "10.0.0.2"}
+    assert backends[1].peers == {}
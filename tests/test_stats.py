@@ -0,0 +1,118 @@
+"""Tests for the peer statistics collector"""
+
+from conftest import register
+from server.database.models import Peer
+from server.routes import peers
+from server.services.peer_registry import peer_registry
+from server.services.stats import FakeCounterSource, StatsCollector, parse_dump
+
+DUMP = (
+    "wg0\tprivate\tpublic\t51820\toff\n"
+    "wg0\ta-key\t(none)\t203.0.113.5:4000\t10.0.0.2/32\t1700000000\t1200\t3400\t0\n"
+    "wg1\tprivate\tpublic\t51821\toff\n"
+    "wg1\tb-key\t(none)\t(none)\t10.0.1.2/32\t0\t0\t0\t25\n"
+)
+
+
+def test_dump_lists_peers_of_every_interface():
+    counters = parse_dump(DUMP)
+    assert counters["a-key"] == (1200, 3400, 1700000000)
+    assert counters["b-key"] == (0, 0, 0)
+
+
+def test_tiers_downsample_and_stay_bounded():
+    source = FakeCounterSource()
+    collector = StatsCollector(source, tiers=(("10s", 10, 4), ("1m", 60, 3)))
+
+    for step in range(13):
+        now = 1000.0 * 60 + step * 10
+        source.set("a-key", rx_bytes=step * 100, tx_bytes=step * 10)
+        if step < 3:
+            source.set("gone-key", rx_bytes=step, tx_bytes=step)
+        else:
+            source.counters.pop("gone-key", None)
+        collector.sample(now)
+
+    fine, coarse = collector.tiers["10s"], collector.tiers["1m"]
+    assert fine.count == 4 and coarse.count == 3
+    # Peers absent for a whole ring are forgotten
+    assert set(fine.series) == {"a-key"}
+
+    points = fine.peer_points("a-key")
+    assert len(points) == 3
+    assert points[-1]["rx_bytes"] == 100
+    assert points[-1]["rx_rate"] == 10.0
+
+    # One sample per minute, so each step covers six 10s samples
+    assert [point["rx_bytes"] for point in coarse.peer_points("a-key")] == [600, 600]
+    totals = collector.aggregate("1m")
+    assert totals["rx_bytes"] == 1200
+    assert [point["tx_bytes"] for point in totals["points"]] == [60, 60]
+
+
+def test_handshakes_update_last_seen(session_factory):
+    with session_factory() as session:
+        session.add(
+            Peer(
+                name="a",
+                public_key="a-key",
+                assigned_ip="10.0.0.2/24",
+                api_key_hash="a-api",
+            )
+        )
+        session.commit()
+
+    source = FakeCounterSource()
+    collector = StatsCollector(
+        source, persist_interval=60, session_factory=session_factory
+    )
+    source.set("a-key", 0, 0, latest_handshake=1700000000)
+    collector.sample(1700000005)
+
+    assert peer_registry.get_by_public_key("a-key").last_seen.timestamp() == (
+        1700000000
+    )
+    with session_factory() as session:
+        assert session.query(Peer).one().last_seen is not None
+
+
+def test_peer_stats_route(client, monkeypatch):
+    source = FakeCounterSource()
+    collector = StatsCollector(source)
+    monkeypatch.setattr(peers, "stats_collector", collector)
+    alice, bob = register(client, "alice", 2), register(client, "bob", 3)
+
+    source.set("alice".ljust(44, "k"), 500, 50, latest_handshake=1700000000)
+    collector.sample(1700000000)
+    source.set("alice".ljust(44, "k"), 1500, 150, latest_handshake=1700000000)
+    collector.sample(1700000010)
+
+    response = client.get(
+        f"/api/peers/{alice['id']}/stats", headers={"X-API-Key": alice["api_key"]}
+    )
+    assert response.status_code == 200
+    body = response.json()
+    assert body["rx_bytes"] == 1500
+    assert body["points"][0]["rx_rate"] == 100.0
+
+    forbidden = client.get(
+        f"/api/peers/{alice['id']}/stats", headers={"X-API-Key": bob["api_key"]}
+    )
+    assert forbidden.status_code == 403
+    aggregate = client.get("/api/peers/stats", headers={"X-API-Key": bob["api_key"]})
+    assert aggregate.status_code == 403
+
+
+def test_handshakes_keep_etags_valid(client, monkeypatch):
+    source = FakeCounterSource()
+    collector = StatsCollector(source)
+    monkeypatch.setattr(peers, "stats_collector", collector)
+    alice = register(client, "alice", 2)
+    headers = {"X-API-Key": alice["api_key"]}
+    etag = client.get("/api/peers/", headers=headers).headers["ETag"]
+
+    source.set("alice".ljust(44, "k"), 0, 0, latest_handshake=1700000000)
+    collector.sample(1700000005)
+
+    cached = client.get("/api/peers/", headers={**headers, "If-None-Match": etag})
+    assert cached.status_code == 304
@@ -0,0 +1,72 @@
+"""Tests for request tracing"""
+
+import json
+
+import pytest
+from fastapi.testclient import TestClient
+
+from conftest import register
+from server.services.tracing import TracingMiddleware, format_tree, tracer
+
+
+@pytest.fixture
+def traces(tmp_path, monkeypatch):
+    """Enable tracing into a fresh file and return its path"""
+    path = tmp_path / "traces.jsonl"
+    monkeypatch.setattr(tracer, "enabled", True)
+    monkeypatch.setattr(tracer, "export_path", str(path))
+    # Every trace counts as slow
+    monkeypatch.setattr(tracer, "slow_ms", 1e-6)
+    yield path
+    tracer.close()
+
+
+def read_traces(path) -> list[list[dict]]:
+    return [
+        json.loads(line)["resourceSpans"][0]["scopeSpans"][0]["spans"]
+        for line in path.read_text().splitlines()
+    ]
+
+
+def test_request_is_one_trace_with_nested_spans(client, traces):
+    with TestClient(TracingMiddleware(client.app)) as traced_client:
+        register(traced_client, "alpha", 2)
+
+    request = next(spans for spans in read_traces(traces) if spans[0]["kind"] == 2)
+    root = request[0]
+    assert root["name"] == "POST /api/peers/register"
+    assert "parentSpanId" not in root
+    assert {"key": "http.status_code", "value": {"intValue": "200"}} in root[
+        "attributes"
+    ]
+    names = {span["name"] for span in request}
+    assert {"crud.create_peer", "db.query", "provision.wait"} <= names
+    assert {span["traceId"] for span in request} == {root["traceId"]}
+    span_ids = {span["spanId"] for span in request}
+    assert all(span["parentSpanId"] in span_ids for span in request[1:])
+
+    # The coalesced WireGuard update is traced on its own
+    batch = next(spans for spans in read_traces(traces) if spans[0]["kind"] == 1)
+    assert batch[0]["name"] == "provision.batch"
+    assert "wg.apply" in {span["name"] for span in batch}
+
+
+def test_slow_traces_are_logged_as_a_tree(traces, capsys):
+    with tracer.span("outer") as outer:
+        with tracer.span("inner", **{"db.statement": "SELECT  1"}):
+            pass
+
+    output = capsys.readouterr().out
+    assert "[server]: Slow operation:" in output
+    assert format_tree(outer) in output
+    assert "\n  inner " in output and "SELECT 1" in output
+
+
+def test_disabled_tracer_records_nothing(tmp_path, monkeypatch):
+    monkeypatch.setattr(tracer, "enabled", False)
+    monkeypatch.setattr(tracer, "export_path", str(tmp_path / "traces.jsonl"))
+
+    with tracer.span("ignored") as span:
+        assert span is None
+        assert tracer.current_span() is None
+    assert not (tmp_path / "traces.jsonl").exists()
@@ -0,0 +1,94 @@
+"""Tests for restarting the server without dropping tunnels"""
+
+import os
+import subprocess
+
+from sqlalchemy import create_engine, func, select
+from sqlalchemy.orm import sessionmaker
+
+from server import wireguard
+from server.database.models import Base, IPAllocation
+from server.services.shards import ShardedIPManager
+from server.wireguard import (
+    InterfaceState,
+    load_or_create_key_pair,
+    open_server,
+    read_interface,
+)
+
+
+def test_key_pair_is_kept_across_starts(tmp_path):
+    path = str(tmp_path / "server.key")
+
+    private, public = load_or_create_key_pair(path)
+    again = load_or_create_key_pair(path)
+
+    assert (str(again[0]), str(again[1])) == (str(private), str(public))
+    assert os.stat(path).st_mode & 0o777 == 0o600
+
+
+def test_read_interface_parses_wg_and_ip_output():
+    outputs = {
+        "wg": "priv=\tpub=\t51820\toff\npeer=\t(none)\t(none)\t10.0.0.2/32\t0\t0\t0\toff\n",
+        "ip": (
+            "7: wg0    inet 10.0.0.1/24 scope global wg0\\       valid_lft forever\n"
+            "7: wg0    inet6 fd00::1/64 scope global \\       valid_lft forever\n"
+        ),
+    }
+
+    def run(args, **kwargs):
+        return subprocess.CompletedProcess(args, 0, outputs[args[0]], "")
+
+    assert read_interface("wg0", run) == InterfaceState(
+        "pub=", 51820, ["10.0.0.1/24", "fd00::1/64"]
+    )
+
+    def missing(args, **kwargs):
+        return subprocess.CompletedProcess(args, 1, "", "No such device")
+
+    assert read_interface("wg0", missing) is None
+
+
+class FakeServer:
+    """Records the interface calls python_wireguard's Server would make"""
+
+    calls: list = []
+
+    def __init__(self, interface_name, key, local_ip, port):
+        self.interface_name = interface_name
+        self.interface_created = False
+
+    def enable(self):
+        self.calls.append("enable" if self.interface_created else "create")
+
+    def delete_interface(self):
+        self.calls.append("delete")
+
+
+def test_matching_interface_is_adopted_and_others_recreated(tmp_path, monkeypatch):
+    private, public = load_or_create_key_pair(str(tmp_path / "server.key"))
+    live = InterfaceState(str(public), 51820, ["10.0.0.1/24"])
+    monkeypatch.setattr(wireguard, "Server", FakeServer)
+    monkeypatch.setattr(wireguard, "read_interface", lambda name: live)
+    FakeServer.calls = []
+
+    _, adopted = open_server("wg0", private, public, "10.0.0.1/24", 51820)
+    assert adopted and FakeServer.calls == ["enable"]
+
+    FakeServer.calls = []
+    _, adopted = open_server("wg0", private, public, "10.0.0.1/24", 51821)
+    assert not adopted and FakeServer.calls == ["delete", "create"]
+
+
+def test_pool_initialization_is_idempotent():
+    engine = create_engine("sqlite://")
+    Base.metadata.create_all(bind=engine)
+    db = sessionmaker(bind=engine)()
+
+    for _ in range(3):
+        manager = ShardedIPManager("10.0.0.0/16", 24, 51820, shards=2)
+        manager.initialize_ip_pool(db)
+
+    reserved = db.scalar(select(func.count()).where(IPAllocation.is_reserved))
+    assert reserved == 2
+    assert manager.allocate_ip(db, 1) == "10.0.0.2"
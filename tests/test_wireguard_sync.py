@@ -0,0 +1,73 @@
+"""Tests for diff-based WireGuard peer reconciliation, run against the in-memory backend"""
+
+from sqlalchemy import create_engine
+from sqlalchemy.orm import sessionmaker
+
+from server.database.models import Base, Peer, IPAllocation
+from server.wireguard import InMemoryBackend, PeerReconciler, sync_wireguard_peers
+
+
+def make_session():
+    engine = create_engine("sqlite://")
+    Base.metadata.create_all(bind=engine)
+    return sessionmaker(bind=engine)()
+
+
+def add_peer(db, name: str, ip: str, enabled: bool = True) -> Peer:
+    peer = Peer(
+        name=name,
+        public_key=f"{name}-key",
+        assigned_ip=f"{ip}/24",
+        api_key_hash=f"{name}-api",
+        is_enabled=enabled,
+    )
+    db.add(peer)
+    db.flush()
+    db.add(IPAllocation(ip_address=ip, peer_id=peer.id))
+    db.commit()
+    return peer
+
+
+def test_only_changed_peers_are_applied():
+    db = make_session()
+    add_peer(db, "a", "10.0.0.2")
+    add_peer(db, "b", "10.0.0.3")
+    backend = InMemoryBackend({"a-key": "10.0.0.2", "stale-key": "10.0.0.9"})
+    reconciler = PeerReconciler(backend)
+
+    changes = sync_wireguard_peers(db, reconciler)
+
+    assert changes.add == {"b-key": "10.0.0.3"}
+    assert changes.remove == ["stale-key"]
+    assert changes.update == {}
+    assert backend.peers == {"a-key": "10.0.0.2", "b-key": "10.0.0.3"}
+
+
+def test_disabled_peer_is_removed():
+    db = make_session()
+    add_peer(db, "a", "10.0.0.2")
+    peer = add_peer(db, "b", "10.0.0.3")
+    backend = InMemoryBackend()
+    reconciler = PeerReconciler(backend)
+    sync_wireguard_peers(db, reconciler)
+
+    peer.is_enabled = False
+    db.commit()
+    changes = sync_wireguard_peers(db, reconciler)
+
+    assert changes.remove == ["b-key"]
+    assert changes.op_count == 1
+    assert backend.peers == {"a-key": "10.0.0.2"}
+
+
+def test_unchanged_state_skips_backend():
+    db = make_session()
+    add_peer(db, "a", "10.0.0.2")
+    backend = InMemoryBackend()
+    reconciler = PeerReconciler(backend)
+
+    sync_wireguard_peers(db, reconciler)
+    changes = sync_wireguard_peers(db, reconciler)
+
+    assert not changes
+    assert len(backend.applied) == 1